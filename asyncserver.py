@@ -0,0 +1,301 @@
+import asyncio, socket, sys, logging
+from http import HTTPStatus
+from email.utils import formatdate
+
+from sockwriter import IOV_MAX
+
+MAX_REQUEST_SIZE = 8192
+
+# A minimal HTTP/1.0 request handler on a non-blocking socket with the
+# BaseHTTPRequestHandler interface, so the same do_GET can serve both servers.
+# It has its own write buffer which holds memoryviews, not copies.
+class AsyncRequestHandler:
+    server_version = 'Fmp4streamer'
+    protocol_version = 'HTTP/1.0'
+
+    def __init__(self, server, sock, client_address):
+        self.server = server
+        self.loop = server.loop
+        self.connection = sock
+        self.client_address = client_address
+        self.wfile = self
+        self.path = None
+        self.rbuf = bytearray()
+        self.headers_buffer = []
+        # unsent buffers, they can point into the V4L2 buffers held by wleases
+        self.wbufs = []
+        self.wleases = []
+        self.finishing = False
+        self.closed = False
+        # the response waits for the data, see respond_when
+        self.deferred = False
+        self.waiting = None
+        # streaming
+        self.reader = None
+        self.write_frame = None
+        self.on_close = None
+        self.loop.add_reader(sock, self.on_readable)
+
+    def on_readable(self):
+        try:
+            data = self.connection.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            return self.close(e)
+        if not data:
+            return self.close(None)
+        if self.path is not None:
+            # we don't care about the data after the request
+            return
+
+        self.rbuf += data
+        if self.rbuf.find(b'\r\n\r\n') == -1:
+            if len(self.rbuf) > MAX_REQUEST_SIZE:
+                self.path = ''
+                self.send_error(431)
+                self.finish()
+            return
+
+        requestline = bytes(self.rbuf[:self.rbuf.find(b'\r\n')]).decode('iso-8859-1')
+        self.rbuf = None
+        words = requestline.split()
+        if len(words) != 3:
+            self.path = ''
+            self.send_error(400)
+        else:
+            self.command, self.path, self.request_version = words
+            if self.command != 'GET':
+                self.send_error(501)
+            else:
+                self.log_request(requestline)
+                try:
+                    self.do_GET()
+                except Exception as e:
+                    return self.close(e)
+        if not self.reader and not self.deferred:
+            self.finish()
+
+    def send_response(self, code):
+        self.headers_buffer.append(f'{self.protocol_version} {code} {HTTPStatus(code).phrase}\r\n'.encode('latin-1'))
+        self.send_header('Server', self.server_version)
+        self.send_header('Date', formatdate(usegmt=True))
+
+    def send_header(self, keyword, value):
+        self.headers_buffer.append(f'{keyword}: {value}\r\n'.encode('latin-1'))
+
+    def end_headers(self):
+        if not self.headers_buffer:
+            return
+        self.headers_buffer.append(b'\r\n')
+        self.write(b''.join(self.headers_buffer))
+        self.headers_buffer = []
+
+    def send_error(self, code):
+        body = f'{code} {HTTPStatus(code).phrase}\n'.encode('latin-1')
+        self.send_response(code)
+        self.send_header('Connection', 'close')
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.write(body)
+
+    def log_request(self, requestline):
+        self.log_message(f'"{requestline}"')
+
+    def log_message(self, message):
+        sys.stderr.write(f'{self.client_address[0]} - - [{formatdate(localtime=True)}] {message}\n')
+
+    # writer interface for the MP4Writer
+    def write(self, data):
+        self.writev([data])
+
+    # frame: the bufs point into it, it is held until the bufs are sent
+    def writev(self, bufs, frame = None):
+        if self.closed:
+            raise BrokenPipeError('connection closed')
+        lease = frame.acquire() if frame else None
+        if lease:
+            self.wleases.append(lease)
+        if self.wbufs:
+            self.wbufs.extend(bufs)
+            return
+        self.wbufs = bufs
+        self.flush()
+
+    def flush(self):
+        try:
+            while self.wbufs:
+                sent = self.connection.sendmsg(self.wbufs[:IOV_MAX])
+                while self.wbufs and sent >= len(self.wbufs[0]):
+                    sent -= len(self.wbufs[0])
+                    self.wbufs.pop(0)
+                if sent:
+                    self.wbufs[0] = memoryview(self.wbufs[0])[sent:]
+        except BlockingIOError:
+            self.loop.add_writer(self.connection, self.on_writable)
+            return False
+        self.release_wleases()
+        return True
+
+    def release_wleases(self):
+        for lease in self.wleases:
+            lease.release()
+        self.wleases = []
+
+    def on_writable(self):
+        try:
+            if not self.flush():
+                return
+        except OSError as e:
+            return self.close(e)
+        self.loop.remove_writer(self.connection)
+        if self.finishing:
+            self.close(None)
+        elif self.reader:
+            self.feed()
+
+    # close the connection after the response is sent
+    def finish(self):
+        self.finishing = True
+        if not self.wbufs:
+            self.close(None)
+
+    # send the frames from the reader with write_frame(frame) until close
+    def start_stream(self, reader, write_frame, on_close):
+        self.reader = reader
+        self.write_frame = write_frame
+        self.on_close = on_close
+        self.server.streams.add(self)
+        # the caller can still write the stream header before the first frame
+        self.loop.call_soon(self.feed)
+
+    def feed(self):
+        try:
+            # stop reading if the socket is full, the reader keeps our place in the ring
+            while not self.wbufs and not self.closed:
+                frame = self.reader.read_frame(0)
+                if frame is None:
+                    return
+                self.write_frame(frame)
+        except Exception as e:
+            self.close(e)
+
+    # calls respond() when ready() returns True or after the timeout, then finishes the response
+    # unless respond() waits again. ready() is checked again when someone calls server.wakeup()
+    def respond_when(self, ready, respond, timeout):
+        if ready():
+            respond()
+            return
+        self.deferred = True
+        self.waiting = (ready, respond, self.loop.call_later(timeout, self.respond_deferred))
+        self.server.waiters.add(self)
+
+    def check_waiting(self):
+        if self.waiting[0]():
+            self.respond_deferred()
+
+    def respond_deferred(self):
+        _, respond, timer = self.waiting
+        self.waiting = None
+        timer.cancel()
+        self.server.waiters.discard(self)
+        self.deferred = False
+        try:
+            respond()
+        except Exception as e:
+            return self.close(e)
+        if not self.deferred:
+            self.finish()
+
+    def close(self, e):
+        if self.closed:
+            return
+        self.closed = True
+        if self.waiting:
+            self.waiting[2].cancel()
+            self.waiting = None
+            self.server.waiters.discard(self)
+        self.wbufs = []
+        self.release_wleases()
+        self.loop.remove_reader(self.connection)
+        self.loop.remove_writer(self.connection)
+        self.connection.close()
+        if self.reader:
+            self.server.streams.discard(self)
+            self.reader.close()
+            self.on_close(e)
+
+
+# One event loop serves every client. The capture thread only wakes up the loop,
+# which sends the new frames to every streaming client
+class AsyncStreamingServer:
+    def __init__(self, server_address, RequestHandlerClass, parser):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.loop = asyncio.new_event_loop()
+        self.streams = set()
+        self.feeding = False
+        # deferred responses, see AsyncRequestHandler.respond_when
+        self.waiters = set()
+        self.waking = False
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # disable Nagle's algorithm for lower latency
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+
+        parser.add_listener(self.frame_published)
+
+    # called from the capture thread
+    def frame_published(self):
+        if not self.feeding:
+            self.feeding = True
+            self.loop.call_soon_threadsafe(self.feed_streams)
+
+    def feed_streams(self):
+        self.feeding = False
+        for stream in list(self.streams):
+            stream.feed()
+
+    # can be called from any thread when a deferred response could be ready
+    def wakeup(self):
+        if not self.waking:
+            self.waking = True
+            self.loop.call_soon_threadsafe(self.check_waiters)
+
+    def check_waiters(self):
+        self.waking = False
+        for waiter in list(self.waiters):
+            try:
+                waiter.check_waiting()
+            except Exception as e:
+                waiter.close(e)
+
+    def accept(self):
+        try:
+            sock, client_address = self.socket.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.warning(f'AsyncStreamingServer: accept failed: {e}')
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.RequestHandlerClass(self, sock, client_address)
+
+    def start(self):
+        self.loop.add_reader(self.socket, self.accept)
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        self.loop.remove_reader(self.socket)
+        self.socket.close()
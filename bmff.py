@@ -1,4 +1,5 @@
-from struct import pack
+import io
+from struct import pack, Struct
 
 HANDLERNAME = b'TinyStreamer'
 COMPATSTRING = b'isomiso2iso5avc1mp41'
@@ -79,7 +80,8 @@ ROT270MATRIX = pack('>9I',
     0x00000000, 0x00000000, 0x40000000
 )
 
-def write_moov(w, width, height, rotation, timescale, sps, pps):
+# vps, hvcc_header: H265 (hvc1), H264 (avc1) without them
+def write_moov(w, width, height, rotation, timescale, sps, pps, vps = None, hvcc_header = None):
     if rotation == 0:
         rot_matrix = ROT0MATRIX
     elif rotation == 90:
@@ -91,8 +93,37 @@ def write_moov(w, width, height, rotation, timescale, sps, pps):
     else:
         raise ValueError(f'bmff: write_moov: rotation should be 0, 90, 180, 270 not {rotation}')
 
-    w.write(pack('>I 4s', MOOVSIZEWOSPSPPS + len(sps) + len(pps), b'moov'))
-#    w.write((MOOVSIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+    if vps is None:
+        entrytype = b'avc1'
+        # MPEG-4 Part 15 extension
+        # See ISO/IEC 14496-15:2004 5.3.4.1.2
+        codecbox = pack('>I 4s B B B B B B H %ds B H %ds' % (len(sps), len(pps)),
+        AVCCSIZEWOSPSPPS + len(sps) + len(pps), b'avcC',
+        1, sps[1], sps[2], sps[3], 0xff, 0xe1,
+        len(sps), sps, 1, len(pps), pps)
+#    w.write((AVCCSIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+#    w.write(b'avcC')
+#    w.write((1).to_bytes(1, 'big'))    # configuration version
+#    w.write(sps[1:2]) # H.264 profile from the SPS (0x64 == high)
+#    w.write(sps[2:3]) # H.264 profile compatibility from the SPS
+#    w.write(sps[3:4]) # H.264 level from the SPS (0x28 == 4.0, 0x2a == 4.2)
+#    w.write((0xff).to_bytes(1, 'big')) # nal unit length - 1 (upper 6 bits == 1)
+#    w.write((0xe1).to_bytes(1, 'big')) # number of sps (upper 3 bits == 1)
+#    w.write((len(sps)).to_bytes(2, 'big'))
+#    w.write(sps)
+#    w.write((1).to_bytes(1, 'big')) # number of pps
+#    w.write((len(pps)).to_bytes(2, 'big'))
+#    w.write(pps)
+    else:
+        # ISO/IEC 14496-15 8.3.3.1, the arrays of the VPS, SPS, PPS after the header (see H265SPS.get_hvcc_header)
+        entrytype = b'hvc1'
+        arrays = b''.join(pack('>B H H', 0x80 | (nalu[0] >> 1) & 0x3f, 1, len(nalu)) + nalu for nalu in (vps, sps, pps))
+        codecbox = pack('>I 4s', 8 + len(hvcc_header) + 1 + len(arrays), b'hvcC') + hvcc_header + bytes([3]) + arrays
+    # the size of the sample entry's codec box above the avcC without SPS, PPS
+    extra = len(codecbox) - AVCCSIZEWOSPSPPS
+
+    w.write(pack('>I 4s', MOOVSIZEWOSPSPPS + extra, b'moov'))
+#    w.write((MOOVSIZEWOSPSPPS + extra).to_bytes(4, 'big'))
 #    w.write(b'moov')
 
     w.write(pack('>I 4s I I I I I I H H II III III III IIIIIII', MVHDSIZE, b'mvhd',
@@ -130,8 +161,8 @@ def write_moov(w, width, height, rotation, timescale, sps, pps):
 #    w.write((0).to_bytes(4, 'big'))          # pre-defined
 #    w.write((0).to_bytes(4, 'big'))          # next track id
 
-    w.write(pack('>I 4s', TRAKSIZEWOSPSPPS + len(sps) + len(pps), b'trak'))
-#    w.write((TRAKSIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+    w.write(pack('>I 4s', TRAKSIZEWOSPSPPS + extra, b'trak'))
+#    w.write((TRAKSIZEWOSPSPPS + extra).to_bytes(4, 'big'))
 #    w.write(b'trak')
     
     w.write(pack('>I 4s I I I I I I I I H H H H 36s I I', TKHDSIZE, b'tkhd',
@@ -163,8 +194,8 @@ def write_moov(w, width, height, rotation, timescale, sps, pps):
 #    w.write((int(width)<<16).to_bytes(4, 'big'))  # width (fixed-point 16.16 format)
 #    w.write((int(height)<<16).to_bytes(4, 'big')) # height (fixed-point 16.16 format)
 
-    w.write(pack('>I 4s', MDIASIZEWOSPSPPS + len(sps) + len(pps), b'mdia'))
-#    w.write((MDIASIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+    w.write(pack('>I 4s', MDIASIZEWOSPSPPS + extra, b'mdia'))
+#    w.write((MDIASIZEWOSPSPPS + extra).to_bytes(4, 'big'))
 #    w.write(b'mdia')
 
     w.write(pack('>I 4s I I I I I H H', MDHDSIZE, b'mdhd', 0, 0, 0, timescale, 0, 0x55c4, 0))
@@ -191,8 +222,8 @@ def write_moov(w, width, height, rotation, timescale, sps, pps):
 #    w.write(HANDLERNAME)       # name
 #    w.write((0).to_bytes(1, 'big'))         # null-terminator
 
-    w.write(pack('>I 4s', MINFSIZEWOSPSPPS + len(sps) + len(pps), b'minf'))
-#    w.write((MINFSIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+    w.write(pack('>I 4s', MINFSIZEWOSPSPPS + extra, b'minf'))
+#    w.write((MINFSIZEWOSPSPPS + extra).to_bytes(4, 'big'))
 #    w.write(b'minf')
 
     w.write(pack('>I 4s I H H H H', VMHDSIZE, b'vmhd', 1, 0, 0, 0, 0))
@@ -219,21 +250,21 @@ def write_moov(w, width, height, rotation, timescale, sps, pps):
 #    w.write(b'url ')
 #    w.write((1).to_bytes(4, 'big')) # version and flags
 
-    w.write(pack('>I 4s', STBLSIZEWOSPSPPS + len(sps) + len(pps), b'stbl'))
-#    w.write((STBLSIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+    w.write(pack('>I 4s', STBLSIZEWOSPSPPS + extra, b'stbl'))
+#    w.write((STBLSIZEWOSPSPPS + extra).to_bytes(4, 'big'))
 #    w.write(b'stbl')
 
     # Sample Table Box
-    w.write(pack('>I 4s IH H', STSDSIZEWOSPSPPS + len(sps) + len(pps), b'stsd', 0, 0, 1))
-#    w.write((STSDSIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+    w.write(pack('>I 4s IH H', STSDSIZEWOSPSPPS + extra, b'stsd', 0, 0, 1))
+#    w.write((STSDSIZEWOSPSPPS + extra).to_bytes(4, 'big'))
 #    w.write(b'stsd')
 #    w.write((0).to_bytes(6, 'big')) # reserved
 #    w.write((1).to_bytes(2, 'big')) # deta reference index
 
     w.write(pack('>I 4s IH H H H I I I H H I I I H 32s H H',
-    AVC1SIZEWOSPSPPS + len(sps) + len(pps), b'avc1',
+    AVC1SIZEWOSPSPPS + extra, entrytype,
     0, 0, 1, 0, 0, 0, 0, 0, width, height, 0x00480000, 0x00480000, 0, 1, bytes(32), 0x18, 0xffff))
-#    w.write((AVC1SIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
+#    w.write((AVC1SIZEWOSPSPPS + extra).to_bytes(4, 'big'))
 #    w.write(b'avc1')
 #    w.write((0).to_bytes(6, 'big'))           # reserved
 #    w.write((1).to_bytes(2, 'big'))           # data reference index
@@ -252,25 +283,7 @@ def write_moov(w, width, height, rotation, timescale, sps, pps):
 #    w.write((0x18).to_bytes(2, 'big'))        # depth
 #    w.write((0xffff).to_bytes(2, 'big'))      # pre-defined
 
-    # MPEG-4 Part 15 extension
-    # See ISO/IEC 14496-15:2004 5.3.4.1.2
-    w.write(pack('>I 4s B B B B B B H %ds B H %ds' % (len(sps), len(pps)),
-    AVCCSIZEWOSPSPPS + len(sps) + len(pps), b'avcC',
-    1, 0x64, 0x00, 0x2a, 0xff, 0xe1,
-    len(sps), sps, 1, len(pps), pps))
-#    w.write((AVCCSIZEWOSPSPPS + len(sps) + len(pps)).to_bytes(4, 'big'))
-#    w.write(b'avcC')
-#    w.write((1).to_bytes(1, 'big'))    # configuration version
-#    w.write((0x64).to_bytes(1, 'big')) # H.264 profile (0x64 == high)
-#    w.write((0x00).to_bytes(1, 'big')) # H.264 profile compatibility
-#    w.write((0x2a).to_bytes(1, 'big')) # H.264 level (0x28 == 4.0, 0x2a == 4.2)
-#    w.write((0xff).to_bytes(1, 'big')) # nal unit length - 1 (upper 6 bits == 1)
-#    w.write((0xe1).to_bytes(1, 'big')) # number of sps (upper 3 bits == 1)
-#    w.write((len(sps)).to_bytes(2, 'big'))
-#    w.write(sps)
-#    w.write((1).to_bytes(1, 'big')) # number of pps
-#    w.write((len(pps)).to_bytes(2, 'big'))
-#    w.write(pps)
+    w.write(codecbox)
 
     w.write(pack('>I 4s I I I', STSZSIZE, b'stsz', 0, 0, 0))
 #    w.write(STSZSIZE.to_bytes(4, 'big'))
@@ -330,6 +343,12 @@ TRAFSIZE = TFHDSIZE + TFDTSIZE + TRUNSIZE + 8
 MFHDSIZE = 8 + 8
 MOOFSIZE = MFHDSIZE + TRAFSIZE + 8
 
+# offsets of the per-client fields inside the moof written by write_moof
+MOOFSEQOFFSET = 8 + 12
+MOOFDECODETIMEOFFSET = 8 + MFHDSIZE + 8 + TFHDSIZE + 12
+MOOFDURATIONOFFSET = 8 + MFHDSIZE + 8 + TFHDSIZE + TFDTSIZE + 24
+MOOFPATCHSIZE = MOOFDURATIONOFFSET + 4
+
 # Movie Fragment Box
 def write_moof(w, seq, mdatsize, is_idr, sampleduration, decodetime):
     w.write(pack('>20s I 40s Q 20s 4s I I',
@@ -398,7 +417,120 @@ trun\
 #    w.write((sampleduration).to_bytes(4, 'big'))      # sample duration
 #    w.write((mdatsize - 8).to_bytes(4, 'big')) # sample size
 
+MOOFFLAGSOFFSET = MOOFDURATIONOFFSET - 4
+
+# Movie Fragment Box with a composition time offset (cto), it's the same as write_moof,
+# but the trun is version 1 with signed offsets, so the IDR frames can have 0 and the B-frames negative offsets
+MOOFCTOSIZE = MOOFSIZE + 4
+def write_moof_cto(w, seq, mdatsize, is_idr, sampleduration, decodetime, cto):
+    w.write(pack('>I 4s I 4s I I I 4s I 4s I I I I 4s I Q I 4s I I I I I I i',
+        MOOFCTOSIZE, b'moof',
+        MFHDSIZE, b'mfhd', 0, seq,
+        TRAFSIZE + 4, b'traf',
+        TFHDSIZE, b'tfhd', 0x020020, 1, 0x01010000,
+        TFDTSIZE, b'tfdt', 0x01000000, decodetime,
+        TRUNSIZE + 4, b'trun',
+        0x01000B05,       # version 1, data offset, first sample flags, sample duration, size, composition time offset present
+        1,                # sample count
+        MOOFCTOSIZE + 8,  # data offset
+        0x02000000 if is_idr else 0x01010000,
+        sampleduration,
+        mdatsize - 8,
+        cto))
+
+# sample flags, (sample duration, patched by the clients), sample size and the size of the following mdat
+MOOFSAMPLESTRUCT = Struct('>I 4x I I')
+# the same with the composition time offset after the sample size
+MOOFCTOSAMPLESTRUCT = Struct('>I 4x I i I')
+NALULENGTHSTRUCT = Struct('>I')
+
+# Builds the moof, the mdat header and the NALU length prefixes of single-sample fragments
+# without struct formats and BytesIO writes: the header is copied from a preallocated template
+# and only the sample flags and sizes are patched in place
+class FragmentBuilder:
+    def __init__(self):
+        template = io.BytesIO()
+        write_moof(template, 0, 8, False, 0, 0)
+        write_mdat_header(template, 8)
+        self.template = template.getvalue()
+        template = io.BytesIO()
+        write_moof_cto(template, 0, 8, False, 0, 0, 0)
+        write_mdat_header(template, 8)
+        self.cto_template = template.getvalue()
+        # the templates with the last SPS, PPS at the beginning of the mdat
+        self.params = None
+        self.params_template = None
+        self.params_cto_template = None
+        # the structs of the length prefixes by the number of the nalus
+        self.prefixes_structs = {}
+
+    # returns the header (moof, mdat header and the params with their length prefixes)
+    # and the length prefixes of the nalus, the nalus follow their prefixes in the mdat
+    # cto: composition time offset, the moof is 4 bytes longer if it's not 0 (see write_moof_cto)
+    def build(self, params, nalus, is_idr, cto = 0):
+        lengths = list(map(len, nalus))
+        count = len(lengths)
+        # every prefix is packed into one buffer with one call, the writers get the views of it
+        prefixes_struct = self.prefixes_structs.get(count)
+        if prefixes_struct is None:
+            prefixes_struct = self.prefixes_structs[count] = Struct(f'>{count}I')
+        prefixes = bytearray(4 * count)
+        prefixes_struct.pack_into(prefixes, 0, *lengths)
+        header = self.build_header(params, 4 * count + sum(lengths), is_idr, cto)
+        view = memoryview(prefixes)
+        return header, [view[i : i + 4] for i in range(0, 4 * count, 4)]
+
+    # returns only the header, payloadsize: the size of the rest of the mdat (AVCC nalus)
+    def build_header(self, params, payloadsize, is_idr, cto = 0):
+        if params and params != self.params:
+            self.params = params
+            params_data = b''.join(NALULENGTHSTRUCT.pack(len(nalu)) + nalu for nalu in params)
+            self.params_template = self.template + params_data
+            self.params_cto_template = self.cto_template + params_data
+
+        flags = 0x02000000 if is_idr else 0x01010000
+        if cto:
+            header = bytearray(self.params_cto_template if params else self.cto_template)
+            mdatsize = len(header) - MOOFCTOSIZE + payloadsize
+            MOOFCTOSAMPLESTRUCT.pack_into(header, MOOFFLAGSOFFSET, flags, mdatsize - 8, cto, mdatsize)
+        else:
+            header = bytearray(self.params_template if params else self.template)
+            mdatsize = len(header) - MOOFSIZE + payloadsize
+            MOOFSAMPLESTRUCT.pack_into(header, MOOFFLAGSOFFSET, flags, mdatsize - 8, mdatsize)
+        return memoryview(header)
+
+# Movie Fragment Box with several samples, every sample has its own duration, size, flags
+# and composition time offset if any of them is not 0
+# samples: [(duration, size, is_idr, cto), ...]
+TRUNSAMPLESIZE = 12
+TRUNCTOSAMPLESIZE = 16
+def get_moof_size(samplecount, cto = False):
+    return MFHDSIZE + TFHDSIZE + TFDTSIZE + 20 + (TRUNCTOSAMPLESIZE if cto else TRUNSAMPLESIZE) * samplecount + 8 + 8
+
+def write_moof_samples(w, seq, decodetime, samples):
+    cto = any(sample[3] for sample in samples)
+    moofsize = get_moof_size(len(samples), cto)
+    w.write(pack('>I 4s I 4s I I I 4s I 4s I I I I 4s I Q I 4s I I I',
+        moofsize, b'moof',
+        MFHDSIZE, b'mfhd', 0, seq,
+        moofsize - MFHDSIZE - 8, b'traf',
+        TFHDSIZE, b'tfhd', 0x020020, 1, 0x01010000, # default-base-is-moof, default sample flags (not i-frame)
+        TFDTSIZE, b'tfdt', 0x01000000, decodetime,
+        moofsize - MFHDSIZE - TFHDSIZE - TFDTSIZE - 16, b'trun',
+        # version 1 (signed composition time offsets) and data offset, sample duration, size, flags, composition time offset present
+        0x01000F01 if cto else 0x00000701,
+        len(samples),     # sample count
+        moofsize + 8))    # data offset: after the mdat header
+    for duration, size, is_idr, offset in samples:
+        if cto:
+            w.write(pack('>I I I i', duration, size, 0x02000000 if is_idr else 0x01010000, offset))
+        else:
+            w.write(pack('>I I I', duration, size, 0x02000000 if is_idr else 0x01010000))
+
 # Media Data Box
+def write_mdat_header(w, mdatsize):
+    w.write(pack('>I 4s', mdatsize, b'mdat'))
+
 def write_mdat(w, nalus):
     w.write(get_mdat_size(nalus).to_bytes(4, 'big'))
     w.write(b'mdat')
@@ -0,0 +1,310 @@
+import logging
+from collections import deque
+from math import ceil
+from threading import Thread, Condition
+from time import monotonic, time
+
+from mp4writer import MP4Writer
+
+# stop the segmenter (and let the camera sleep) if nobody requested anything for this long
+IDLE_TIMEOUT = 10
+# wait at most this long for the first segment, the camera could be sleeping
+STARTUP_TIMEOUT = 10
+
+# A partial segment: a few frames, every frame is a moof+mdat pair (chunk)
+class Part:
+    __slots__ = ('chunks', 'data', 'duration', 'independent')
+
+    def __init__(self, chunks, duration, independent):
+        self.chunks = chunks
+        self.data = None
+        # in seconds
+        self.duration = duration
+        # starts with a keyframe
+        self.independent = independent
+
+    def get_data(self):
+        if self.data is None:
+            self.data = b''.join(self.chunks)
+        return self.data
+
+
+# A segment starts with a keyframe, it is complete when the next one starts
+class Segment:
+    def __init__(self, msn, start, start_dts, period, period_start, init):
+        # media sequence number
+        self.msn = msn
+        # the segments of a period have the same init segment, a new one starts when the SPS, PPS change
+        self.period = period
+        # decode time of the period's first frame in timescale units
+        self.period_start = period_start
+        self.init = init
+        # decode time of the first frame in timescale units
+        self.start = start
+        # decode timestamp of the first frame in microseconds
+        self.start_dts = start_dts
+        # the camera was asked for the keyframe of the next segment
+        self.keyframe_requested = False
+        # every frame's moof+mdat, they are added as soon as they are muxed
+        self.chunks = []
+        self.size = 0
+        self.parts = []
+        # in seconds
+        self.duration = 0
+        # in timescale units, the durations are summed in integers, so they don't drift
+        self.ticks = 0
+        self.complete = False
+        self.data = None
+
+    def get_data(self):
+        if self.data is None:
+            self.data = b''.join(self.chunks)
+        return self.data
+
+
+# Cuts the frames of the parser into CMAF segments at the keyframes and into parts
+# of at most part_duration seconds. It keeps the last max_segments segments in memory.
+# It runs only while the clients request its segments, see touch()
+class CMAFSegmenter(Thread):
+    def __init__(self, parser, fragment_producer, camera, sleeper,
+        width, height, rotation, timescale,
+        part_duration, segment_duration, max_segments):
+        super(CMAFSegmenter, self).__init__(daemon=True)
+        self.parser = parser
+        self.fragment_producer = fragment_producer
+        self.camera = camera
+        self.sleeper = sleeper
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.timescale = timescale
+        self.part_duration = part_duration
+        self.segment_duration = segment_duration
+        self.max_segments = max_segments
+        # the segments are cut at the first keyframe after segment_duration and the camera is asked
+        # for that keyframe in time, so this is the longest segment, it can't change (RFC 8216 6.2.1)
+        self.target = max(1, ceil(segment_duration))
+        self.target_warned = False
+        # the longest complete segment of the session in seconds
+        self.longest = 0
+
+        self.condition = Condition()
+        self.active = False
+        self.last_request = 0
+        self.init = None
+        # the period of the current init segment, see Segment
+        self.period = 0
+        self.period_start = 0
+        self.next_period = 0
+        # wall clock time of the decode time 0
+        self.start_time = 0
+        self.segments = deque()
+        # the numbering continues after an idle period, so the cached segments don't collide
+        self.next_msn = 0
+        # called from the segmenter thread after every new frame
+        self.listeners = []
+
+        # MP4Writer output of the current frame
+        self.out = []
+        # frames of the current part
+        self.chunks = []
+        self.chunks_ticks = 0
+        self.chunks_independent = False
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # called by every request, it starts the segmenter if it's idle
+    def touch(self):
+        with self.condition:
+            self.last_request = monotonic()
+            if not self.active:
+                self.active = True
+                self.condition.notify_all()
+
+    # waits until ready() returns True, the condition is held while ready() runs
+    def wait_for(self, ready, timeout):
+        with self.condition:
+            return self.condition.wait_for(ready, timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.active)
+            try:
+                self.run_session()
+            except Exception as e:
+                logging.warning(f'CMAFSegmenter: {e}')
+            finally:
+                with self.condition:
+                    # a request could arrive while we were stopping
+                    self.active = monotonic() - self.last_request < IDLE_TIMEOUT
+                    self.init = None
+                    self.segments.clear()
+                    self.longest = 0
+                    self.out = []
+                    self.chunks = []
+                    self.chunks_ticks = 0
+                    self.condition.notify_all()
+
+    def run_session(self):
+        # a woken up camera starts with a keyframe anyway
+        running = not self.camera.sleeping
+        # it clears the cached GOP if the camera was sleeping, the frames are stale
+        self.sleeper.add_client()
+        reader = self.parser.reader()
+        try:
+            if running and not reader.from_gop:
+                self.camera.request_key_frame()
+            mp4_writer = self.start_period(self.parser.params)
+
+            while monotonic() - self.last_request < IDLE_TIMEOUT:
+                frame = reader.read_frame(1)
+                if frame is None:
+                    continue
+                if frame.keyframe and frame.params != mp4_writer.params:
+                    # the segments can't change their init segment, a new period starts with the new one
+                    logging.info('CMAFSegmenter: SPS, PPS changed, starting a new period')
+                    mp4_writer = self.start_period(frame.params, mp4_writer)
+                self.add_frame(mp4_writer, frame)
+        finally:
+            reader.close()
+            self.sleeper.remove_client()
+
+    # returns the MP4Writer of the new init segment, its timeline continues after the previous writer's frames,
+    # the next frame starts a new segment (HLS discontinuity, DASH period)
+    def start_period(self, params, prev = None):
+        mp4_writer = MP4Writer(self, self.width, self.height, self.rotation, self.timescale, params)
+        if prev is not None:
+            mp4_writer.seq = prev.seq
+            mp4_writer.decodetime = prev.decodetime
+            mp4_writer.prev_dts = prev.prev_dts
+        with self.condition:
+            self.init = b''.join(self.out)
+            self.out = []
+            self.period = self.next_period
+            self.period_start = mp4_writer.decodetime
+            self.next_period += 1
+            self.condition.notify_all()
+        return mp4_writer
+
+    # writer interface for the MP4Writer, the frames are copied, because they are kept for a while
+    def write(self, data):
+        self.out.append(bytes(data))
+
+    def writev(self, bufs, frame = None):
+        self.out.append(b''.join(bufs))
+
+    def add_frame(self, mp4_writer, frame):
+        decodetime = mp4_writer.decodetime
+        mp4_writer.write_frame(frame, self.fragment_producer.get_fragment(frame))
+        if not self.out:
+            # waiting for the first keyframe
+            return
+        data = b''.join(self.out)
+        self.out = []
+        ticks = mp4_writer.decodetime - decodetime
+        part_ticks = round(self.part_duration * self.timescale)
+        segment_ticks = self.segment_duration * self.timescale
+
+        with self.condition:
+            segment = self.segments[-1] if self.segments else None
+            # the time since the first frame of the segment, not the sum of the durations,
+            # because the first sample of the stream is only 1 tick long
+            elapsed = (frame.dts - segment.start_dts) * self.timescale / 1000000 if segment else 0
+            # the timestamps jitter, so allow half a frame shorter segments
+            if frame.keyframe and (segment is None or segment.period != self.period or
+                segment.keyframe_requested or elapsed + ticks // 2 >= segment_ticks):
+                if segment is None:
+                    # the frame could be captured a while ago (e.g. the cached GOP)
+                    self.start_time = time() - (monotonic() - frame.dts / 1000000) - decodetime / self.timescale
+                self.close_part()
+                self.start_segment(decodetime, frame.dts)
+                elapsed = 0
+            elif self.chunks and self.chunks_ticks + ticks > part_ticks:
+                self.close_part()
+
+            segment = self.segments[-1]
+            # ask for the next keyframe a frame before the end of the segment, it takes a frame or two
+            if not segment.keyframe_requested and elapsed + 2 * ticks >= segment_ticks:
+                segment.keyframe_requested = True
+                if not self.camera.sleeping:
+                    self.camera.request_key_frame()
+            segment.chunks.append(data)
+            segment.size += len(data)
+            segment.ticks += ticks
+            segment.duration = segment.ticks / self.timescale
+
+            if not self.chunks:
+                self.chunks_independent = frame.keyframe
+            self.chunks.append(data)
+            self.chunks_ticks += ticks
+
+            if self.chunks_ticks >= part_ticks:
+                self.close_part()
+            self.condition.notify_all()
+
+        for listener in self.listeners:
+            listener()
+
+    # the condition should be held by the caller
+    def close_part(self):
+        if not self.chunks:
+            return
+        self.segments[-1].parts.append(Part(self.chunks, self.chunks_ticks / self.timescale, self.chunks_independent))
+        self.chunks = []
+        self.chunks_ticks = 0
+
+    # the condition should be held by the caller
+    def start_segment(self, decodetime, dts):
+        if self.segments:
+            last = self.segments[-1]
+            last.complete = True
+            self.longest = max(self.longest, last.duration)
+            if round(last.duration) > self.target and not self.target_warned:
+                logging.warning(f'CMAFSegmenter: {last.duration:.3f} seconds long segment, the camera doesn\'t send the requested keyframes, ' +
+                    f'the segments are longer than the {self.target} seconds target duration')
+                self.target_warned = True
+        self.segments.append(Segment(self.next_msn, decodetime, dts, self.period, self.period_start, self.init))
+        self.next_msn += 1
+        while len(self.segments) > self.max_segments:
+            self.segments.popleft()
+
+    # the condition should be held by the caller for the following methods
+
+    def get_segment(self, msn):
+        if self.segments and self.segments[0].msn <= msn <= self.segments[-1].msn:
+            return self.segments[msn - self.segments[0].msn]
+        return None
+
+    # the init segment of the period, the current one if period is None
+    def get_init(self, period = None):
+        if period is None or period == self.period:
+            return self.init
+        for segment in self.segments:
+            if segment.period == period:
+                return segment.init
+        return None
+
+    def current_segment(self):
+        return self.segments[-1] if self.segments else None
+
+    # the segments are never longer than this, in seconds
+    def target_duration(self):
+        return self.target
+
+    # how long a request can wait for the data
+    def block_timeout(self):
+        if not self.segments:
+            return STARTUP_TIMEOUT
+        return 3 * self.target_duration()
+
+    # the part (or the whole segment if part is None) is available
+    def has_part(self, msn, part = None):
+        segment = self.get_segment(msn)
+        if segment is None:
+            # already dropped or not yet started
+            return bool(self.segments) and msn < self.segments[0].msn
+        if part is None:
+            return segment.complete
+        return part < len(segment.parts) or segment.complete
@@ -0,0 +1,99 @@
+import re
+from time import time, gmtime, strftime
+from urllib.parse import urlsplit
+
+# Low-latency MPEG-DASH over the segments of the CMAFSegmenter.
+# The segment which is still being muxed is sent with chunked transfer, frame by frame.
+# References:
+# ISO/IEC 23009-1 Dynamic adaptive streaming over HTTP (DASH)
+# DASH-IF IOP Low-latency Modes for DASH
+
+FILE_RE = re.compile(r'/dash/(?:init(\d*)\.mp4|seg(\d+)\.m4s)')
+
+# returns (kind, msn) or None, kind is init or seg, msn is the period of the init segment (None without it)
+def parse_file_path(path):
+    m = FILE_RE.fullmatch(urlsplit(path).path)
+    if not m:
+        return None
+    if m.group(2) is not None:
+        return ('seg', int(m.group(2)))
+    return ('init', int(m.group(1)) if m.group(1) else None)
+
+def format_time(t):
+    return strftime('%Y-%m-%dT%H:%M:%S', gmtime(t)) + f'.{int(t * 1000) % 1000:03d}Z'
+
+def format_duration(seconds):
+    return f'PT{seconds:.3f}S'
+
+# the condition of the segmenter should be held by the caller for the following functions
+
+def is_mpd_ready(segmenter):
+    return any(segment.complete for segment in segmenter.segments)
+
+# the segment can't be requested before the previous one is complete
+def is_valid_msn(segmenter, msn):
+    current = segmenter.current_segment()
+    return current is not None and msn <= current.msn + 1
+
+def is_segment_started(segmenter, msn):
+    current = segmenter.current_segment()
+    return current is not None and msn <= current.msn
+
+# returns the new chunks of the segment after the first sent ones and if the segment is complete,
+# or None if there is nothing new yet
+def get_new_chunks(segmenter, msn, sent):
+    segment = segmenter.get_segment(msn)
+    if segment is None:
+        # already dropped
+        return [], True
+    if len(segment.chunks) == sent and not segment.complete:
+        return None
+    return segment.chunks[sent:], segment.complete
+
+def get_mpd(segmenter, codec, width, height, fps):
+    complete = [segment for segment in segmenter.segments if segment.complete]
+    timescale = segmenter.timescale
+    window = sum(segment.duration for segment in complete)
+    bandwidth = int(sum(segment.size for segment in complete) * 8 / window) if window else 1000000
+    now = time()
+
+    # a new period starts with every new init segment (SPS, PPS change), its timeline continues the previous one
+    periods = []
+    for segment in complete:
+        if not periods or periods[-1][0].period != segment.period:
+            periods.append([])
+        periods[-1].append(segment)
+
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" profiles="urn:mpeg:dash:profile:isoff-live:2011" type="dynamic"
+  availabilityStartTime="{format_time(segmenter.start_time)}" publishTime="{format_time(now)}"
+  minimumUpdatePeriod="{format_duration(segmenter.segment_duration)}" minBufferTime="{format_duration(segmenter.part_duration)}"
+  timeShiftBufferDepth="{format_duration(window)}" maxSegmentDuration="{format_duration(segmenter.longest)}">
+  <ServiceDescription id="0">
+    <Latency target="{int(segmenter.segment_duration * 1000)}"/>
+  </ServiceDescription>
+{''.join(get_period(segmenter, segments, codec, width, height, fps, bandwidth) for segments in periods)}\
+  <UTCTiming schemeIdUri="urn:mpeg:dash:utc:direct:2014" value="{format_time(now)}"/>
+</MPD>
+'''.encode('utf-8')
+
+def get_period(segmenter, segments, codec, width, height, fps, bandwidth):
+    first = segments[0]
+    timescale = segmenter.timescale
+    timeline = '\n'.join(f'            <S t="{segment.start}" d="{segment.ticks}"/>' for segment in segments)
+
+    return f'''\
+  <Period id="{first.period}" start="{format_duration(first.period_start / timescale)}">
+    <AdaptationSet id="0" contentType="video" mimeType="video/mp4" segmentAlignment="true" startWithSAP="1">
+      <Representation id="0" codecs="{codec}" width="{width}" height="{height}" frameRate="{fps}" bandwidth="{bandwidth}">
+        <SegmentTemplate timescale="{timescale}" presentationTimeOffset="{first.period_start}"
+          initialization="dash/init{first.period}.mp4" media="dash/seg$Number$.m4s"
+          startNumber="{first.msn}" availabilityTimeOffset="{segmenter.segment_duration:.3f}" availabilityTimeComplete="false">
+          <SegmentTimeline>
+{timeline}
+          </SegmentTimeline>
+        </SegmentTemplate>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+'''
@@ -1,10 +1,19 @@
-import io, socketserver, logging, configparser, getopt, sys, socket, os
+import socketserver, logging, configparser, getopt, sys, socket, os, ipaddress
 from http import server
 from time import time
+from urllib.parse import urlsplit, parse_qs
 
-import bmff
 from v4l2camera import V4L2Camera, CameraSleeper
-from h264 import H264Parser, H264NALU
+from h264 import H264Parser
+from h265 import H265Parser, H265NALU
+from mp4writer import MP4Writer, FragmentProducer
+from sockwriter import SocketWriter
+from asyncserver import AsyncRequestHandler, AsyncStreamingServer
+from cmaf import CMAFSegmenter
+from rtsp import RTSPServer, MulticastSender
+from relay import Upstream, RelaySource
+from push import PushClient
+import hls, dash
 
 def get_index_html(codec):
     return f'''<!doctype html>
@@ -37,20 +46,36 @@ body {{ margin:0; padding:0; background-color:#303030; }}
 </html>
 '''.encode('utf-8')
 
-def get_stream_m3u8(width, height, codec):
+def get_stream_m3u8(width, height, codec, fps):
     return f'''#EXTM3U
-#EXT-X-STREAM-INF:BANDWIDTH=150000,RESOLUTION={width}x{height},CODECS="{codec}"
+#EXT-X-STREAM-INF:BANDWIDTH=150000,RESOLUTION={width}x{height},FRAME-RATE={fps:.3f},CODECS="{codec}"
 streaminf.m3u8
 '''.encode('utf-8')
 
-def get_streaminf_m3u8():
-    return f'''#EXTM3U
-#EXT-X-TARGETDURATION:49057
-#EXT-X-VERSION:4
-#EXTINF:49057.00,
-stream.mp4?{int(time())}
-#EXT-X-ENDLIST
-'''.encode('utf-8')
+# returns the codec, width, height and fps of the stream, they come from the SPS,
+# the config is used only until the first SPS and for the missing values
+def get_stream_info():
+    info = parser.sps_info
+    if info is None:
+        return config.codec(), config.width(), config.height(), config.fps()
+    return info.codec(), info.width, info.height, round(info.fps) if info.fps else config.fps()
+
+# the samples of a fragment are held in memory and sent at once
+MAX_FRAGMENT_FRAMES = 120
+MAX_FRAGMENT_DURATION = 4000
+
+# stream.mp4?fragment=N or stream.mp4?fragment_ms=T: N frames or T milliseconds in one fragment
+# the fragment is closed at the first limit if both of them are given
+def get_fragment_options(path):
+    query = parse_qs(urlsplit(path).query)
+    fragment_frames = int(query['fragment'][0]) if 'fragment' in query else 0
+    fragment_duration = int(query['fragment_ms'][0]) if 'fragment_ms' in query else 0
+    if 'fragment' in query and fragment_frames < 1 or fragment_duration < 0 or \
+        fragment_frames > MAX_FRAGMENT_FRAMES or fragment_duration > MAX_FRAGMENT_DURATION:
+        raise ValueError('invalid fragment options')
+    if not fragment_frames and not fragment_duration:
+        fragment_frames = 1
+    return fragment_frames, fragment_duration
 
 def get_manifest():
     return '''{
@@ -70,74 +95,8 @@ def get_manifest():
 }
 '''.encode('utf-8')
 
-class MP4Writer:
-    def __init__(self, w, width, height, rotation, timescale, sps, pps):
-        if not sps or not pps:
-            raise ValueError('MP4Writer: sps, pps NALUs are missing!')
-
-        self.seq = 0
-        self.sps = sps
-        self.pps = pps
-        self.start_secs = 0
-        self.start_usecs = 0
-
-        self.framebuf = io.BytesIO()
-
-        self.w = w
-        self.width = width
-        self.height = height
-        self.rotation = rotation
-        self.timescale = timescale
-        self.timescaleusec = timescale / 1000000
-        self.decodetime = 0
-        self.prevtime = 0
-
-        self.write_header()
-
-
-    def write_header(self):
-        buf = io.BytesIO()
-        bmff.write_ftyp(buf)
-        bmff.write_moov(buf, self.width, self.height, self.rotation, self.timescale, self.sps, self.pps)
-        self.w.write(buf.getbuffer())
-
-    def add_frame(self, nalus, frame_secs, frame_usecs):
-        nalutype = H264NALU.get_type(nalus[0])
-
-        # our first frame should have SPS, PPS, IDR NALUS, so wait until we have an IDR or SPS+PPS+IDR
-        if self.seq == 0 and (nalutype != H264NALU.IDRTYPE and nalutype != H264NALU.SPSTYPE):
-            return
-
-        # we have IDR or SPS+PPS+IDR
-        if nalutype == H264NALU.IDRTYPE:
-            self.write_frame([self.sps, self.pps] + nalus, frame_secs, frame_usecs, is_idr=True)
-        elif nalutype == H264NALU.SPSTYPE:
-            self.write_frame(nalus, frame_secs, frame_usecs, is_idr=True)
-        elif nalutype == H264NALU.NONIDRTYPE:
-            self.write_frame(nalus, frame_secs, frame_usecs, is_idr=False)
-
-    def write_frame(self, nalus, frame_secs, frame_usecs, is_idr):
-        if self.seq == 0:
-            self.start_secs = frame_secs
-            self.start_usecs = frame_usecs
-            sampleduration = 1
-        else:
-            sampleduration = round(
-                (frame_secs - self.start_secs) * self.timescale +
-                (frame_usecs - self.start_usecs) * self.timescaleusec -
-                self.decodetime)
-
-        mdatsize = bmff.get_mdat_size(nalus)
-        self.framebuf.seek(0)
-        bmff.write_moof(self.framebuf, self.seq, mdatsize, is_idr, sampleduration, self.decodetime)
-        bmff.write_mdat(self.framebuf, nalus)
-        self.w.write(self.framebuf.getbuffer()[:bmff.MOOFSIZE + mdatsize])
-
-        self.seq += 1
-        self.decodetime += sampleduration
-
-
-class StreamingHandler(server.BaseHTTPRequestHandler):
+# the routes are shared between the threading and the asyncio server
+class StreamingHandlerMixin:
     def do_GET(self):
         if self.path == '/':
             self.send_response(301)
@@ -148,7 +107,7 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Age', '0')
             self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
             self.send_header('Content-Type', 'text/html')
-            indexhtml = get_index_html(config.codec())
+            indexhtml = get_index_html(get_stream_info()[0])
             self.send_header('Content-Length', len(indexhtml))
             self.end_headers()
             self.wfile.write(indexhtml)
@@ -174,40 +133,354 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Age', '0')
             self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
             self.send_header('Content-Type', 'application/x-mpegURL')
-            streamm3u8 = get_stream_m3u8(config.width(), config.height(), config.codec())
+            codec, width, height, fps = get_stream_info()
+            streamm3u8 = get_stream_m3u8(width, height, codec, fps)
             self.send_header('Content-Length', len(streamm3u8))
             self.end_headers()
             self.wfile.write(streamm3u8)
-        elif self.path == '/streaminf.m3u8':
+        elif self.path.startswith('/streaminf.m3u8'):
+            self.send_hls_playlist()
+        elif self.path.startswith('/hls/'):
+            self.send_hls_file()
+        elif self.path.startswith('/stream.mpd'):
+            self.send_dash_mpd()
+        elif self.path.startswith('/dash/'):
+            self.send_dash_file()
+        elif self.path == '/multicast.sdp':
+            if multicast_sender is None:
+                self.send_error(404)
+                self.end_headers()
+                return
             self.send_response(200)
             self.send_header('Age', '0')
             self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Content-Type', 'application/x-mpegURL')
-            streaminfm3u8 = get_streaminf_m3u8()
-            self.send_header('Content-Length', len(streaminfm3u8))
+            self.send_header('Content-Type', 'application/sdp')
+            sdp = multicast_sender.get_sdp(self.connection.getsockname()[0])
+            self.send_header('Content-Length', len(sdp))
             self.end_headers()
-            self.wfile.write(streaminfm3u8)
-        elif self.path.startswith('/stream.mp4'):
+            self.wfile.write(sdp)
+        elif self.path.startswith('/stream.mp4') or self.path.startswith('/keyframes.mp4'):
+            try:
+                fragment_frames, fragment_duration = get_fragment_options(self.path)
+            except ValueError:
+                self.send_error(400)
+                self.end_headers()
+                return
             self.send_response(200)
             self.send_header('Age', '0')
             self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Content-Type', f'video/mp4; codecs="{config.codec()}"')
+            self.send_header('Content-Type', f'video/mp4; codecs="{get_stream_info()[0]}"')
             self.end_headers()
-            try:
-                if not camera.sleeping:
-                    camera.request_key_frame()
-                cameraSleeper.add_client()
-                mp4_writer = MP4Writer(self.wfile, config.width(), config.height(), config.rotation(), config.timescale(), h264parser.sps, h264parser.pps)
-                while True:
-                    nalus, frame_secs, frame_usecs = h264parser.read_frame()
-                    mp4_writer.add_frame(nalus, frame_secs, frame_usecs)
-            except Exception as e:
-                cameraSleeper.remove_client()
-                self.log_message(f'Removed streaming client {self.client_address} {e}')
+            self.stream_mp4(fragment_frames, fragment_duration, self.path.startswith('/keyframes.mp4'))
+        elif self.path == ('/stream.h265' if parser.NALU is H265NALU else '/stream.h264'):
+            self.send_response(200)
+            self.send_header('Age', '0')
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.send_header('Content-Type', 'video/h265' if parser.NALU is H265NALU else 'video/h264')
+            self.end_headers()
+            self.stream_annexb()
         else:
             self.send_error(404)
             self.end_headers()
 
+    # blocking playlist reload: waits until the requested part is available
+    def send_hls_playlist(self):
+        try:
+            msn, part = hls.parse_playlist_query(self.path)
+        except ValueError:
+            self.send_error(400)
+            self.end_headers()
+            return
+        segmenter.touch()
+        with segmenter.condition:
+            valid = hls.is_valid_msn(segmenter, msn)
+            timeout = segmenter.block_timeout()
+        if not valid:
+            self.send_error(400)
+            self.end_headers()
+            return
+
+        def respond():
+            with segmenter.condition:
+                data = hls.get_media_playlist(segmenter) if hls.is_playlist_ready(segmenter, None, None) else None
+            if data is None:
+                self.send_error(503)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Age', '0')
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+            self.send_header('Content-Length', len(data))
+            self.end_headers()
+            self.wfile.write(data)
+
+        self.wait_for(lambda: hls.is_playlist_ready(segmenter, msn, part), respond, timeout)
+
+    # the parts can be requested before they are ready (preload hint)
+    def send_hls_file(self):
+        file = hls.parse_file_path(self.path)
+        if file is None:
+            self.send_error(404)
+            self.end_headers()
+            return
+        segmenter.touch()
+        with segmenter.condition:
+            timeout = segmenter.block_timeout()
+
+        def respond():
+            with segmenter.condition:
+                data = hls.get_file(segmenter, file)
+            if data is None:
+                self.send_error(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            # the segments never change, the init changes only with the SPS/PPS
+            self.send_header('Cache-Control', 'max-age=10' if file[0] == 'init' else 'max-age=3600')
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Content-Length', len(data))
+            self.end_headers()
+            self.wfile.write(data)
+
+        self.wait_for(lambda: hls.is_file_ready(segmenter, file), respond, timeout)
+
+    def send_dash_mpd(self):
+        segmenter.touch()
+        with segmenter.condition:
+            timeout = segmenter.block_timeout()
+
+        def respond():
+            with segmenter.condition:
+                data = dash.get_mpd(segmenter, *get_stream_info()) if dash.is_mpd_ready(segmenter) else None
+            if data is None:
+                self.send_error(503)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Age', '0')
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.send_header('Content-Type', 'application/dash+xml')
+            self.send_header('Content-Length', len(data))
+            self.end_headers()
+            self.wfile.write(data)
+
+        self.wait_for(lambda: dash.is_mpd_ready(segmenter), respond, timeout)
+
+    # the segment which is being muxed is sent frame by frame with chunked transfer
+    def send_dash_file(self):
+        file = dash.parse_file_path(self.path)
+        segmenter.touch()
+        with segmenter.condition:
+            timeout = segmenter.block_timeout()
+            valid = file is not None and (file[0] == 'init' or dash.is_valid_msn(segmenter, file[1]))
+        if not valid:
+            self.send_error(404)
+            self.end_headers()
+            return
+
+        if file[0] == 'init':
+            def respond():
+                with segmenter.condition:
+                    data = segmenter.get_init(file[1])
+                if data is None:
+                    self.send_error(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Cache-Control', 'max-age=10')
+                self.send_header('Content-Type', 'video/mp4')
+                self.send_header('Content-Length', len(data))
+                self.end_headers()
+                self.wfile.write(data)
+
+            self.wait_for(lambda: segmenter.init is not None, respond, timeout)
+            return
+
+        msn = file[1]
+        sent = 0
+        def pull():
+            nonlocal sent
+            new = dash.get_new_chunks(segmenter, msn, sent)
+            if new is not None:
+                sent += len(new[0])
+            return new
+
+        def respond():
+            with segmenter.condition:
+                started = dash.is_segment_started(segmenter, msn)
+                segment = segmenter.get_segment(msn)
+                complete = segment is None or segment.complete
+            if not started:
+                self.send_error(404)
+                self.end_headers()
+                return
+            # without chunked transfer the end of the response is the end of the segment
+            self.chunked = self.request_version == 'HTTP/1.1'
+            if self.chunked:
+                self.protocol_version = 'HTTP/1.1'
+            self.send_response(200)
+            # the segment which is still being muxed isn't cached, a broken connection would leave a truncated copy
+            self.send_header('Cache-Control', 'max-age=3600' if complete else 'no-cache, no-store, must-revalidate')
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Connection', 'close')
+            if self.chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.send_chunks(pull, timeout)
+
+        self.wait_for(lambda: dash.is_segment_started(segmenter, msn), respond, timeout)
+
+    # adds a client to the sleeper and returns its reader, it starts with the cached GOP if there is one
+    def open_reader(self, keyframes_only = False):
+        # a woken up camera starts with a keyframe anyway
+        running = not camera.sleeping
+        # it clears the cached GOP if the camera was sleeping, the frames are stale
+        cameraSleeper.add_client()
+        reader = parser.reader(max_lag_frames=config.client_queue_frames(), max_lag_bytes=config.client_queue_bytes(),
+            keyframes_only=keyframes_only)
+        if running and not reader.from_gop:
+            camera.request_key_frame()
+        return reader
+
+    # keyframes_only: the skipped frames' time is added to the keyframes' durations, see MP4Writer.write_frame
+    def stream_mp4(self, fragment_frames, fragment_duration, keyframes_only):
+        writer = self.open_writer()
+        # it can fail (e.g. it sends the init segment), so it is created before the reader and the sleeper's client
+        try:
+            mp4_writer = MP4Writer(writer, config.width(), config.height(), config.rotation(), config.timescale(), parser.params,
+                fragment_frames, fragment_duration)
+        except Exception as e:
+            self.close_writer(writer)
+            self.log_message(f'Removed streaming client {self.client_address} {e}')
+            return
+
+        def write_frame(frame):
+            mp4_writer.write_frame(frame, fragmentProducer.get_fragment(frame))
+
+        self.send_stream(writer, self.open_reader(keyframes_only), write_frame, mp4_writer.close)
+
+    # the raw stream starts with a keyframe, the lagging clients skip to the next one (see FrameReader)
+    def stream_annexb(self):
+        writer = self.open_writer()
+        joined = False
+
+        def write_frame(frame):
+            nonlocal joined
+            if not joined and not frame.keyframe:
+                return
+            writer.writev(parser.get_annexb(frame, not joined), frame)
+            joined = True
+
+        self.send_stream(writer, self.open_reader(), write_frame)
+
+    def remove_client(self, reader, e):
+        cameraSleeper.remove_client()
+        self.log_message(f'Removed streaming client {self.client_address}, dropped frames: {reader.dropped} {e}')
+
+    def write_chunk(self, data):
+        if self.chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        elif data:
+            self.wfile.write(data)
+
+
+class StreamingHandler(StreamingHandlerMixin, server.BaseHTTPRequestHandler):
+    def open_writer(self):
+        return SocketWriter(self.connection, config.zerocopy())
+
+    def close_writer(self, writer):
+        writer.close()
+
+    # sends the frames with write_frame(frame) until the client disconnects, then on_close()
+    def send_stream(self, writer, reader, write_frame, on_close = None):
+        try:
+            while True:
+                # the reader holds the frame's buffer while we are sending it
+                write_frame(reader.read_frame())
+        except Exception as e:
+            self.remove_client(reader, e)
+        finally:
+            if on_close:
+                on_close()
+            self.close_writer(writer)
+            reader.close()
+
+    # ready() is called with the segmenter's condition held
+    def wait_for(self, ready, respond, timeout):
+        segmenter.wait_for(ready, timeout)
+        respond()
+
+    # sends the chunks returned by pull() until it returns done or the timeout,
+    # pull() is called with the segmenter's condition held and it returns None if there is nothing new
+    def send_chunks(self, pull, timeout):
+        while True:
+            new = None
+            def ready():
+                nonlocal new
+                new = pull()
+                return new is not None
+            if not segmenter.wait_for(ready, timeout):
+                break
+            chunks, done = new
+            for chunk in chunks:
+                self.write_chunk(chunk)
+            if done:
+                break
+        self.write_chunk(b'')
+
+
+class AsyncStreamingHandler(StreamingHandlerMixin, AsyncRequestHandler):
+    # the handler buffers the writes until the socket is writable
+    def open_writer(self):
+        return self
+
+    def close_writer(self, writer):
+        pass
+
+    # the event loop calls write_frame(frame) when the socket is writable, on_close() after the client disconnected
+    def send_stream(self, writer, reader, write_frame, on_close = None):
+        def close(e):
+            if on_close:
+                on_close()
+            self.remove_client(reader, e)
+
+        self.start_stream(reader, write_frame, close)
+
+    # ready() is called with the segmenter's condition held
+    def wait_for(self, ready, respond, timeout):
+        def locked_ready():
+            with segmenter.condition:
+                return ready()
+        self.respond_when(locked_ready, respond, timeout)
+
+    # sends the chunks returned by pull() until it returns done or the timeout,
+    # pull() is called with the segmenter's condition held and it returns None if there is nothing new
+    def send_chunks(self, pull, timeout):
+        new = None
+        def ready():
+            nonlocal new
+            with segmenter.condition:
+                new = pull()
+            return new is not None
+
+        def respond():
+            nonlocal new
+            if new is None:
+                # timeout
+                self.write_chunk(b'')
+                return
+            chunks, done = new
+            new = None
+            for chunk in chunks:
+                self.write_chunk(chunk)
+            if done:
+                self.write_chunk(b'')
+            else:
+                self.respond_when(ready, respond, timeout)
+
+        self.respond_when(ready, respond, timeout)
+
 
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
@@ -233,7 +506,10 @@ class Config(configparser.ConfigParser):
             'height': 480,
             'fps': 30,
         })
-        self.read_dict({'server': {'listen': '', 'port': 8000, 'priority': 0}})
+        self.read_dict({'server': {'listen': '', 'port': 8000, 'priority': 0, 'zerocopy': 'no', 'mode': 'threading', 'client_queue_frames': 30, 'client_queue_bytes': 2097152,
+            'hls_part_duration': 0.33, 'segment_duration': 1, 'segments': 6, 'rewrite_sps': 'no', 'rtsp_port': 0,
+            'multicast': '', 'multicast_ttl': 1, 'relay': '',
+            'push': '', 'push_method': 'POST'}})
 
         if len(self.read(configfile)) == 0:
             logging.warning(f'Couldn\'t read {configfile}, using default config')
@@ -261,6 +537,69 @@ class Config(configparser.ConfigParser):
     def rotation(self):
         return int(self[self.device].get('rotation', 0))
 
+    def server_mode(self):
+        return self.get('server', 'mode')
+
+    def zerocopy(self):
+        return self.getboolean('server', 'zerocopy')
+
+    def client_queue_frames(self):
+        return self.getint('server', 'client_queue_frames')
+
+    def client_queue_bytes(self):
+        return self.getint('server', 'client_queue_bytes')
+
+    def hls_part_duration(self):
+        return self.getfloat('server', 'hls_part_duration')
+
+    def segment_duration(self):
+        return self.getfloat('server', 'segment_duration')
+
+    def segments(self):
+        return self.getint('server', 'segments')
+
+    def rewrite_sps(self):
+        return self.getboolean('server', 'rewrite_sps')
+
+    # 0: disabled
+    def rtsp_port(self):
+        return self.getint('server', 'rtsp_port')
+
+    # (group, port) or None if disabled
+    def multicast(self):
+        multicast = self.get('server', 'multicast')
+        if not multicast:
+            return None
+        group, _, port = multicast.rpartition(':')
+        try:
+            if not ipaddress.IPv4Address(group).is_multicast or int(port) % 2:
+                raise ValueError()
+        except ValueError:
+            logging.error(f'Invalid multicast address: {multicast}, use an IPv4 multicast group and an even port, eg 239.255.0.1:5004')
+            sys.exit(3)
+        return group, int(port)
+
+    def multicast_ttl(self):
+        return self.getint('server', 'multicast_ttl')
+
+    # the URL of the upstream stream.mp4, empty: capture from the device
+    def relay(self):
+        return self.get('server', 'relay')
+
+    # the URL of the receiver, empty: disabled
+    def push(self):
+        return self.get('server', 'push')
+
+    def push_method(self):
+        method = self.get('server', 'push_method').upper()
+        if method not in ['POST', 'PUT']:
+            logging.error(f'Unknown push_method: {method}, use POST or PUT')
+            sys.exit(3)
+        return method
+
+    def auto_sleep(self):
+        return self.getboolean(self.device, 'auto_sleep', fallback=True)
+
     def sampleduration(self):
         return 500
 
@@ -273,7 +612,17 @@ class Config(configparser.ConfigParser):
     def h264_level(self):
         return self[self.device].get('h264_level', '4')
 
+    # H264 or HEVC: the format of the stream from the camera or from the encoder
+    def video_format(self):
+        params = self[self.device]
+        if params.get('encoder'):
+            return params.get('encoder_format', 'H264')
+        return 'HEVC' if params.get('capture_format') == 'HEVC' else 'H264'
+
     def codec(self):
+        if self.video_format() == 'HEVC':
+            # Main profile, level 4
+            return 'hvc1.1.6.L120.B0'
         profiles = {'High' : '6400', 'Main': '4d00', 'Baseline': '4200'}
         levels = {'4': '28', '4.1': '29', '4.2': '2a'}
         codec = 'avc1.' + profiles.get(self.h264_profile(), '6400') + levels.get(self.h264_level(), '28')
@@ -315,9 +664,31 @@ try:
 except Exception as e:
     logging.warning(f'os.setpriority(os.PRIO_PROCESS, 0, {priority}) failed: {e}')
 
-h264parser = H264Parser()
-camera = V4L2Camera(device, h264parser, config)
-cameraSleeper = CameraSleeper(camera)
+video_format = config.video_format()
+upstream = None
+if config.relay():
+    try:
+        upstream = Upstream(config.relay())
+    except Exception as e:
+        logging.error(f'Unable to read the upstream {config.relay()}: {e}')
+        sys.exit(3)
+    video_format = upstream.video_format()
+
+if video_format == 'HEVC':
+    parser = H265Parser(fps=config.fps())
+    if config.rewrite_sps():
+        logging.warning('rewrite_sps is supported only for H264, it is ignored')
+else:
+    parser = H264Parser(rewrite_sps=config.rewrite_sps(), fps=config.fps())
+if upstream:
+    camera = RelaySource(upstream, parser, config.auto_sleep())
+else:
+    camera = V4L2Camera(device, parser, config)
+cameraSleeper = CameraSleeper(camera, parser)
+fragmentProducer = FragmentProducer(parser, config.timescale())
+segmenter = CMAFSegmenter(parser, fragmentProducer, camera, cameraSleeper,
+    config.width(), config.height(), config.rotation(), config.timescale(),
+    config.hls_part_duration(), config.segment_duration(), config.segments())
 
 if list_controls:
     camera.print_ctrls()
@@ -325,14 +696,46 @@ if list_controls:
     sys.exit(0)
 
 camera.start()
+segmenter.start()
 
-print(f'Waiting for the first h264 frame...', end="", flush=True)
-h264parser.read_frame()
+print(f'Waiting for the first {video_format} frame...', end="", flush=True)
+reader = parser.reader(gop=False)
+reader.read_frame()
+reader.close()
 print(f' ok')
+codec, width, height, fps = get_stream_info()
+print(f'Stream: {codec} {width}x{height} {fps} fps')
+if not upstream and (width, height) != (config.width(), config.height()):
+    logging.warning(f'The camera sends {width}x{height} instead of the configured {config.width()}x{config.height()}')
 
 camera.sleep()
 
-server = StreamingServer((config.get('server', 'listen'), config.getint('server', 'port')), StreamingHandler)
+if config.rtsp_port():
+    rtsp_server = RTSPServer((config.get('server', 'listen'), config.rtsp_port()), parser, camera, cameraSleeper,
+        config.client_queue_frames(), config.client_queue_bytes())
+    print(f'Fmp4streamer RTSP server is listening on {rtsp_server.server_address}')
+    rtsp_server.start()
+
+multicast_sender = None
+if config.multicast():
+    multicast_sender = MulticastSender(config.multicast(), config.multicast_ttl(), parser, camera, cameraSleeper,
+        config.client_queue_frames(), config.client_queue_bytes())
+    print(f'Fmp4streamer is sending the stream to the multicast group {config.multicast()}')
+    multicast_sender.play()
+
+if config.push():
+    push_client = PushClient(config.push(), config.push_method(), parser, fragmentProducer, camera, cameraSleeper,
+        config.width(), config.height(), config.rotation(), config.timescale(),
+        config.client_queue_frames(), config.client_queue_bytes())
+    print(f'Fmp4streamer is pushing the stream to {config.push()}')
+    push_client.start()
+
+server_address = (config.get('server', 'listen'), config.getint('server', 'port'))
+if config.server_mode() == 'asyncio':
+    server = AsyncStreamingServer(server_address, AsyncStreamingHandler, parser)
+    segmenter.add_listener(server.wakeup)
+else:
+    server = StreamingServer(server_address, StreamingHandler)
 print(f'Fmp4streamer will now start listening on {server.server_address}')
 server.start()
 camera.stop()
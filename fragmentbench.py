@@ -0,0 +1,58 @@
+import io, sys
+from timeit import repeat
+
+import bmff
+
+# Micro-benchmark of the per-frame fragment building: the previous struct format + BytesIO
+# version against the FragmentBuilder with length prefixes and with in place converted AVCC frames.
+# Usage: python3 fragmentbench.py [bitrate in Mbit/s]
+
+SPS = b'\x27\x64\x00\x2a\xac\x2b\x40\x28\x02\xdd\x00\xf1\x22\x6a'
+PPS = b'\x28\xee\x02\x5c\xb0\x00'
+
+def build_legacy(params, nalus, is_idr):
+    mdatsize = bmff.get_mdat_size(params) + bmff.get_mdat_size(nalus) - 8
+    buf = io.BytesIO()
+    bmff.write_moof(buf, 0, mdatsize, is_idr, 0, 0)
+    bmff.write_mdat_header(buf, mdatsize)
+    for nalu in params:
+        buf.write(len(nalu).to_bytes(4, 'big'))
+        buf.write(nalu)
+    prefixes = [len(nalu).to_bytes(4, 'big') for nalu in nalus]
+    return memoryview(buf.getvalue()), prefixes
+
+# one second of frames: an IDR with SPS, PPS and P frames, the encoder sends 4 slices per frame
+def get_gop(fps, bitrate):
+    framesize = bitrate // 8 // fps
+    slices = 4
+    idr = ([SPS, PPS], [b'\x65' * (4 * framesize // slices)] * slices, True)
+    p = ([], [b'\x41' * (framesize // slices)] * slices, False)
+    return [idr] + [p] * (fps - 1)
+
+def build_avcc(builder):
+    def build(params, nalus, is_idr):
+        # the parser has the size of the converted frame already
+        return builder.build_header(params, 4 * len(nalus) + len(nalus[0]) * len(nalus), is_idr)
+    return build
+
+def bench(build, gop):
+    def run():
+        for params, nalus, is_idr in gop:
+            build(params, nalus, is_idr)
+    # per frame in microseconds
+    return min(repeat(run, number=20, repeat=25)) / 20 / len(gop) * 1000000
+
+def main():
+    bitrate = int(float(sys.argv[1]) * 1000000) if len(sys.argv) > 1 else 4000000
+    builder = bmff.FragmentBuilder()
+    print(f'bitrate: {bitrate / 1000000} Mbit/s')
+    print('us/frame and the share of one core spent on building the fragments')
+    print(f'{"fps":>4} {"legacy":>8} {"builder":>8} {"avcc":>8} {"legacy %":>9} {"builder %":>10} {"avcc %":>8}')
+    for fps in (30, 60, 90):
+        gop = get_gop(fps, bitrate)
+        times = [bench(build, gop) for build in (build_legacy, builder.build, build_avcc(builder))]
+        print(f'{fps:>4} ' + ' '.join(f'{t:>8.2f}' for t in times) +
+            f' {times[0] * fps / 10000:>9.3f} {times[1] * fps / 10000:>10.3f} {times[2] * fps / 10000:>8.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
-import logging, struct, time
+import logging, struct
+from collections import deque
 from threading import Condition
 
 class H264NALU:
@@ -6,27 +7,547 @@ class H264NALU:
 
     NONIDRTYPE = 1
     IDRTYPE = 5
+    SEITYPE = 6
     SPSTYPE = 7
     PPSTYPE = 8
+    AUDTYPE = 9
 
     @staticmethod
     def get_type(nalubytes):
         return nalubytes[0] & 0x1f
 
+    # the frame types by the first NALU, they are the same for the H265NALU (see h265.py)
+    @staticmethod
+    def is_idr(nalutype):
+        return nalutype == H264NALU.IDRTYPE
+
+    # the keyframe starts with the parameter sets
+    @staticmethod
+    def is_params(nalutype):
+        return nalutype == H264NALU.SPSTYPE
+
+    @staticmethod
+    def is_non_idr(nalutype):
+        return nalutype == H264NALU.NONIDRTYPE
+
+    # the access unit delimiter and the SEI are before the parameter sets and the slices, they don't tell the frame type
+    @staticmethod
+    def is_prefix(nalutype):
+        return nalutype in (H264NALU.AUDTYPE, H264NALU.SEITYPE)
+
+# Reads the bits of a NALU payload, it removes the emulation prevention bytes (00 00 03)
+class BitReader:
+    def __init__(self, data):
+        self.data = bytes(data).replace(b'\x00\x00\x03', b'\x00\x00')
+        self.pos = 0
+
+    def read_bits(self, n):
+        value = 0
+        for _ in range(n):
+            byte = self.pos >> 3
+            if byte >= len(self.data):
+                raise ValueError('BitReader: out of data')
+            value = (value << 1) | ((self.data[byte] >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def read_flag(self):
+        return self.read_bits(1) == 1
+
+    # unsigned exp-Golomb
+    def read_ue(self):
+        zeros = 0
+        while self.read_bits(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise ValueError('BitReader: invalid exp-Golomb code')
+        return (1 << zeros) - 1 + self.read_bits(zeros)
+
+    # signed exp-Golomb
+    def read_se(self):
+        value = self.read_ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+# Writes the bits of a NALU payload, see get_rbsp
+class BitWriter:
+    def __init__(self):
+        self.value = 0
+        self.bits = 0
+
+    def write_bits(self, value, n):
+        self.value = (self.value << n) | value
+        self.bits += n
+
+    # copies the first n bits of data
+    def copy_bits(self, data, n):
+        self.write_bits(int.from_bytes(data, 'big') >> (len(data) * 8 - n), n)
+
+    def write_ue(self, value):
+        value += 1
+        self.write_bits(0, value.bit_length() - 1)
+        self.write_bits(value, value.bit_length())
+
+    # with the rbsp_trailing_bits and the emulation prevention bytes
+    def get_rbsp(self):
+        self.write_bits(1, 1)
+        self.write_bits(0, -self.bits % 8)
+        data = self.value.to_bytes(self.bits // 8, 'big')
+        out = bytearray()
+        zeros = 0
+        for byte in data:
+            if zeros >= 2 and byte <= 3:
+                out.append(3)
+                zeros = 0
+            out.append(byte)
+            zeros = zeros + 1 if byte == 0 else 0
+        return bytes(out)
+
+
+# The fields of the Sequence Parameter Set which describe the stream
+# References:
+# ITU-T H.264 7.3.2.1.1 Sequence parameter set data syntax
+# ITU-T H.264 E.1.1 VUI parameters syntax
+class SPS:
+    # these profiles have chroma format, bit depth and scaling matrices in the SPS
+    HIGHPROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+    def __init__(self, nalu):
+        r = BitReader(nalu)
+        # NAL unit header
+        r.read_bits(8)
+        self.profile_idc = r.read_bits(8)
+        self.constraint_flags = r.read_bits(8)
+        self.level_idc = r.read_bits(8)
+        r.read_ue() # seq_parameter_set_id
+
+        chroma_format_idc = 1
+        self.separate_colour_plane = False
+        if self.profile_idc in SPS.HIGHPROFILES:
+            chroma_format_idc = r.read_ue()
+            if chroma_format_idc == 3:
+                self.separate_colour_plane = r.read_flag()
+            r.read_ue() # bit_depth_luma_minus8
+            r.read_ue() # bit_depth_chroma_minus8
+            r.read_flag() # qpprime_y_zero_transform_bypass_flag
+            if r.read_flag(): # seq_scaling_matrix_present_flag
+                for i in range(8 if chroma_format_idc != 3 else 12):
+                    if r.read_flag(): # seq_scaling_list_present_flag
+                        self.skip_scaling_list(r, 16 if i < 6 else 64)
+
+        self.log2_max_frame_num = r.read_ue() + 4
+        self.pic_order_cnt_type = r.read_ue()
+        if self.pic_order_cnt_type == 0:
+            self.log2_max_pic_order_cnt_lsb = r.read_ue() + 4
+        elif self.pic_order_cnt_type == 1:
+            r.read_flag() # delta_pic_order_always_zero_flag
+            r.read_se() # offset_for_non_ref_pic
+            r.read_se() # offset_for_top_to_bottom_field
+            for _ in range(r.read_ue()): # num_ref_frames_in_pic_order_cnt_cycle
+                r.read_se()
+        self.max_num_ref_frames = r.read_ue()
+        r.read_flag() # gaps_in_frame_num_value_allowed_flag
+
+        width_in_mbs = r.read_ue() + 1
+        height_in_map_units = r.read_ue() + 1
+        frame_mbs_only = r.read_flag()
+        self.frame_mbs_only = frame_mbs_only
+        if not frame_mbs_only:
+            r.read_flag() # mb_adaptive_frame_field_flag
+        r.read_flag() # direct_8x8_inference_flag
+
+        crop_left = crop_right = crop_top = crop_bottom = 0
+        if r.read_flag(): # frame_cropping_flag
+            crop_left = r.read_ue()
+            crop_right = r.read_ue()
+            crop_top = r.read_ue()
+            crop_bottom = r.read_ue()
+        # 6.2 and 7.4.2.1.1: the crop units depend on the chroma subsampling
+        if chroma_format_idc == 0:
+            crop_unit_x = 1
+            crop_unit_y = 2 - frame_mbs_only
+        else:
+            crop_unit_x = 1 if chroma_format_idc == 3 else 2
+            crop_unit_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+        self.width = width_in_mbs * 16 - crop_unit_x * (crop_left + crop_right)
+        self.height = (2 - frame_mbs_only) * height_in_map_units * 16 - crop_unit_y * (crop_top + crop_bottom)
+        if self.width <= 0 or self.height <= 0:
+            raise ValueError(f'SPS: invalid frame size {self.width}x{self.height}')
+
+        # frames per second, None if the stream doesn't tell
+        self.fps = None
+        # VUI bitstream restriction, None if not present
+        self.bitstream_restriction_pos = None
+        self.bitstream_restriction = None
+        self.max_num_reorder_frames = None
+        self.max_dec_frame_buffering = None
+        self.vui_parameters_pos = r.pos
+        self.vui_parameters_present = r.read_flag()
+        if self.vui_parameters_present:
+            self.read_vui(r)
+
+    @staticmethod
+    def skip_scaling_list(r, size):
+        last_scale = next_scale = 8
+        for _ in range(size):
+            if next_scale != 0:
+                next_scale = (last_scale + r.read_se() + 256) % 256
+            last_scale = next_scale if next_scale != 0 else last_scale
+
+    def read_vui(self, r):
+        if r.read_flag(): # aspect_ratio_info_present_flag
+            if r.read_bits(8) == 255: # aspect_ratio_idc == Extended_SAR
+                r.read_bits(32) # sar_width, sar_height
+        if r.read_flag(): # overscan_info_present_flag
+            r.read_flag() # overscan_appropriate_flag
+        if r.read_flag(): # video_signal_type_present_flag
+            r.read_bits(4) # video_format, video_full_range_flag
+            if r.read_flag(): # colour_description_present_flag
+                r.read_bits(24) # colour_primaries, transfer_characteristics, matrix_coefficients
+        if r.read_flag(): # chroma_loc_info_present_flag
+            r.read_ue()
+            r.read_ue()
+        if r.read_flag(): # timing_info_present_flag
+            num_units_in_tick = r.read_bits(32)
+            time_scale = r.read_bits(32)
+            r.read_flag() # fixed_frame_rate_flag
+            # a frame is two ticks (fields)
+            if num_units_in_tick:
+                self.fps = time_scale / (2 * num_units_in_tick)
+        nal_hrd = r.read_flag() # nal_hrd_parameters_present_flag
+        if nal_hrd:
+            self.skip_hrd_parameters(r)
+        vcl_hrd = r.read_flag() # vcl_hrd_parameters_present_flag
+        if vcl_hrd:
+            self.skip_hrd_parameters(r)
+        if nal_hrd or vcl_hrd:
+            r.read_flag() # low_delay_hrd_flag
+        r.read_flag() # pic_struct_present_flag
+
+        self.bitstream_restriction_pos = r.pos
+        if r.read_flag(): # bitstream_restriction_flag
+            self.bitstream_restriction = (
+                r.read_flag(), # motion_vectors_over_pic_boundaries_flag
+                r.read_ue(), # max_bytes_per_pic_denom
+                r.read_ue(), # max_bits_per_mb_denom
+                r.read_ue(), # log2_max_mv_length_horizontal
+                r.read_ue(), # log2_max_mv_length_vertical
+            )
+            self.max_num_reorder_frames = r.read_ue()
+            self.max_dec_frame_buffering = r.read_ue()
+
+    @staticmethod
+    def skip_hrd_parameters(r):
+        cpb_cnt = r.read_ue() + 1
+        r.read_bits(8) # bit_rate_scale, cpb_size_scale
+        for _ in range(cpb_cnt):
+            r.read_ue() # bit_rate_value_minus1
+            r.read_ue() # cpb_size_value_minus1
+            r.read_flag() # cbr_flag
+        # initial_cpb_removal_delay_length_minus1, cpb_removal_delay_length_minus1,
+        # dpb_output_delay_length_minus1, time_offset_length
+        r.read_bits(20)
+
+    # returns the SPS with max_num_reorder_frames = 0 in the VUI, so the decoder outputs every frame
+    # immediately instead of filling its reorder buffer first, or None if it's already so.
+    # The stream should not have B-frames
+    def set_zero_reorder(self, nalu):
+        if self.max_num_reorder_frames == 0:
+            return None
+        data = BitReader(nalu).data
+        w = BitWriter()
+        if self.vui_parameters_present:
+            # copy everything before the bitstream_restriction_flag
+            w.copy_bits(data, self.bitstream_restriction_pos)
+        else:
+            w.copy_bits(data, self.vui_parameters_pos)
+            w.write_bits(1, 1) # vui_parameters_present_flag
+            # aspect_ratio, overscan, video_signal_type, chroma_loc, timing, nal_hrd, vcl_hrd, pic_struct are not present
+            w.write_bits(0, 8)
+
+        # bitstream_restriction_flag, the defaults of E.2.1 if they weren't present
+        w.write_bits(1, 1)
+        mv_over_boundaries, max_bytes_per_pic_denom, max_bits_per_mb_denom, log2_mv_h, log2_mv_v = \
+            self.bitstream_restriction or (True, 2, 1, 15, 15)
+        w.write_bits(int(mv_over_boundaries), 1)
+        w.write_ue(max_bytes_per_pic_denom)
+        w.write_ue(max_bits_per_mb_denom)
+        w.write_ue(log2_mv_h)
+        w.write_ue(log2_mv_v)
+        w.write_ue(0) # max_num_reorder_frames
+        # it can't be less than the number of reference frames
+        w.write_ue(self.max_dec_frame_buffering if self.max_dec_frame_buffering is not None else max(1, self.max_num_ref_frames))
+        return w.get_rbsp()
+
+    # RFC 6381 codecs parameter
+    def codec(self):
+        return f'avc1.{self.profile_idc:02x}{self.constraint_flags:02x}{self.level_idc:02x}'
+
+
+# Finds the display order of the frames from the picture order count (POC) of their slice headers.
+# Only pic_order_cnt_type 0 can reorder the frames (type 2 can't, type 1 is not supported).
+# References:
+# ITU-T H.264 7.3.3 Slice header syntax
+# ITU-T H.264 8.2.1.1 Decoding process for picture order count type 0
+class FrameOrder:
+    def __init__(self):
+        # the GOP has B-frames, they get decode times on a frame rate grid (see H264Parser.set_decode_time)
+        self.reordered = False
+        # we have seen a B-frame or a frame displayed before an earlier decoded one in this GOP
+        self.gop_reordered = False
+        # decode order of the frame since the last IDR frame
+        self.index = 0
+        self.prev_poc_msb = 0
+        self.prev_poc_lsb = 0
+        self.prev_poc = 0
+        self.idr_poc = 0
+        # POC difference of the consecutive frames, the encoders use 2 usually
+        self.poc_step = 2
+
+    # returns how many frames later the frame is displayed than decoded (negative if earlier),
+    # nalu is the first slice of the frame
+    def get_offset(self, sps, nalu, idr):
+        # the slice header until the pic_order_cnt_lsb fits into this
+        r = BitReader(nalu[1:32])
+        r.read_ue() # first_mb_in_slice
+        b_slice = r.read_ue() % 5 == 1 # slice_type
+        r.read_ue() # pic_parameter_set_id
+        if sps.separate_colour_plane:
+            r.read_bits(2) # colour_plane_id
+        r.read_bits(sps.log2_max_frame_num) # frame_num
+        if not sps.frame_mbs_only and r.read_flag(): # field_pic_flag
+            r.read_flag() # bottom_field_flag
+        if idr:
+            r.read_ue() # idr_pic_id
+        lsb = r.read_bits(sps.log2_max_pic_order_cnt_lsb)
+
+        if idr:
+            self.index = 0
+            self.prev_poc_msb = 0
+            self.prev_poc_lsb = 0
+            # the previous GOP decides, a stream can stop sending B-frames
+            self.reordered = self.gop_reordered
+            self.gop_reordered = False
+        max_lsb = 1 << sps.log2_max_pic_order_cnt_lsb
+        if lsb < self.prev_poc_lsb and self.prev_poc_lsb - lsb >= max_lsb // 2:
+            msb = self.prev_poc_msb + max_lsb
+        elif lsb > self.prev_poc_lsb and lsb - self.prev_poc_lsb > max_lsb // 2:
+            msb = self.prev_poc_msb - max_lsb
+        else:
+            msb = self.prev_poc_msb
+        poc = msb + lsb
+        # nal_ref_idc: only the reference frames are the base of the next POC
+        if nalu[0] & 0x60:
+            self.prev_poc_msb = msb
+            self.prev_poc_lsb = lsb
+
+        if idr:
+            self.idr_poc = poc
+        elif 0 < abs(poc - self.prev_poc) < self.poc_step:
+            self.poc_step = abs(poc - self.prev_poc)
+        self.prev_poc = poc
+
+        offset = (poc - self.idr_poc) // self.poc_step - self.index
+        self.index += 1
+        # a positive offset alone is not reordering, the lost frames leave gaps in the POC
+        if offset < 0 or b_slice:
+            self.reordered = True
+            self.gop_reordered = True
+        return offset
+
+
+# A published frame, it holds a reference on its V4L2 buffer while the nalus point into it
+class Frame:
+    __slots__ = ('seq', 'nalus', 'nalutype', 'avcc', 'keyframe', 'droppable', 'size', 'offset', 'timestamp', 'dts', 'cto', 'lease', 'fragment', 'params')
+
+    def __init__(self, nalus, nalutype, keyframe, droppable, timestamp, lease, avcc = None):
+        self.seq = 0
+        self.nalus = nalus
+        # the type of the first NALU after the AUD and SEI, see H264NALU.is_idr, is_params, is_non_idr
+        self.nalutype = nalutype
+        # the nalus with 4 byte length prefixes in one buffer (the mdat payload) if the parser converted them in place
+        self.avcc = avcc
+        self.keyframe = keyframe
+        # not a reference frame, the next frames can be decoded without it
+        self.droppable = droppable
+        self.size = sum(len(nalu) for nalu in nalus)
+        # bytes published before this frame
+        self.offset = 0
+        # in microseconds
+        self.timestamp = timestamp
+        # decode time and composition time offset (presentation - decode, it can be negative) in microseconds,
+        # they differ from the timestamp only if the stream has B-frames (see FrameOrder)
+        self.dts = timestamp
+        self.cto = 0
+        self.lease = lease
+        self.fragment = None
+        # the (SPS, PPS) or (VPS, SPS, PPS) of the frame, it's the same object until the parser sees a different one
+        self.params = None
+
+    def acquire(self):
+        if self.lease:
+            self.lease.acquire()
+        return self.lease
+
+    # drop our reference on the V4L2 buffer, the readers holding the frame keep their own
+    def drop(self):
+        lease = self.lease
+        self.lease = None
+        lease.release()
+
+    # copy the nalus out of the V4L2 buffer
+    def copy(self):
+        if self.avcc is None:
+            self.nalus = [bytes(nalu) for nalu in self.nalus]
+            return
+        avcc = memoryview(bytes(self.avcc))
+        nalus = []
+        start = 4
+        for nalu in self.nalus:
+            nalus.append(avcc[start : start + len(nalu)])
+            start += len(nalu) + 4
+        self.nalus = nalus
+        self.avcc = avcc
+
+    def detach(self):
+        self.copy()
+        self.drop()
+
+    # nobody will read this frame anymore
+    def expire(self):
+        self.nalus = None
+        self.avcc = None
+        self.drop()
+
+
+# Reads every frame from the parser's ring with its own cursor.
+# If it lags behind more than the ring size, it resyncs at the next keyframe.
+# The frames between the cursor and the newest one are the reader's queue,
+# if it's longer than max_lag_frames or max_lag_bytes, the reader drops the
+# non-reference frames first, then the rest of the GOP until the next keyframe
+# keyframes_only: it skips every other frame (they don't count as dropped)
+class FrameReader:
+    def __init__(self, parser, gop, max_lag_frames = None, max_lag_bytes = None, keyframes_only = False):
+        self.parser = parser
+        # start with the cached GOP for an instant picture
+        self.seq = parser.gop[0].seq if gop and parser.gop else parser.seq
+        self.from_gop = self.seq < parser.seq
+        # the cached GOP is sent as a burst, it doesn't count as lag
+        self.burst_end = parser.seq
+        self.max_lag_frames = max_lag_frames
+        self.max_lag_bytes = max_lag_bytes
+        self.keyframes_only = keyframes_only
+        self.lease = None
+        self.resync = True
+        self.dropped = 0
+
+    # returns the next frame or None on timeout,
+    # the frame remains valid until the next read_frame or release call
+    def read_frame(self, timeout=None):
+        self.release()
+        parser = self.parser
+        with parser.condition:
+            while True:
+                if self.seq >= parser.seq:
+                    if not parser.condition.wait(timeout):
+                        return None
+                    continue
+
+                oldest = parser.oldest_seq()
+                if self.seq < oldest:
+                    self.dropped += oldest - self.seq
+                    self.seq = oldest
+                    self.resync = True
+
+                frame = parser.get_frame(self.seq)
+                self.seq += 1
+                if self.keyframes_only and not frame.keyframe:
+                    continue
+                if frame.nalus is None or (self.resync and not frame.keyframe):
+                    self.dropped += 1
+                    self.resync = True
+                    continue
+
+                if frame.seq >= self.burst_end and not frame.keyframe:
+                    lag = self.lag(frame)
+                    if lag >= 1:
+                        # the queue is full, skip to the next keyframe
+                        self.dropped += 1
+                        self.resync = True
+                        continue
+                    if lag >= 0.5 and frame.droppable:
+                        self.dropped += 1
+                        continue
+
+                self.resync = False
+                self.lease = frame.acquire()
+                return frame
+
+    # the queue length relative to its limit, the condition should be held by the caller
+    def lag(self, frame):
+        parser = self.parser
+        lag = 0
+        if self.max_lag_frames:
+            lag = (parser.seq - frame.seq) / self.max_lag_frames
+        if self.max_lag_bytes:
+            lag = max(lag, (parser.size - frame.offset) / self.max_lag_bytes)
+        return lag
+
+    def release(self):
+        if self.lease:
+            self.lease.release()
+            self.lease = None
+
+    def close(self):
+        self.release()
+        with self.parser.condition:
+            self.parser.readers.discard(self)
+
+
 JPEG_SOI = b'\xff\xd8' # JPEG Start Of Image
 JPEG_APP4 = b'\xff\xe4' # JPEG APP4 marker to store metadata (H264 frame)
+NALULENGTH = struct.Struct('>I')
 
+# rewrite_sps: set max_num_reorder_frames = 0 in the SPS (see SPS.set_zero_reorder) until we see a B-frame
+# fps: the frame rate of the decode times of B-frame streams if the SPS doesn't tell
 class H264Parser(object):
-    def __init__(self):
+    NALU = H264NALU
+
+    def __init__(self, ring_size = 64, gop_cache_size = 300, rewrite_sps = False, fps = 30):
         self.sps = None
         self.pps = None
+        self.params = (None, None)
+        # the parsed SPS, None until the first valid one
+        self.sps_info = None
+        # the SPS from the camera, self.sps is a rewritten copy of it if rewrite_sps is on
+        self.sps_source = None
+        self.rewrite_sps = rewrite_sps
+        self.fps = fps
+        self.frame_order = FrameOrder()
+        # timestamp of the last keyframe and decode time of the last frame in microseconds
+        self.gop_timestamp = 0
+        self.prev_dts = 0
         self.condition = Condition()
-        self.nalus = []
-        self.frame_secs = 0
-        self.frame_usecs = 0
+        self.ring_size = ring_size
+        self.ring = [None] * ring_size
+        # sequence number of the next frame
+        self.seq = 0
+        # the frames before this are stale, see clear
+        self.start_seq = 0
+        # bytes published so far
+        self.size = 0
+        # frames which hold a reference on their V4L2 buffer, oldest first
+        self.leased = deque()
+        self.readers = set()
+        # frames since the last keyframe, they are kept even if they drop out of the ring
+        self.gop_cache_size = gop_cache_size
+        self.gop = []
+        # called from the capture thread after every new frame
+        self.listeners = []
 
     def write_buf(self, buf):
         nalus = []
+        avcc = None
 
         # find H264 inside MJPG
         if buf.buffer.find(JPEG_SOI, 0, 2) == 0:
@@ -56,37 +577,227 @@ class H264Parser(object):
         else:
             start = 4
             end = buf.bytesused
+            data = memoryview(buf.buffer)
+            # the start codes and the AVCC length prefixes are both 4 bytes, so a writable (MMAP) buffer
+            # is converted to AVCC in place and the frame is sent as one buffer (we are its only consumer)
+            inplace = not data.readonly and buf.buffer.find(H264NALU.DELIMITER, 0, 4) == 0
             while start < end:
                 next = buf.buffer.find(H264NALU.DELIMITER, start, end)
                 if next == -1:
                     next = end
-                nalus.append(memoryview(buf.buffer)[start : next])
+                nalus.append(data[start : next])
+                if inplace:
+                    NALULENGTH.pack_into(buf.buffer, start - 4, next - start)
                 start = next + 4
-
-        if not self.sps or not self.pps:
-            for nalu in nalus:
-                if len(nalu) and H264NALU.get_type(nalu) == H264NALU.SPSTYPE:
-                    self.sps = bytes(nalu)
-                if len(nalu) and H264NALU.get_type(nalu) == H264NALU.PPSTYPE:
-                    self.pps = bytes(nalu)
-            if not self.sps or not self.pps:
-                logging.error('H264Parser: Invalid H264 first frame. Unable to read SPS and PPS.')
+            if inplace:
+                avcc = data[:end]
 
         if len(nalus) == 0:
             logging.warning('H264Parser: 0 NALU found')
             return
 
+        NALU = self.NALU
+        nalutype = NALU.get_type(nalus[0])
+        for nalu in nalus:
+            if len(nalu) and not NALU.is_prefix(NALU.get_type(nalu)):
+                nalutype = NALU.get_type(nalu)
+                break
+        # the SPS, PPS are repeated before the IDR frames, they can change, e.g. after a reconfiguration of the camera
+        if NALU.is_params(nalutype) or not all(self.params):
+            self.update_params(nalus)
+            if self.sps is not self.sps_source:
+                # send the rewritten SPS in-band too, it doesn't fit into the place of the original one
+                nalus = [self.sps if len(nalu) and H264NALU.get_type(nalu) == H264NALU.SPSTYPE else nalu for nalu in nalus]
+                avcc = None
+        elif self.rewrite_sps and self.is_b_slice(self.first_slice(nalus)):
+            logging.warning('H264Parser: the stream has B-frames, the SPS is not rewritten anymore')
+            self.rewrite_sps = False
+            # the original SPS will be used from the next keyframe
+            self.sps_source = None
+
+        keyframe = NALU.is_idr(nalutype) or NALU.is_params(nalutype)
+        droppable = NALU.is_non_idr(nalutype) and self.is_droppable(nalus)
+        timestamp = buf.timestamp.secs * 1000000 + buf.timestamp.usecs
+        frame = Frame(nalus, nalutype, keyframe, droppable, timestamp, getattr(buf, 'lease', None), avcc)
+        self.set_decode_time(frame)
+        self.publish(frame)
+
+    # The timestamps of the frames are in decode order (UVC) or they are the presentation times (M2M encoders),
+    # so B-frame streams get decode times on a constant frame rate grid from the last keyframe
+    # and their presentation time offset comes from the POC, the other streams keep the timestamps
+    def set_decode_time(self, frame):
+        if frame.keyframe:
+            self.gop_timestamp = frame.timestamp
+        info = self.sps_info
+        # baseline profile doesn't have B-frames
+        if info is not None and info.pic_order_cnt_type == 0 and info.profile_idc != 66:
+            order = self.frame_order
+            slice = self.first_slice(frame.nalus)
+            try:
+                offset = order.get_offset(info, slice, frame.keyframe) if slice else 0
+            except ValueError as e:
+                logging.warning(f'H264Parser: unable to parse the slice header: {e}')
+                offset = 0
+            if order.reordered:
+                frame_duration = 1000000 / (info.fps or self.fps)
+                frame.dts = self.gop_timestamp + round((order.index - 1) * frame_duration)
+                frame.cto = round(offset * frame_duration)
+                # the decode times should be increasing, but the presentation time stays
+                if frame.dts <= self.prev_dts:
+                    frame.cto -= self.prev_dts + 1 - frame.dts
+                    frame.dts = self.prev_dts + 1
+        self.prev_dts = frame.dts
+
+    # nal_ref_idc is 0 in every slice
+    @staticmethod
+    def is_droppable(nalus):
+        return all(nalu[0] & 0x60 == 0
+            for nalu in nalus if len(nalu) and H264NALU.get_type(nalu) == H264NALU.NONIDRTYPE)
+
+    def update_params(self, nalus):
+        sps_source, pps = self.sps_source, self.pps
+        for nalu in nalus:
+            if len(nalu) and H264NALU.get_type(nalu) == H264NALU.SPSTYPE and nalu != sps_source:
+                sps_source = bytes(nalu)
+            if len(nalu) and H264NALU.get_type(nalu) == H264NALU.PPSTYPE and nalu != pps:
+                pps = bytes(nalu)
+        if not sps_source or not pps:
+            logging.error('H264Parser: Invalid H264 first frame. Unable to read SPS and PPS.')
+        if sps_source is self.sps_source and pps is self.pps:
+            return
+
+        sps = self.sps
+        if sps_source is not self.sps_source:
+            self.sps_source = sps = sps_source
+            if sps:
+                try:
+                    self.sps_info = SPS(sps)
+                    if self.rewrite_sps:
+                        sps = self.sps_info.set_zero_reorder(sps) or sps
+                except ValueError as e:
+                    logging.warning(f'H264Parser: unable to parse the SPS: {e}')
+        if self.sps and self.pps:
+            logging.info('H264Parser: SPS, PPS changed')
+        self.sps = sps
+        self.pps = pps
+        self.params = (sps, pps)
+
+    # the frame can start with an AUD or SEI, returns None if there is no slice
+    @staticmethod
+    def first_slice(nalus):
+        return next((nalu for nalu in nalus if len(nalu) and
+            H264NALU.get_type(nalu) in (H264NALU.IDRTYPE, H264NALU.NONIDRTYPE)), None)
+
+    # slice_type of the slice header is 1 or 6 (B)
+    @staticmethod
+    def is_b_slice(nalu):
+        if nalu is None or H264NALU.get_type(nalu) != H264NALU.NONIDRTYPE:
+            return False
+        try:
+            r = BitReader(nalu[1:16])
+            r.read_ue() # first_mb_in_slice
+            return r.read_ue() % 5 == 1
+        except ValueError:
+            return False
+
+    def publish(self, frame):
+        frame.params = self.params
         with self.condition:
-            self.nalus = nalus
-            self.frame_secs = buf.timestamp.secs
-            self.frame_usecs = buf.timestamp.usecs
+            lease = frame.lease
+            if lease:
+                self.release_leases(lease.pool)
+                if lease.pool.starving():
+                    # the readers hold too many buffers, copy the frame and let the buffer go back to the driver
+                    frame.copy()
+                    frame.lease = None
+                else:
+                    lease.acquire()
+                    self.leased.append(frame)
+
+            frame.seq = self.seq
+            frame.offset = self.size
+            self.size += frame.size
+
+            if frame.keyframe:
+                self.gop = [frame]
+            elif self.gop:
+                if len(self.gop) < self.gop_cache_size:
+                    self.gop.append(frame)
+                else:
+                    # too long GOP to cache, the new readers will wait for the next keyframe
+                    self.gop = []
+
+            self.ring[frame.seq % self.ring_size] = frame
+            self.seq += 1
+            # the frames out of the ring keep their buffers while they are in the GOP,
+            # release_leases copies them only if the pool is starving
+            needed = min(self.seq - self.ring_size, self.gop[0].seq if self.gop else self.seq)
+            while self.leased and self.leased[0].seq < needed:
+                self.leased.popleft().drop()
+
             self.condition.notify_all()
 
-        # chance for other threads to get the GIL even if the there aren't following blocking reads
-        # don't have a better solution yet
-        time.sleep(0.001)
+        for listener in self.listeners:
+            listener()
 
-    def read_frame(self):
+    # give back the oldest buffers to the driver, copy the frames which are still needed by a reader
+    def release_leases(self, pool):
+        # readers hold the frame before their cursor
+        needed = min((reader.seq - 1 for reader in self.readers), default=self.seq)
+        if self.gop:
+            needed = min(needed, self.gop[0].seq)
+        while self.leased and pool.starving():
+            frame = self.leased.popleft()
+            if frame.seq >= needed:
+                frame.detach()
+            else:
+                frame.expire()
+
+    # forget the cached frames when the camera stops, they would be sent to the next readers as
+    # the start of the stream, the buffers which are not read go back to the driver
+    def clear(self):
         with self.condition:
-            self.condition.wait()
-            return self.nalus, self.frame_secs, self.frame_usecs
+            self.gop = []
+            self.start_seq = self.seq
+            # readers hold the frame before their cursor
+            needed = min((reader.seq - 1 for reader in self.readers), default=self.seq)
+            while self.leased and self.leased[0].seq < needed:
+                self.leased.popleft().expire()
+
+    # the condition should be held by the caller
+    def oldest_seq(self):
+        oldest = max(self.seq - self.ring_size, self.start_seq)
+        if self.gop and self.gop[0].seq < oldest:
+            return self.gop[0].seq
+        return oldest
+
+    # the condition should be held by the caller
+    def get_frame(self, seq):
+        if seq >= self.seq - self.ring_size:
+            return self.ring[seq % self.ring_size]
+        return self.gop[seq - self.gop[0].seq]
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # gop: start with the cached frames since the last keyframe
+    # max_lag_frames, max_lag_bytes, keyframes_only: see FrameReader
+    def reader(self, gop = True, max_lag_frames = None, max_lag_bytes = None, keyframes_only = False):
+        with self.condition:
+            reader = FrameReader(self, gop, max_lag_frames, max_lag_bytes, keyframes_only)
+            self.readers.add(reader)
+        return reader
+
+    # the frame with a start code before every NALU for the raw streams, the NALUs are not copied
+    # join: the first frame of a raw stream, the parameter sets are prepended if it doesn't start with them
+    def get_annexb(self, frame, join):
+        NALU = self.NALU
+        nalus = frame.nalus
+        if join and not NALU.is_params(frame.nalutype):
+            nalus = list(frame.params) + list(nalus)
+        bufs = []
+        for nalu in nalus:
+            bufs.append(NALU.DELIMITER)
+            bufs.append(nalu)
+        return bufs
+
@@ -0,0 +1,265 @@
+import logging
+
+from h264 import BitReader, H264Parser
+
+class H265NALU:
+    DELIMITER = b'\x00\x00\x00\x01'
+
+    # 0-9: slices of the non-IRAP pictures, the even ones are sub-layer non-reference pictures
+    # 16-23: slices of the IRAP pictures (BLA, IDR, CRA)
+    IRAPFIRSTTYPE = 16
+    IRAPLASTTYPE = 23
+    VPSTYPE = 32
+    SPSTYPE = 33
+    PPSTYPE = 34
+    AUDTYPE = 35
+    PREFIXSEITYPE = 39
+
+    @staticmethod
+    def get_type(nalubytes):
+        return (nalubytes[0] >> 1) & 0x3f
+
+    # every IRAP picture is a random access point, not only the IDR ones
+    @staticmethod
+    def is_idr(nalutype):
+        return H265NALU.IRAPFIRSTTYPE <= nalutype <= H265NALU.IRAPLASTTYPE
+
+    # the keyframe starts with the parameter sets
+    @staticmethod
+    def is_params(nalutype):
+        return nalutype == H265NALU.VPSTYPE
+
+    @staticmethod
+    def is_non_idr(nalutype):
+        return nalutype <= 9
+
+    @staticmethod
+    def is_prefix(nalutype):
+        return nalutype in (H265NALU.AUDTYPE, H265NALU.PREFIXSEITYPE)
+
+
+# The fields of the Sequence Parameter Set which describe the stream
+# References:
+# ITU-T H.265 7.3.2.2 Sequence parameter set RBSP syntax
+# ITU-T H.265 E.2.1 VUI parameters syntax
+# ISO/IEC 14496-15 8.3.3.1 HEVC decoder configuration record, E.3 Codecs parameter
+class H265SPS:
+    def __init__(self, nalu):
+        r = BitReader(nalu)
+        # NAL unit header
+        r.read_bits(16)
+        r.read_bits(4) # sps_video_parameter_set_id
+        self.max_sub_layers = r.read_bits(3) + 1
+        self.temporal_id_nesting = r.read_flag()
+
+        # profile_tier_level, only the general part is used
+        self.profile_space = r.read_bits(2)
+        self.tier_flag = r.read_bits(1)
+        self.profile_idc = r.read_bits(5)
+        self.profile_compatibility_flags = r.read_bits(32)
+        self.constraint_flags = r.read_bits(48)
+        self.level_idc = r.read_bits(8)
+        sub_layers = [(r.read_flag(), r.read_flag()) for _ in range(self.max_sub_layers - 1)]
+        if sub_layers:
+            r.read_bits(2 * (9 - self.max_sub_layers)) # reserved_zero_2bits
+        for profile_present, level_present in sub_layers:
+            if profile_present:
+                r.read_bits(88)
+            if level_present:
+                r.read_bits(8)
+
+        r.read_ue() # sps_seq_parameter_set_id
+        self.chroma_format_idc = r.read_ue()
+        separate_colour_plane = False
+        if self.chroma_format_idc == 3:
+            separate_colour_plane = r.read_flag()
+        width = r.read_ue() # pic_width_in_luma_samples
+        height = r.read_ue() # pic_height_in_luma_samples
+        crop_left = crop_right = crop_top = crop_bottom = 0
+        if r.read_flag(): # conformance_window_flag
+            crop_left = r.read_ue()
+            crop_right = r.read_ue()
+            crop_top = r.read_ue()
+            crop_bottom = r.read_ue()
+        # 7.4.3.2.1: the conformance window is in chroma units
+        chroma_array_type = 0 if separate_colour_plane else self.chroma_format_idc
+        crop_unit_x = 2 if chroma_array_type in (1, 2) else 1
+        crop_unit_y = 2 if chroma_array_type == 1 else 1
+        self.width = width - crop_unit_x * (crop_left + crop_right)
+        self.height = height - crop_unit_y * (crop_top + crop_bottom)
+        if self.width <= 0 or self.height <= 0:
+            raise ValueError(f'H265SPS: invalid frame size {self.width}x{self.height}')
+        self.bit_depth_luma = r.read_ue() + 8
+        self.bit_depth_chroma = r.read_ue() + 8
+
+        # frames per second, None if the stream doesn't tell
+        self.fps = None
+        # the frame rate is deep in the VUI, the stream can be muxed without it
+        try:
+            self.read_fps(r)
+        except ValueError as e:
+            logging.debug(f'H265SPS: unable to read the frame rate: {e}')
+
+    def read_fps(self, r):
+        log2_max_pic_order_cnt_lsb = r.read_ue() + 4
+        sub_layer_ordering_info = r.read_flag()
+        for _ in range(self.max_sub_layers if sub_layer_ordering_info else 1):
+            r.read_ue() # sps_max_dec_pic_buffering_minus1
+            r.read_ue() # sps_max_num_reorder_pics
+            r.read_ue() # sps_max_latency_increase_plus1
+        for _ in range(6):
+            # log2_min_luma_coding_block_size_minus3, log2_diff_max_min_luma_coding_block_size,
+            # log2_min_luma_transform_block_size_minus2, log2_diff_max_min_luma_transform_block_size,
+            # max_transform_hierarchy_depth_inter, max_transform_hierarchy_depth_intra
+            r.read_ue()
+        if r.read_flag() and r.read_flag(): # scaling_list_enabled_flag, sps_scaling_list_data_present_flag
+            self.skip_scaling_list_data(r)
+        r.read_bits(2) # amp_enabled_flag, sample_adaptive_offset_enabled_flag
+        if r.read_flag(): # pcm_enabled_flag
+            r.read_bits(8) # pcm_sample_bit_depth_luma_minus1, pcm_sample_bit_depth_chroma_minus1
+            r.read_ue() # log2_min_pcm_luma_coding_block_size_minus3
+            r.read_ue() # log2_diff_max_min_pcm_luma_coding_block_size
+            r.read_flag() # pcm_loop_filter_disabled_flag
+        num_short_term_ref_pic_sets = r.read_ue()
+        num_delta_pocs = []
+        for i in range(num_short_term_ref_pic_sets):
+            num_delta_pocs.append(self.skip_st_ref_pic_set(r, i, num_delta_pocs))
+        if r.read_flag(): # long_term_ref_pics_present_flag
+            for _ in range(r.read_ue()): # num_long_term_ref_pics_sps
+                r.read_bits(log2_max_pic_order_cnt_lsb + 1) # lt_ref_pic_poc_lsb_sps, used_by_curr_pic_lt_sps_flag
+        r.read_bits(2) # sps_temporal_mvp_enabled_flag, strong_intra_smoothing_enabled_flag
+        if not r.read_flag(): # vui_parameters_present_flag
+            return
+
+        if r.read_flag(): # aspect_ratio_info_present_flag
+            if r.read_bits(8) == 255: # aspect_ratio_idc == EXTENDED_SAR
+                r.read_bits(32) # sar_width, sar_height
+        if r.read_flag(): # overscan_info_present_flag
+            r.read_flag() # overscan_appropriate_flag
+        if r.read_flag(): # video_signal_type_present_flag
+            r.read_bits(4) # video_format, video_full_range_flag
+            if r.read_flag(): # colour_description_present_flag
+                r.read_bits(24) # colour_primaries, transfer_characteristics, matrix_coeffs
+        if r.read_flag(): # chroma_loc_info_present_flag
+            r.read_ue()
+            r.read_ue()
+        r.read_bits(3) # neutral_chroma_indication_flag, field_seq_flag, frame_field_info_present_flag
+        if r.read_flag(): # default_display_window_flag
+            for _ in range(4):
+                r.read_ue()
+        if r.read_flag(): # vui_timing_info_present_flag
+            num_units_in_tick = r.read_bits(32)
+            time_scale = r.read_bits(32)
+            # unlike H264, a tick is a frame
+            if num_units_in_tick:
+                self.fps = time_scale / num_units_in_tick
+
+    @staticmethod
+    def skip_scaling_list_data(r):
+        for size_id in range(4):
+            for _ in range(0, 6, 3 if size_id == 3 else 1):
+                if not r.read_flag(): # scaling_list_pred_mode_flag
+                    r.read_ue() # scaling_list_pred_matrix_id_delta
+                    continue
+                if size_id > 1:
+                    r.read_se() # scaling_list_dc_coef_minus8
+                for _ in range(min(64, 1 << (4 + (size_id << 1)))):
+                    r.read_se() # scaling_list_delta_coef
+
+    # returns NumDeltaPocs of the set, num_delta_pocs: of the previous sets
+    @staticmethod
+    def skip_st_ref_pic_set(r, idx, num_delta_pocs):
+        if idx != 0 and r.read_flag(): # inter_ref_pic_set_prediction_flag
+            # delta_idx_minus1 is only in the slice header, so the reference is the previous set
+            r.read_flag() # delta_rps_sign
+            r.read_ue() # abs_delta_rps_minus1
+            count = 0
+            for _ in range(num_delta_pocs[idx - 1] + 1):
+                used_by_curr_pic = r.read_flag()
+                if used_by_curr_pic or r.read_flag(): # use_delta_flag
+                    count += 1
+            return count
+        num_negative_pics = r.read_ue()
+        num_positive_pics = r.read_ue()
+        for _ in range(num_negative_pics + num_positive_pics):
+            r.read_ue() # delta_poc_minus1
+            r.read_flag() # used_by_curr_pic_flag
+        return num_negative_pics + num_positive_pics
+
+    # the HEVCDecoderConfigurationRecord until the arrays of the parameter sets
+    def get_hvcc_header(self):
+        return bytes([
+            1, # configurationVersion
+            self.profile_space << 6 | self.tier_flag << 5 | self.profile_idc,
+            *self.profile_compatibility_flags.to_bytes(4, 'big'),
+            *self.constraint_flags.to_bytes(6, 'big'),
+            self.level_idc,
+            0xf0, 0x00, # min_spatial_segmentation_idc: unknown
+            0xfc, # parallelismType: unknown
+            0xfc | self.chroma_format_idc,
+            0xf8 | (self.bit_depth_luma - 8),
+            0xf8 | (self.bit_depth_chroma - 8),
+            0x00, 0x00, # avgFrameRate: unknown
+            # constantFrameRate: unknown, numTemporalLayers, temporalIdNested, lengthSizeMinusOne: 3
+            self.max_sub_layers << 3 | self.temporal_id_nesting << 2 | 3,
+        ])
+
+    # RFC 6381 codecs parameter, ISO/IEC 14496-15 E.3
+    def codec(self):
+        space = ('', 'A', 'B', 'C')[self.profile_space]
+        # the compatibility flags in reverse bit order
+        compatibility = int(f'{self.profile_compatibility_flags:032b}'[::-1], 2)
+        tier = 'H' if self.tier_flag else 'L'
+        constraints = self.constraint_flags.to_bytes(6, 'big').rstrip(b'\x00')
+        return f'hvc1.{space}{self.profile_idc}.{compatibility:X}.{tier}{self.level_idc}' + \
+            ''.join(f'.{byte:02X}' for byte in constraints)
+
+
+# The H264Parser with the H265 NALU types and parameter sets (VPS, SPS, PPS)
+# The frames are muxed in decode order without composition time offsets
+class H265Parser(H264Parser):
+    NALU = H265NALU
+
+    def __init__(self, ring_size = 64, gop_cache_size = 300, fps = 30):
+        super(H265Parser, self).__init__(ring_size, gop_cache_size, False, fps)
+        self.vps = None
+        self.params = (None, None, None)
+
+    # the sub-layer non-reference pictures can be dropped if there is only one temporal sub-layer
+    def is_droppable(self, nalus):
+        if self.sps_info is None or self.sps_info.max_sub_layers != 1:
+            return False
+        return all(H265NALU.get_type(nalu) % 2 == 0
+            for nalu in nalus if len(nalu) and H265NALU.is_non_idr(H265NALU.get_type(nalu)))
+
+    def set_decode_time(self, frame):
+        pass
+
+    def update_params(self, nalus):
+        vps, sps, pps = self.params
+        for nalu in nalus:
+            if not len(nalu):
+                continue
+            nalutype = H265NALU.get_type(nalu)
+            if nalutype == H265NALU.VPSTYPE and nalu != vps:
+                vps = bytes(nalu)
+            elif nalutype == H265NALU.SPSTYPE and nalu != sps:
+                sps = bytes(nalu)
+            elif nalutype == H265NALU.PPSTYPE and nalu != pps:
+                pps = bytes(nalu)
+        if not vps or not sps or not pps:
+            logging.error('H265Parser: Invalid H265 first frame. Unable to read VPS, SPS and PPS.')
+        if (vps, sps, pps) == self.params:
+            return
+
+        if sps and sps != self.sps:
+            try:
+                self.sps_info = H265SPS(sps)
+            except ValueError as e:
+                logging.warning(f'H265Parser: unable to parse the SPS: {e}')
+        if all(self.params):
+            logging.info('H265Parser: VPS, SPS, PPS changed')
+        self.vps = vps
+        self.sps_source = self.sps = sps
+        self.pps = pps
+        self.params = (vps, sps, pps)
@@ -0,0 +1,94 @@
+import re
+from urllib.parse import urlsplit, parse_qs
+
+# Low-Latency HLS over the segments of the CMAFSegmenter
+# References:
+# RFC 8216bis HTTP Live Streaming 2nd Edition
+
+# the parts are listed only in the last segments
+PART_SEGMENTS = 3
+
+FILE_RE = re.compile(r'/hls/(?:init(\d*)|seg(\d+)|part(\d+)\.(\d+))\.mp4')
+
+# returns (msn, part) of the blocking playlist reload, they are None without the query
+def parse_playlist_query(path):
+    query = parse_qs(urlsplit(path).query)
+    msn = int(query['_HLS_msn'][0]) if '_HLS_msn' in query else None
+    part = int(query['_HLS_part'][0]) if '_HLS_part' in query and msn is not None else None
+    return msn, part
+
+# returns (kind, msn, part) or None, kind is init, seg or part,
+# msn is the period of the init segment (None without it)
+def parse_file_path(path):
+    m = FILE_RE.fullmatch(urlsplit(path).path)
+    if not m:
+        return None
+    if m.group(2) is not None:
+        return ('seg', int(m.group(2)), None)
+    if m.group(3) is not None:
+        return ('part', int(m.group(3)), int(m.group(4)))
+    return ('init', int(m.group(1)) if m.group(1) else None, None)
+
+# the condition of the segmenter should be held by the caller for the following functions
+
+# the server should answer 400 for a too far msn
+def is_valid_msn(segmenter, msn):
+    current = segmenter.current_segment()
+    return msn is None or current is None or msn <= current.msn + 2
+
+def is_playlist_ready(segmenter, msn, part):
+    current = segmenter.current_segment()
+    if current is None or not current.parts:
+        return False
+    return msn is None or segmenter.has_part(msn, part)
+
+def is_file_ready(segmenter, file):
+    kind, msn, part = file
+    if kind == 'init':
+        return segmenter.init is not None
+    if kind == 'seg':
+        return segmenter.has_part(msn)
+    return segmenter.has_part(msn, part)
+
+# returns the data of the file or None if it's not available
+def get_file(segmenter, file):
+    kind, msn, part = file
+    if kind == 'init':
+        return segmenter.get_init(msn)
+    segment = segmenter.get_segment(msn)
+    if segment is None:
+        return None
+    if kind == 'seg':
+        return segment.get_data() if segment.complete else None
+    return segment.parts[part].get_data() if part < len(segment.parts) else None
+
+def get_media_playlist(segmenter):
+    segments = segmenter.segments
+    part_target = segmenter.part_duration
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:6',
+        f'#EXT-X-TARGETDURATION:{segmenter.target_duration()}',
+        f'#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={3 * part_target:.3f}',
+        f'#EXT-X-PART-INF:PART-TARGET={part_target:.3f}',
+        f'#EXT-X-MEDIA-SEQUENCE:{segments[0].msn}',
+        # the periods are numbered from the start, every new one is a discontinuity
+        f'#EXT-X-DISCONTINUITY-SEQUENCE:{segments[0].period}',
+    ]
+    for i, segment in enumerate(segments):
+        # the SPS, PPS changed, the segments continue with a new init segment
+        if i == 0 or segment.period != segments[i - 1].period:
+            if i > 0:
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.append(f'#EXT-X-MAP:URI="hls/init{segment.period}.mp4"')
+        if i >= len(segments) - PART_SEGMENTS:
+            for j, part in enumerate(segment.parts):
+                independent = ',INDEPENDENT=YES' if part.independent else ''
+                lines.append(f'#EXT-X-PART:DURATION={part.duration:.5f},URI="hls/part{segment.msn}.{j}.mp4"{independent}')
+        if segment.complete:
+            lines.append(f'#EXTINF:{segment.duration:.5f},')
+            lines.append(f'hls/seg{segment.msn}.mp4')
+    current = segments[-1]
+    lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="hls/part{current.msn}.{len(current.parts)}.mp4"')
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
@@ -0,0 +1,240 @@
+import io
+from functools import lru_cache
+from struct import pack_into
+from threading import Lock
+
+import bmff
+from h264 import SPS
+from h265 import H265SPS
+
+# The moof, the mdat header and the NALU length prefixes of a frame,
+# the NALUs are sent from the frame's buffer directly.
+# prefixes is None if the frame is already AVCC (see Frame.avcc)
+# cto: composition time offset in timescale units, the moof is longer if it's not 0
+class Fragment:
+    def __init__(self, header, prefixes, is_idr, cto = 0):
+        self.header = header
+        self.prefixes = prefixes
+        self.is_idr = is_idr
+        self.cto = cto
+        self.moofsize = bmff.MOOFCTOSIZE if cto else bmff.MOOFSIZE
+
+
+# Builds the fragment header of every frame only once and shares it between the clients.
+# The clients patch only their own sequence number, decode time and duration (see MP4Writer)
+class FragmentProducer:
+    def __init__(self, parser, timescale):
+        self.parser = parser
+        self.timescaleusec = timescale / 1000000
+        self.lock = Lock()
+        self.builder = bmff.FragmentBuilder()
+
+    def get_fragment(self, frame):
+        if frame.fragment is None:
+            with self.lock:
+                if frame.fragment is None:
+                    frame.fragment = self.build_fragment(frame)
+        return frame.fragment
+
+    def build_fragment(self, frame):
+        nalus = frame.nalus
+        NALU = self.parser.NALU
+        nalutype = frame.nalutype
+
+        # we have IDR or SPS+PPS+IDR (VPS+SPS+PPS+IRAP for H265)
+        params = ()
+        if NALU.is_idr(nalutype):
+            params = frame.params
+            is_idr = True
+        elif NALU.is_params(nalutype):
+            is_idr = True
+        elif NALU.is_non_idr(nalutype):
+            is_idr = False
+        else:
+            return False
+
+        cto = round(frame.cto * self.timescaleusec)
+
+        # seq, duration and decodetime are patched by every client
+        if frame.avcc is not None:
+            return Fragment(self.builder.build_header(params, len(frame.avcc), is_idr, cto), None, is_idr, cto)
+        header, prefixes = self.builder.build(params, nalus, is_idr, cto)
+        return Fragment(header, prefixes, is_idr, cto)
+
+
+# The init segment (ftyp, moov) is the same for every client, it's built only once for every SPS, PPS.
+# params: (SPS, PPS) of H264 or (VPS, SPS, PPS) of H265
+# The frame size comes from the SPS, width and height are used only if it can't be parsed,
+# the H265 SPS is needed for the hvcC, so it raises ValueError without it
+@lru_cache(maxsize=4)
+def get_init_segment(width, height, rotation, timescale, params):
+    buf = io.BytesIO()
+    bmff.write_ftyp(buf)
+    if len(params) == 3:
+        vps, sps, pps = params
+        info = H265SPS(sps)
+        bmff.write_moov(buf, info.width, info.height, rotation, timescale, sps, pps, vps, info.get_hvcc_header())
+        return buf.getvalue()
+
+    sps, pps = params
+    try:
+        info = SPS(sps)
+        width, height = info.width, info.height
+    except ValueError:
+        pass
+    bmff.write_moov(buf, width, height, rotation, timescale, sps, pps)
+    return buf.getvalue()
+
+
+# appends the frame's nalus with their length prefixes to bufs
+def add_payload(bufs, frame, fragment):
+    if fragment.prefixes is None:
+        bufs.append(frame.avcc)
+        return
+    for prefix, nalu in zip(fragment.prefixes, frame.nalus):
+        bufs.append(prefix)
+        bufs.append(nalu)
+
+
+# Holds the V4L2 buffers of the frames of a multi-sample fragment,
+# it can be passed to the writer's writev instead of a frame
+class FrameGroup:
+    def __init__(self):
+        self.leases = []
+
+    def add(self, frame):
+        lease = frame.acquire()
+        if lease:
+            self.leases.append(lease)
+
+    # returns a new holder with its own references, the writer releases it when the data is sent
+    def acquire(self):
+        group = FrameGroup()
+        for lease in self.leases:
+            group.leases.append(lease.acquire())
+        return group
+
+    def release(self):
+        for lease in self.leases:
+            lease.release()
+        self.leases = []
+
+
+# fragment_frames, fragment_duration (in ms): one fragment holds this many frames or this long,
+# 0 means no limit, every frame has its own fragment by default
+# params: the parameter sets of the stream, see get_init_segment
+class MP4Writer:
+    def __init__(self, w, width, height, rotation, timescale, params, fragment_frames = 1, fragment_duration = 0):
+        if not all(params):
+            raise ValueError('MP4Writer: the parameter set NALUs are missing!')
+
+        self.seq = 0
+        self.params = params
+
+        self.w = w
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.timescale = timescale
+        self.timescaleusec = timescale / 1000000
+        self.decodetime = 0
+        # decode timestamp of the last sent frame in microseconds
+        self.prev_dts = 0
+
+        self.fragment_frames = fragment_frames
+        self.fragment_ticks = fragment_duration * timescale // 1000
+        self.multisample = self.fragment_frames != 1 or self.fragment_ticks > 0
+        # samples of the next multi-sample fragment: [(duration, size, is_idr, cto)]
+        self.samples = []
+        self.samples_bufs = []
+        self.samples_ticks = 0
+        self.samples_frames = FrameGroup()
+
+        self.write_header()
+
+
+    def write_header(self):
+        self.w.write(get_init_segment(self.width, self.height, self.rotation, self.timescale, self.params))
+
+    # the frame should be held by the caller until the call returns
+    def write_frame(self, frame, fragment):
+        if not fragment:
+            return
+
+        first = self.seq == 0 and not self.samples
+        # our first fragment should have SPS, PPS, IDR NALUS, so wait until we have one
+        if first and not fragment.is_idr:
+            return
+
+        # the camera changed its SPS, PPS, most players can't take a new init segment in the middle of the stream,
+        # so the response ends and the client reconnects, it gets the new init segment then
+        if fragment.is_idr and frame.params is not self.params:
+            if frame.params != self.params:
+                raise ValueError('MP4Writer: the SPS, PPS changed, the client should reconnect')
+            self.params = frame.params
+
+        # the duration is the time elapsed since our previous frame, so the decode time
+        # follows the camera's clock even if the reader dropped frames,
+        # rounding the absolute times, so the durations don't drift
+        if first:
+            duration = 1
+        else:
+            duration = max(1,
+                round(frame.dts * self.timescaleusec) -
+                round(self.prev_dts * self.timescaleusec))
+
+        if self.multisample:
+            self.add_sample(frame, fragment, duration)
+            return
+
+        # the decode time is our own, so the timeline stays continuous even if we missed frames
+        header = bytearray(fragment.header[:bmff.MOOFPATCHSIZE])
+        pack_into('>I', header, bmff.MOOFSEQOFFSET, self.seq)
+        pack_into('>Q', header, bmff.MOOFDECODETIMEOFFSET, self.decodetime)
+        pack_into('>I', header, bmff.MOOFDURATIONOFFSET, duration)
+
+        bufs = [header, fragment.header[bmff.MOOFPATCHSIZE:]]
+        add_payload(bufs, frame, fragment)
+        self.w.writev(bufs, frame)
+
+        self.seq += 1
+        self.decodetime += duration
+        self.prev_dts = frame.dts
+
+    def add_sample(self, frame, fragment, duration):
+        # the SPS, PPS after the single-sample moof and mdat header
+        bufs = [fragment.header[fragment.moofsize + 8:]]
+        add_payload(bufs, frame, fragment)
+        self.samples.append((duration, sum(len(buf) for buf in bufs), fragment.is_idr, fragment.cto))
+        self.samples_bufs += bufs
+        self.samples_ticks += duration
+        # the frame's buffer should be kept until the fragment is sent
+        self.samples_frames.add(frame)
+        self.prev_dts = frame.dts
+
+        if (self.fragment_frames and len(self.samples) >= self.fragment_frames) or \
+            (self.fragment_ticks and self.samples_ticks >= self.fragment_ticks):
+            self.write_samples()
+
+    def write_samples(self):
+        mdatsize = 8 + sum(sample[1] for sample in self.samples)
+        buf = io.BytesIO()
+        bmff.write_moof_samples(buf, self.seq, self.decodetime, self.samples)
+        bmff.write_mdat_header(buf, mdatsize)
+
+        frames = self.samples_frames
+        try:
+            self.w.writev([buf.getvalue()] + self.samples_bufs, frames)
+        finally:
+            frames.release()
+            self.samples_frames = FrameGroup()
+
+        self.seq += 1
+        self.decodetime += self.samples_ticks
+        self.samples = []
+        self.samples_bufs = []
+        self.samples_ticks = 0
+
+    # releases the frames of the unsent samples
+    def close(self):
+        self.samples_frames.release()
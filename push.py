@@ -0,0 +1,127 @@
+import logging, ssl
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from threading import Thread
+from time import sleep
+from urllib.parse import urlsplit
+
+from mp4writer import MP4Writer
+from sockwriter import SocketWriter
+
+# wait this long before reconnecting to the receiver, it doubles after every failed attempt up to MAX_RECONNECT_DELAY
+RECONNECT_DELAY = 2
+MAX_RECONNECT_DELAY = 60
+# a receiver which doesn't read the stream for this long is considered dead
+SEND_TIMEOUT = 10
+
+# Sends every write of the MP4Writer as one chunk of the chunked request body
+class ChunkedWriter:
+    def __init__(self, sock):
+        self.sock = sock
+        # sendmsg doesn't work on the SSL sockets
+        self.writer = None if isinstance(sock, ssl.SSLSocket) else SocketWriter(sock)
+
+    def write(self, data):
+        self.writev([data])
+
+    def writev(self, bufs, frame = None):
+        bufs = [b'%x\r\n' % sum(len(buf) for buf in bufs)] + bufs + [b'\r\n']
+        if self.writer:
+            self.writer.writev(bufs, frame)
+        else:
+            self.sock.sendall(b''.join(bufs))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+# Pushes the stream.mp4 to a media server or a cloud relay in the body of one long-lived chunked
+# POST or PUT request (like the DASH-IF live media ingest), so only one copy of the stream leaves
+# the device no matter how many viewers are behind the receiver. After an error it reconnects and
+# resumes with the cached GOP. The receiver records or restreams without telling us, so the push
+# holds one sleeper client for its whole life, across the reconnects.
+class PushClient(Thread):
+    def __init__(self, url, method, parser, fragment_producer, camera, sleeper,
+        width, height, rotation, timescale, max_lag_frames, max_lag_bytes):
+        super(PushClient, self).__init__(daemon=True)
+        self.url = url
+        self.method = method
+        self.parser = parser
+        self.fragment_producer = fragment_producer
+        self.camera = camera
+        self.sleeper = sleeper
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.timescale = timescale
+        self.max_lag_frames = max_lag_frames
+        self.max_lag_bytes = max_lag_bytes
+        self.client = False
+        self.delay = RECONNECT_DELAY
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    self.push()
+                    # the SPS, PPS changed, the new init segment goes in a new request
+                    continue
+                except (OSError, HTTPException) as e:
+                    logging.warning(f'PushClient: {self.url}: {e}, reconnecting in {self.delay} seconds')
+                sleep(self.delay)
+                self.delay = min(2 * self.delay, MAX_RECONNECT_DELAY)
+        except Exception as e:
+            # a bug, retrying wouldn't help
+            logging.error(f'PushClient: {self.url}: {type(e).__name__}: {e}, stopped pushing')
+        finally:
+            if self.client:
+                self.sleeper.remove_client()
+                self.client = False
+
+    def push(self):
+        url = urlsplit(self.url)
+        Connection = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+        connection = Connection(url.netloc, timeout=SEND_TIMEOUT)
+        try:
+            path = url.path or '/'
+            if url.query:
+                path += '?' + url.query
+            connection.putrequest(self.method, path)
+            connection.putheader('Content-Type', 'video/mp4')
+            connection.putheader('Transfer-Encoding', 'chunked')
+            connection.endheaders()
+            self.send_stream(ChunkedWriter(connection.sock))
+        finally:
+            connection.close()
+
+    def send_stream(self, writer):
+        # a woken up camera starts with a keyframe anyway
+        running = not self.camera.sleeping
+        if not self.client:
+            # it stays a client after the errors, so the cached GOP is fresh when it reconnects
+            self.sleeper.add_client()
+            self.client = True
+        # the receiver gets the frames since the last keyframe first, so it can continue without waiting for a keyframe
+        reader = self.parser.reader(max_lag_frames=self.max_lag_frames, max_lag_bytes=self.max_lag_bytes)
+        mp4_writer = None
+        try:
+            if running and not reader.from_gop:
+                self.camera.request_key_frame()
+            mp4_writer = MP4Writer(writer, self.width, self.height, self.rotation, self.timescale, self.parser.params)
+            logging.info(f'PushClient: pushing the stream to {self.url}')
+            # the receiver took the init segment, the next error starts the backoff again
+            self.delay = RECONNECT_DELAY
+            while True:
+                # the reader holds the frame's buffer while we are sending it
+                frame = reader.read_frame()
+                if frame.keyframe and frame.params != mp4_writer.params:
+                    logging.info('PushClient: SPS, PPS changed, starting a new request')
+                    return
+                mp4_writer.write_frame(frame, self.fragment_producer.get_fragment(frame))
+        finally:
+            if mp4_writer:
+                mp4_writer.close()
+            writer.close()
+            reader.close()
+            if reader.dropped:
+                logging.info(f'PushClient: dropped frames: {reader.dropped}')
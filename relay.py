@@ -0,0 +1,317 @@
+import logging, struct
+from http.client import HTTPException
+from threading import Thread, Condition
+from time import monotonic
+from urllib.request import urlopen
+
+import v4l2
+from h264 import H264NALU
+from h265 import H265NALU
+
+# Relay mode: the frames come from an upstream fmp4streamer's stream.mp4 (or any fragmented MP4
+# with one H264 or H265 track) instead of a V4L2 device. The fragments are demuxed back into
+# Annex-B frames for the parser, so every output works the same way as with a camera.
+# References:
+# ISO/IEC 14496-12 ISO base media file format
+# ISO/IEC 14496-15 5.3.3.1 AVC and 8.3.3.1 HEVC decoder configuration records
+
+# wait this long before reconnecting to the upstream
+RECONNECT_DELAY = 2
+# the upstream sends a frame at least this often
+READ_TIMEOUT = 10
+# a fragment of a few frames, a bigger box means that we are out of sync
+MAX_BOX_SIZE = 32 * 1024 * 1024
+# the sample entry fields before the child boxes (avcC, hvcC)
+VISUAL_SAMPLE_ENTRY_SIZE = 78
+
+# trun flags
+TRUN_DATA_OFFSET = 0x000001
+TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+TRUN_SAMPLE_DURATION = 0x000100
+TRUN_SAMPLE_SIZE = 0x000200
+TRUN_SAMPLE_FLAGS = 0x000400
+TRUN_SAMPLE_CTO = 0x000800
+# tfhd flags
+TFHD_BASE_DATA_OFFSET = 0x000001
+TFHD_SAMPLE_DESCRIPTION_INDEX = 0x000002
+TFHD_DEFAULT_SAMPLE_DURATION = 0x000008
+TFHD_DEFAULT_SAMPLE_SIZE = 0x000010
+TFHD_DEFAULT_SAMPLE_FLAGS = 0x000020
+
+# returns the (type, payload) of the boxes in data
+def get_boxes(data):
+    boxes = []
+    start = 0
+    while start + 8 <= len(data):
+        size, boxtype = struct.unpack_from('>I 4s', data, start)
+        if size < 8 or start + size > len(data):
+            raise ValueError(f'invalid {boxtype} box')
+        boxes.append((boxtype, data[start + 8 : start + size]))
+        start += size
+    return boxes
+
+# returns the payload of the box at the path, eg (b'trak', b'mdia')
+def find_box(data, path):
+    for boxtype in path:
+        data = next((payload for t, payload in get_boxes(data) if t == boxtype), None)
+        if data is None:
+            raise ValueError(f'no {boxtype} box')
+    return data
+
+# the parameter sets from the avcC: (SPS, PPS)
+def parse_avcc(avcc):
+    if avcc[4] & 3 != 3:
+        raise ValueError('only 4 byte NALU lengths are supported')
+    params = []
+    start = 5
+    for mask in (0x1f, 0xff):
+        count = avcc[start] & mask
+        start += 1
+        for i in range(count):
+            size = struct.unpack_from('>H', avcc, start)[0]
+            if i == 0:
+                params.append(bytes(avcc[start + 2 : start + 2 + size]))
+            start += 2 + size
+    if len(params) != 2:
+        raise ValueError('no SPS or PPS in the avcC')
+    return tuple(params)
+
+# the parameter sets from the hvcC: (VPS, SPS, PPS)
+def parse_hvcc(hvcc):
+    if hvcc[21] & 3 != 3:
+        raise ValueError('only 4 byte NALU lengths are supported')
+    params = {}
+    start = 23
+    for _ in range(hvcc[22]):
+        nalutype = hvcc[start] & 0x3f
+        count = struct.unpack_from('>H', hvcc, start + 1)[0]
+        start += 3
+        for _ in range(count):
+            size = struct.unpack_from('>H', hvcc, start)[0]
+            params.setdefault(nalutype, bytes(hvcc[start + 2 : start + 2 + size]))
+            start += 2 + size
+    try:
+        return tuple(params[nalutype] for nalutype in (H265NALU.VPSTYPE, H265NALU.SPSTYPE, H265NALU.PPSTYPE))
+    except KeyError:
+        raise ValueError('no VPS, SPS or PPS in the hvcC')
+
+
+# A connection to the upstream, the constructor reads the stream until the first init segment
+class Upstream:
+    def __init__(self, url):
+        self.url = url
+        self.response = urlopen(url, timeout=READ_TIMEOUT)
+        self.hevc = False
+        self.timescale = 0
+        self.params = None
+        # the last moof, the samples are in the next mdat
+        self.moof = None
+        while self.params is None:
+            self.read_box()
+
+    def video_format(self):
+        return 'HEVC' if self.hevc else 'H264'
+
+    def read(self, size):
+        data = self.response.read(size)
+        if len(data) < size:
+            raise EOFError('the upstream closed the stream')
+        return data
+
+    # returns the frames of the box: (decode time, duration in seconds, Annex-B frame) if it's an mdat, [] otherwise
+    def read_box(self):
+        size, boxtype = struct.unpack('>I 4s', self.read(8))
+        if size < 8 or size > MAX_BOX_SIZE:
+            raise ValueError(f'invalid {boxtype} box size: {size}')
+        payload = self.read(size - 8)
+        if boxtype == b'moov':
+            self.parse_moov(payload)
+        elif boxtype == b'moof':
+            self.moof = (size, payload)
+        elif boxtype == b'mdat':
+            if self.moof is None:
+                raise ValueError('mdat without moof')
+            frames = self.get_frames(payload)
+            self.moof = None
+            return frames
+        return []
+
+    def parse_moov(self, moov):
+        mdia = find_box(moov, (b'trak', b'mdia'))
+        mdhd = find_box(mdia, (b'mdhd',))
+        # version 1 has 64 bit creation and modification times
+        self.timescale = struct.unpack_from('>I', mdhd, 20 if mdhd[0] == 1 else 12)[0]
+        stsd = find_box(mdia, (b'minf', b'stbl', b'stsd'))
+        # version, flags, entry_count, then the first sample entry
+        entries = get_boxes(stsd[8:])
+        if not entries:
+            raise ValueError('no sample entry')
+        entrytype, entry = entries[0]
+        boxes = dict(get_boxes(entry[VISUAL_SAMPLE_ENTRY_SIZE:]))
+        if b'avcC' in boxes:
+            hevc, params = False, parse_avcc(boxes[b'avcC'])
+        elif b'hvcC' in boxes:
+            hevc, params = True, parse_hvcc(boxes[b'hvcC'])
+        else:
+            raise ValueError(f'unsupported sample entry: {entrytype}')
+        if self.params is not None and hevc != self.hevc:
+            raise ValueError('the upstream changed its video format')
+        self.hevc = hevc
+        self.params = params
+
+    def get_frames(self, mdat):
+        moofsize, moof = self.moof
+        traf = find_box(moof, (b'traf',))
+        tfhd = find_box(traf, (b'tfhd',))
+        flags = struct.unpack_from('>I', tfhd)[0] & 0xffffff
+        start = 8
+        defaults = {}
+        for flag, name, size in ((TFHD_BASE_DATA_OFFSET, 'base', 8), (TFHD_SAMPLE_DESCRIPTION_INDEX, 'index', 4),
+            (TFHD_DEFAULT_SAMPLE_DURATION, 'duration', 4), (TFHD_DEFAULT_SAMPLE_SIZE, 'size', 4), (TFHD_DEFAULT_SAMPLE_FLAGS, 'flags', 4)):
+            if flags & flag:
+                defaults[name] = int.from_bytes(tfhd[start : start + size], 'big')
+                start += size
+        tfdt = find_box(traf, (b'tfdt',))
+        decodetime = struct.unpack_from('>Q' if tfdt[0] == 1 else '>I', tfdt, 4)[0]
+
+        trun = find_box(traf, (b'trun',))
+        flags, count = struct.unpack_from('>I I', trun)
+        flags &= 0xffffff
+        start = 8
+        # the data offset is relative to the moof, the samples follow the mdat header
+        offset = 0
+        if flags & TRUN_DATA_OFFSET:
+            offset = struct.unpack_from('>i', trun, start)[0] - moofsize - 8
+            start += 4
+        if flags & TRUN_FIRST_SAMPLE_FLAGS:
+            start += 4
+        NALU = H265NALU if self.hevc else H264NALU
+        frames = []
+        for _ in range(count):
+            duration = defaults.get('duration', 0)
+            size = defaults.get('size', 0)
+            if flags & TRUN_SAMPLE_DURATION:
+                duration = struct.unpack_from('>I', trun, start)[0]
+                start += 4
+            if flags & TRUN_SAMPLE_SIZE:
+                size = struct.unpack_from('>I', trun, start)[0]
+                start += 4
+            # the parser finds the keyframes and the decode order by itself
+            start += 4 * bool(flags & TRUN_SAMPLE_FLAGS) + 4 * bool(flags & TRUN_SAMPLE_CTO)
+            if offset < 0 or offset + size > len(mdat):
+                raise ValueError('the samples are out of the mdat')
+
+            # the 4 byte NALU lengths are replaced with start codes
+            frame = bytearray(mdat[offset : offset + size])
+            pos = 0
+            while pos + 4 < len(frame):
+                nalusize = int.from_bytes(frame[pos : pos + 4], 'big')
+                frame[pos : pos + 4] = NALU.DELIMITER
+                pos += 4 + nalusize
+            if pos != len(frame):
+                raise ValueError('invalid NALU length')
+            # the parameter sets could be only in the init segment
+            if size > 4 and NALU.is_idr(NALU.get_type(frame[4:5])):
+                frame[:0] = NALU.DELIMITER + NALU.DELIMITER.join(self.params)
+
+            frames.append((decodetime / self.timescale, duration / self.timescale, frame))
+            decodetime += duration
+            offset += size
+        return frames
+
+    def close(self):
+        self.response.close()
+
+
+# the interface of the V4L2 buffers for the parser's write_buf
+class RelayBuffer:
+    __slots__ = ('buffer', 'bytesused', 'timestamp')
+
+    def __init__(self, buffer, timestamp):
+        self.buffer = buffer
+        self.bytesused = len(buffer)
+        self.timestamp = v4l2.timeval(timestamp // 1000000, timestamp % 1000000)
+
+
+# It has the interface of the V4L2Camera, it reads the frames from the upstream and writes them
+# into the pipe (the parser). If auto_sleep is on, it disconnects from the upstream while nobody
+# is watching. The keyframes come from the upstream, they can't be requested.
+class RelaySource(Thread):
+    def __init__(self, upstream, pipe, auto_sleep):
+        # it must not keep the process alive if the startup fails after it started
+        super(RelaySource, self).__init__(daemon=True)
+        self.condition = Condition()
+        self.url = upstream.url
+        self.upstream = upstream
+        self.pipe = pipe
+        self.auto_sleep = auto_sleep
+        self.stopped = False
+        self.sleeping = False
+        # the timestamp of the last frame in microseconds, it is monotonic across the reconnects
+        self.timestamp = 0
+
+    def request_key_frame(self):
+        pass
+
+    def print_ctrls(self):
+        print(f'Relay mode, the stream comes from {self.url}, there are no controls')
+
+    # the upstream timestamps are moved to the monotonic clock, like the V4L2 timestamps
+    def relay(self, upstream):
+        start = None
+        # the first sample of a stream.mp4 is only 1 tick long (see MP4Writer.write_frame), so the first
+        # frame waits for the second one and it is placed a sample duration before that
+        first = None
+        while not self.stopped and not self.sleeping:
+            for decodetime, duration, frame in upstream.read_box():
+                if start is None:
+                    if first is None:
+                        first = frame
+                        continue
+                    first_decodetime = decodetime - duration
+                    start = max(monotonic(), (self.timestamp + 1) / 1000000) - first_decodetime
+                    self.write_frame(start + first_decodetime, first)
+                self.write_frame(start + decodetime, frame)
+
+    # t: monotonic time in seconds
+    def write_frame(self, t, frame):
+        self.timestamp = max(round(t * 1000000), self.timestamp + 1)
+        self.pipe.write_buf(RelayBuffer(frame, self.timestamp))
+
+    def run(self):
+        while not self.stopped:
+            with self.condition:
+                while self.sleeping and not self.stopped:
+                    self.condition.wait()
+            if self.stopped:
+                break
+            try:
+                if self.upstream is None:
+                    self.upstream = Upstream(self.url)
+                self.relay(self.upstream)
+            except (OSError, EOFError, ValueError, struct.error, HTTPException) as e:
+                logging.warning(f'RelaySource: {self.url}: {e}, reconnecting')
+                with self.condition:
+                    self.condition.wait(RECONNECT_DELAY)
+            finally:
+                if self.upstream:
+                    self.upstream.close()
+                    self.upstream = None
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.join()
+
+    def sleep(self):
+        if not self.auto_sleep:
+            return
+        self.sleeping = True
+
+    def wakeup(self):
+        if not self.auto_sleep:
+            return
+        with self.condition:
+            self.sleeping = False
+            self.condition.notify_all()
@@ -0,0 +1,412 @@
+import socket, socketserver, logging, random, base64
+from struct import pack
+from threading import Thread, Lock
+from time import time
+
+from h265 import H265NALU
+from sockwriter import SocketWriter, IOV_MAX
+
+# RTSP server: the RTP packets are cut from the parser's frames, every session has its own reader
+# References:
+# RFC 2326 Real Time Streaming Protocol (RTSP)
+# RFC 3550 RTP: A Transport Protocol for Real-Time Applications
+# RFC 6184 RTP Payload Format for H.264 Video
+# RFC 7798 RTP Payload Format for High Efficiency Video Coding (HEVC)
+
+RTP_CLOCK = 90000
+PAYLOAD_TYPE = 96
+# the RTP payload fits into the usual 1500 byte MTU with the IP, UDP and RTP headers
+MAX_PAYLOAD = 1400
+# RTCP sender reports, so the clients can map the RTP timestamps to the wall clock
+RTCP_INTERVAL = 5
+# the clients keep the session alive with requests (UDP) or RTCP receiver reports (TCP)
+SESSION_TIMEOUT = 60
+# seconds between 1900 and 1970
+NTP_OFFSET = 2208988800
+
+PUBLIC_METHODS = 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER, SET_PARAMETER'
+
+# multicast: (group, port, ttl) of the MulticastSender, the receivers join the group without RTSP
+def get_sdp(parser, host, multicast = None):
+    if parser.NALU is H265NALU:
+        vps, sps, pps = (base64.b64encode(nalu).decode('ascii') for nalu in parser.params)
+        rtpmap = 'H265/90000'
+        fmtp = f'sprop-vps={vps};sprop-sps={sps};sprop-pps={pps}'
+    else:
+        sps, pps = parser.params
+        rtpmap = 'H264/90000'
+        fmtp = f'packetization-mode=1;profile-level-id={bytes(sps[1:4]).hex()};' + \
+            'sprop-parameter-sets=' + ','.join(base64.b64encode(nalu).decode('ascii') for nalu in (sps, pps))
+    if multicast:
+        group, port, ttl = multicast
+        connection = f'{group}/{ttl}'
+    else:
+        connection, port = '0.0.0.0', 0
+    return f'''v=0
+o=- {random.getrandbits(32)} 1 IN IP4 {host}
+s=fmp4streamer
+c=IN IP4 {connection}
+t=0 0
+a=control:*
+a=range:npt=0-
+m=video {port} RTP/AVP {PAYLOAD_TYPE}
+a=rtpmap:{PAYLOAD_TYPE} {rtpmap}
+a=fmtp:{PAYLOAD_TYPE} {fmtp}
+a=control:track0
+'''.replace('\n', '\r\n').encode('utf-8')
+
+
+# Cuts the NALUs into RTP packets: single NAL unit packets or fragmentation units (FU-A, H265 FU)
+# The packets are lists of buffers, the NALUs are not copied
+class RTPPacketizer:
+    def __init__(self, hevc):
+        self.hevc = hevc
+        self.seq = random.getrandbits(16)
+        self.ssrc = random.getrandbits(32)
+        # the RTP timestamp of the first frame
+        self.base = random.getrandbits(32)
+        self.start = None
+        self.packets = 0
+        self.octets = 0
+        # the RTP timestamp of the last frame and when it was sent, for the sender reports
+        self.timestamp = self.base
+        self.timestamp_time = time()
+
+    # pts: presentation time in microseconds
+    def packetize(self, nalus, pts):
+        if self.start is None:
+            self.start = pts
+        self.timestamp = (self.base + (pts - self.start) * RTP_CLOCK // 1000000) & 0xffffffff
+        self.timestamp_time = time()
+
+        payloads = []
+        for nalu in nalus:
+            if not len(nalu):
+                continue
+            if len(nalu) <= MAX_PAYLOAD:
+                payloads.append([nalu])
+                continue
+            if self.hevc:
+                # payload header with the FU type (49), FU header with the NALU type
+                header = pack('>B B', (nalu[0] & 0x81) | (49 << 1), nalu[1])
+                nalutype = (nalu[0] >> 1) & 0x3f
+                start = 2
+            else:
+                # FU indicator with the FU-A type (28), FU header with the NALU type
+                header = pack('>B', (nalu[0] & 0xe0) | 28)
+                nalutype = nalu[0] & 0x1f
+                start = 1
+            size = MAX_PAYLOAD - len(header) - 1
+            # start bit
+            fu = 0x80
+            while start < len(nalu):
+                end = min(start + size, len(nalu))
+                if end == len(nalu):
+                    # end bit
+                    fu |= 0x40
+                payloads.append([header, pack('>B', fu | nalutype), nalu[start:end]])
+                fu = 0
+                start = end
+
+        packets = []
+        for i, payload in enumerate(payloads):
+            # the marker bit is set on the last packet of the frame
+            marker = 0x80 if i == len(payloads) - 1 else 0
+            packets.append([pack('>B B H I I', 0x80, marker | PAYLOAD_TYPE, self.seq, self.timestamp, self.ssrc)] + payload)
+            self.seq = (self.seq + 1) & 0xffff
+            self.packets += 1
+            self.octets += sum(len(buf) for buf in payload)
+        return packets
+
+    # RTCP sender report and source description (CNAME)
+    def sender_report(self):
+        now = time()
+        timestamp = (self.timestamp + round((now - self.timestamp_time) * RTP_CLOCK)) & 0xffffffff
+        ntp = int((now + NTP_OFFSET) * (1 << 32))
+        cname = b'fmp4streamer'
+        sdes_items = pack('>B B', 1, len(cname)) + cname + b'\x00'
+        sdes_items += bytes(-len(sdes_items) % 4)
+        return pack('>B B H I Q I I I', 0x80, 200, 6, self.ssrc, ntp, timestamp, self.packets & 0xffffffff, self.octets & 0xffffffff) + \
+            pack('>B B H I', 0x81, 202, 1 + len(sdes_items) // 4, self.ssrc) + sdes_items
+
+
+# Sends the frames of the parser as RTP packets from its own thread after play(), the subclasses
+# deliver the packets, see send(). Every playing sender counts as a client of the sleeper
+class RTPSender:
+    def __init__(self, name, parser, camera, sleeper, max_lag_frames, max_lag_bytes):
+        self.name = name
+        self.parser = parser
+        self.camera = camera
+        self.sleeper = sleeper
+        self.max_lag_frames = max_lag_frames
+        self.max_lag_bytes = max_lag_bytes
+        self.packetizer = RTPPacketizer(parser.NALU is H265NALU)
+        self.thread = None
+        self.stopped = False
+
+    def play(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # packets: lists of buffers from the packetizer
+    def send(self, packets, rtcp = False):
+        raise NotImplementedError
+
+    def run(self):
+        parser = self.parser
+        # a burst of the cached GOP would confuse the receivers' jitter buffers, start at the next keyframe
+        reader = parser.reader(gop=False, max_lag_frames=self.max_lag_frames, max_lag_bytes=self.max_lag_bytes)
+        if not self.camera.sleeping:
+            self.camera.request_key_frame()
+        self.sleeper.add_client()
+        try:
+            NALU = parser.NALU
+            last_report = 0
+            while not self.stopped:
+                frame = reader.read_frame(1)
+                if frame is not None:
+                    nalus = frame.nalus
+                    # the parameter sets are repeated before every IDR frame
+                    if NALU.is_idr(frame.nalutype):
+                        nalus = list(frame.params) + nalus
+                    self.send(self.packetizer.packetize(nalus, frame.dts + frame.cto))
+                if time() - last_report >= RTCP_INTERVAL and self.packetizer.packets:
+                    self.send([[self.packetizer.sender_report()]], True)
+                    last_report = time()
+        except Exception as e:
+            logging.info(f'{self.name}: {e}')
+        finally:
+            self.sleeper.remove_client()
+            reader.close()
+            logging.info(f'{self.name}: stopped, dropped frames: {reader.dropped}')
+
+    def stop(self):
+        self.stopped = True
+        if self.thread:
+            self.thread.join()
+
+
+# A SETUP-ed stream of an RTSP client, it plays until TEARDOWN or until the client disconnects
+class RTSPSession(RTPSender):
+    def __init__(self, server, transport):
+        self.id = f'{random.getrandbits(32):08X}'
+        super(RTSPSession, self).__init__(f'RTSPSession {self.id}', server.parser, server.camera, server.sleeper,
+            server.max_lag_frames, server.max_lag_bytes)
+        # ('tcp', writer, lock, rtp channel, rtcp channel) or ('udp', rtp socket, rtcp socket, rtp address, rtcp address)
+        self.transport = transport
+
+    def send(self, packets, rtcp = False):
+        kind = self.transport[0]
+        if kind == 'tcp':
+            _, writer, lock, rtp_channel, rtcp_channel = self.transport
+            channel = rtcp_channel if rtcp else rtp_channel
+            bufs = []
+            for packet in packets:
+                # a keyframe has hundreds of packets, they are sent in batches, so the RTSP responses fit in between
+                if len(bufs) + 1 + len(packet) > IOV_MAX:
+                    with lock:
+                        writer.writev(bufs)
+                    bufs = []
+                bufs.append(pack('>c B H', b'$', channel, sum(len(buf) for buf in packet)))
+                bufs += packet
+            if bufs:
+                with lock:
+                    writer.writev(bufs)
+        else:
+            _, rtp_sock, rtcp_sock, rtp_addr, rtcp_addr = self.transport
+            for packet in packets:
+                if rtcp:
+                    rtcp_sock.sendmsg(packet, [], 0, rtcp_addr)
+                else:
+                    rtp_sock.sendmsg(packet, [], 0, rtp_addr)
+
+    def stop(self):
+        super(RTSPSession, self).stop()
+        if self.transport[0] == 'udp':
+            self.transport[1].close()
+            self.transport[2].close()
+
+
+# Sends every frame once to a multicast group (RTP to the port, RTCP to the next one), the network
+# copies the packets to the receivers, so a LAN full of viewers costs the same as one. The receivers
+# join with IGMP, we never hear about them, so it plays from the start and keeps the camera awake.
+class MulticastSender(RTPSender):
+    def __init__(self, address, ttl, parser, camera, sleeper, max_lag_frames, max_lag_bytes):
+        super(MulticastSender, self).__init__('MulticastSender', parser, camera, sleeper, max_lag_frames, max_lag_bytes)
+        self.address = address
+        self.ttl = ttl
+        group, port = address
+        self.rtp_addr = (group, port)
+        self.rtcp_addr = (group, port + 1)
+        self.rtp_sock, self.rtcp_sock = get_udp_pair()
+        for sock in (self.rtp_sock, self.rtcp_sock):
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.failing = False
+
+    # the sender shouldn't stop if the network is down for a while, eg the interface isn't up yet
+    def send(self, packets, rtcp = False):
+        sock, address = (self.rtcp_sock, self.rtcp_addr) if rtcp else (self.rtp_sock, self.rtp_addr)
+        try:
+            for packet in packets:
+                sock.sendmsg(packet, [], 0, address)
+            self.failing = False
+        except OSError as e:
+            if not self.failing:
+                logging.warning(f'MulticastSender: {e}')
+            self.failing = True
+
+    def get_sdp(self, host):
+        return get_sdp(self.parser, host, (*self.address, self.ttl))
+
+
+# returns an RTP and an RTCP socket on consecutive ports, the RTP port is even
+def get_udp_pair():
+    for _ in range(20):
+        rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtp.bind(('', 0))
+        port = rtp.getsockname()[1]
+        if port % 2 == 0:
+            rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                rtcp.bind(('', port + 1))
+                return rtp, rtcp
+            except OSError:
+                rtcp.close()
+        rtp.close()
+    raise OSError('RTSP: no free UDP port pair')
+
+
+class RTSPRequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super(RTSPRequestHandler, self).setup()
+        self.connection.settimeout(SESSION_TIMEOUT)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the responses and the interleaved packets share the connection
+        self.writer = SocketWriter(self.connection)
+        self.lock = Lock()
+        self.sessions = {}
+
+    def handle(self):
+        try:
+            while True:
+                first = self.rfile.read(1)
+                if not first:
+                    return
+                if first == b'$':
+                    # interleaved RTCP receiver report, we don't need it
+                    header = self.rfile.read(3)
+                    if len(header) < 3:
+                        return
+                    self.rfile.read(int.from_bytes(header[1:], 'big'))
+                    continue
+                requestline = (first + self.rfile.readline(8192)).decode('iso-8859-1').strip()
+                if not requestline:
+                    continue
+                headers = {}
+                while True:
+                    line = self.rfile.readline(8192).decode('iso-8859-1').strip()
+                    if not line:
+                        break
+                    key, _, value = line.partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                if 'content-length' in headers:
+                    self.rfile.read(int(headers['content-length']))
+                self.handle_request(requestline, headers)
+        except (OSError, ValueError) as e:
+            logging.info(f'RTSP client {self.client_address}: {e}')
+        finally:
+            for session in self.sessions.values():
+                session.stop()
+            self.sessions = {}
+
+    def respond(self, code, reason, cseq, headers = {}, body = b''):
+        lines = [f'RTSP/1.0 {code} {reason}', f'CSeq: {cseq}', 'Server: Fmp4streamer']
+        lines += [f'{key}: {value}' for key, value in headers.items()]
+        if body:
+            lines.append(f'Content-Length: {len(body)}')
+        data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+        with self.lock:
+            self.writer.write(data)
+
+    def handle_request(self, requestline, headers):
+        words = requestline.split()
+        cseq = headers.get('cseq', '0')
+        if len(words) != 3 or not words[2].startswith('RTSP/'):
+            return self.respond(400, 'Bad Request', cseq)
+        method, url, _ = words
+        logging.info(f'RTSP client {self.client_address}: {method} {url}')
+        session = self.sessions.get(headers.get('session', '').split(';')[0])
+
+        if method == 'OPTIONS':
+            self.respond(200, 'OK', cseq, {'Public': PUBLIC_METHODS})
+        elif method == 'DESCRIBE':
+            sdp = get_sdp(self.server.parser, self.connection.getsockname()[0])
+            self.respond(200, 'OK', cseq, {'Content-Base': url.rstrip('/') + '/', 'Content-Type': 'application/sdp'}, sdp)
+        elif method == 'SETUP':
+            transport = self.get_transport(headers.get('transport', ''))
+            if transport is None:
+                return self.respond(461, 'Unsupported Transport', cseq)
+            session, reply = transport
+            self.sessions[session.id] = session
+            self.respond(200, 'OK', cseq, {'Transport': reply, 'Session': f'{session.id};timeout={SESSION_TIMEOUT}'})
+        elif method == 'PLAY':
+            if session is None:
+                return self.respond(454, 'Session Not Found', cseq)
+            packetizer = session.packetizer
+            self.respond(200, 'OK', cseq, {'Session': session.id, 'Range': 'npt=0.000-',
+                'RTP-Info': f'url={url};seq={packetizer.seq};rtptime={packetizer.base}'})
+            session.play()
+        elif method == 'TEARDOWN':
+            if session is None:
+                return self.respond(454, 'Session Not Found', cseq)
+            del self.sessions[session.id]
+            session.stop()
+            self.respond(200, 'OK', cseq, {'Session': session.id})
+        elif method in ('GET_PARAMETER', 'SET_PARAMETER'):
+            # keep-alive
+            self.respond(200, 'OK', cseq, {'Session': session.id} if session else {})
+        else:
+            self.respond(501, 'Not Implemented', cseq)
+
+    # returns (session, the Transport header of the reply) or None if the transport isn't supported
+    def get_transport(self, transport):
+        for spec in transport.split(','):
+            params = spec.strip().split(';')
+            options = dict(param.partition('=')[::2] for param in params[1:])
+            if 'multicast' in options:
+                continue
+            if params[0] == 'RTP/AVP/TCP':
+                rtp_channel, _, rtcp_channel = options.get('interleaved', '0-1').partition('-')
+                rtp_channel = int(rtp_channel)
+                rtcp_channel = int(rtcp_channel) if rtcp_channel else rtp_channel + 1
+                session = RTSPSession(self.server, ('tcp', self.writer, self.lock, rtp_channel, rtcp_channel))
+                return session, f'RTP/AVP/TCP;unicast;interleaved={rtp_channel}-{rtcp_channel}'
+            if params[0] in ('RTP/AVP', 'RTP/AVP/UDP') and 'client_port' in options:
+                rtp_port, _, rtcp_port = options['client_port'].partition('-')
+                rtp_port = int(rtp_port)
+                rtcp_port = int(rtcp_port) if rtcp_port else rtp_port + 1
+                rtp_sock, rtcp_sock = get_udp_pair()
+                client = self.client_address[0]
+                session = RTSPSession(self.server, ('udp', rtp_sock, rtcp_sock, (client, rtp_port), (client, rtcp_port)))
+                server_port = rtp_sock.getsockname()[1]
+                return session, f'RTP/AVP;unicast;client_port={rtp_port}-{rtcp_port};server_port={server_port}-{server_port + 1}'
+        return None
+
+
+# It shares the parser and the camera with the HTTP server, every playing session counts as a client of the sleeper
+class RTSPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, parser, camera, sleeper, max_lag_frames, max_lag_bytes):
+        super(RTSPServer, self).__init__(server_address, RTSPRequestHandler)
+        self.parser = parser
+        self.camera = camera
+        self.sleeper = sleeper
+        self.max_lag_frames = max_lag_frames
+        self.max_lag_bytes = max_lag_bytes
+
+    # serves from its own thread next to the HTTP server
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
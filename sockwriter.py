@@ -0,0 +1,103 @@
+import socket, struct, select, logging
+from collections import deque
+
+# not in the socket module
+SO_ZEROCOPY = 60
+MSG_ZEROCOPY = 0x4000000
+SO_EE_ORIGIN_ZEROCOPY = 5
+IP_RECVERR = 11
+IPV6_RECVERR = 25
+
+# send only the bigger writes with MSG_ZEROCOPY, page pinning costs more than copying the small ones
+ZEROCOPY_MIN_SIZE = 16384
+# wait for the completions if there are more sends in flight
+ZEROCOPY_MAX_PENDING = 32
+# sendmsg fails with EMSGSIZE if it gets more buffers
+IOV_MAX = 1024
+
+# Writes the fragment header and the NALU memoryviews in one sendmsg call
+# without copying them together in python
+class SocketWriter:
+    def __init__(self, sock, zerocopy = False):
+        self.sock = sock
+        self.zerocopy = False
+        if zerocopy:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_ZEROCOPY, 1)
+                self.zerocopy = True
+            except OSError as e:
+                logging.warning(f'SocketWriter: MSG_ZEROCOPY is not supported: {e}')
+        # zerocopy sends in flight: (id, lease, bufs)
+        self.pending = deque()
+        self.next_id = 0
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    # frame: holds its V4L2 buffer until the kernel finished with a zerocopy send
+    def writev(self, bufs, frame = None):
+        size = sum(len(b) for b in bufs)
+        if self.zerocopy and size >= ZEROCOPY_MIN_SIZE:
+            lease = frame.acquire() if frame else None
+            self.sendmsg_all(bufs, size, MSG_ZEROCOPY)
+            self.pending.append((self.next_id, lease, bufs))
+            self.next_id = (self.next_id + 1) & 0xffffffff
+            self.reap_completions(len(self.pending) > ZEROCOPY_MAX_PENDING)
+        else:
+            self.sendmsg_all(bufs, size, 0)
+            if self.pending:
+                self.reap_completions(False)
+
+    def sendmsg_all(self, bufs, size, flags):
+        sent = self.sock.sendmsg(bufs[:IOV_MAX], [], flags)
+        while sent < size:
+            # partial send, skip the sent buffers and continue
+            size -= sent
+            while sent >= len(bufs[0]):
+                sent -= len(bufs[0])
+                bufs = bufs[1:]
+            bufs = [memoryview(bufs[0])[sent:]] + bufs[1:]
+            if flags & MSG_ZEROCOPY:
+                # every successful zerocopy sendmsg has its own completion id
+                self.pending.append((self.next_id, None, bufs))
+                self.next_id = (self.next_id + 1) & 0xffffffff
+            sent = self.sock.sendmsg(bufs[:IOV_MAX], [], flags)
+
+    def reap_completions(self, block):
+        while self.pending:
+            try:
+                _, ancdata, _, _ = self.sock.recvmsg(0, 128, socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                if not block or len(self.pending) <= ZEROCOPY_MAX_PENDING:
+                    return
+                # the completions arrive as POLLERR
+                poller = select.poll()
+                poller.register(self.sock, 0)
+                poller.poll(1000)
+                continue
+            for level, type, data in ancdata:
+                if not ((level == socket.SOL_IP and type == IP_RECVERR) or
+                        (level == socket.IPPROTO_IPV6 and type == IPV6_RECVERR)):
+                    continue
+                # struct sock_extended_err
+                ee_errno, ee_origin, ee_type, ee_code, ee_pad, lo, hi = struct.unpack_from('=I B B B B I I', data)
+                if ee_origin == SO_EE_ORIGIN_ZEROCOPY:
+                    self.complete(lo, hi)
+
+    def complete(self, lo, hi):
+        # ids are 32 bit and they can wrap around
+        remaining = deque()
+        for pending in self.pending:
+            id, lease, _ = pending
+            if (id - lo) & 0xffffffff <= (hi - lo) & 0xffffffff:
+                if lease:
+                    lease.release()
+            else:
+                remaining.append(pending)
+        self.pending = remaining
+
+    def close(self):
+        for _, lease, _ in self.pending:
+            if lease:
+                lease.release()
+        self.pending.clear()
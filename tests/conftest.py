@@ -0,0 +1,4 @@
+import os, sys
+
+# the modules are not a package, they import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
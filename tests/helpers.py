@@ -0,0 +1,168 @@
+import socket
+from types import SimpleNamespace
+
+from h264 import Frame, H264Parser, H264NALU, BitWriter
+from v4l2bufpool import BufferPool
+
+SPS = b'\x27\x64\x00\x2a\xac\x2b\x40\x28\x02\xdd\x00\xf1\x22\x6a'
+PPS = b'\x28\xee\x02\x5c\xb0\x00'
+
+# a pool of fake V4L2 buffers, only the lease counting is used
+def get_pool(count):
+    bufs = [SimpleNamespace(index=i) for i in range(count)]
+    return BufferPool('test', -1, bufs, reserve=0), bufs
+
+# a leased frame like the parser publishes it, the caller holds the capture reference
+def get_frame(pool, buf, keyframe, nalus, timestamp):
+    lease = pool.lease(buf)
+    nalus = [memoryview(nalu) for nalu in nalus]
+    frame = Frame(([SPS, PPS] if keyframe else []) + nalus, H264NALU.SPSTYPE if keyframe else H264NALU.NONIDRTYPE, keyframe, False, timestamp, lease)
+    frame.nalus = [memoryview(nalu) for nalu in frame.nalus]
+    frame.params = (SPS, PPS)
+    return frame
+
+# a Main profile 1280x720 SPS with pic_order_cnt_type 0 (B-frames), 8 bit frame_num and POC lsb
+def get_sps(vui = True):
+    w = BitWriter()
+    w.write_bits(0x67, 8)
+    w.write_bits(77, 8) # profile_idc
+    w.write_bits(0, 8) # constraint flags
+    w.write_bits(40, 8) # level_idc
+    w.write_ue(0) # seq_parameter_set_id
+    w.write_ue(4) # log2_max_frame_num_minus4
+    w.write_ue(0) # pic_order_cnt_type
+    w.write_ue(4) # log2_max_pic_order_cnt_lsb_minus4
+    w.write_ue(2) # max_num_ref_frames
+    w.write_bits(0, 1) # gaps_in_frame_num_value_allowed_flag
+    w.write_ue(79) # pic_width_in_mbs_minus1
+    w.write_ue(44) # pic_height_in_map_units_minus1
+    w.write_bits(0b110, 3) # frame_mbs_only_flag, direct_8x8_inference_flag, frame_cropping_flag
+    w.write_bits(int(vui), 1) # vui_parameters_present_flag
+    if vui:
+        # aspect_ratio, overscan, video_signal_type, chroma_loc
+        w.write_bits(0, 4)
+        w.write_bits(1, 1) # timing_info_present_flag
+        w.write_bits(1, 32) # num_units_in_tick
+        w.write_bits(50, 32) # time_scale: 25 fps
+        w.write_bits(1, 1) # fixed_frame_rate_flag
+        # nal_hrd, vcl_hrd, pic_struct
+        w.write_bits(0, 3)
+        w.write_bits(1, 1) # bitstream_restriction_flag
+        w.write_bits(1, 1) # motion_vectors_over_pic_boundaries_flag
+        w.write_ue(2)
+        w.write_ue(1)
+        w.write_ue(16)
+        w.write_ue(16)
+        w.write_ue(2) # max_num_reorder_frames
+        w.write_ue(3) # max_dec_frame_buffering
+    return w.get_rbsp()
+
+# a Main profile 1920x1080 H265 SPS, the frame rate is in the VUI if fps is given
+def get_h265_sps(sub_layers = 1, fps = 30):
+    w = BitWriter()
+    w.write_bits(0x4201, 16) # NAL unit header
+    w.write_bits(0, 4) # sps_video_parameter_set_id
+    w.write_bits(sub_layers - 1, 3) # sps_max_sub_layers_minus1
+    w.write_bits(1, 1) # sps_temporal_id_nesting_flag
+    # profile_tier_level: space 0, tier Main, profile Main, compatible with Main and Main 10
+    w.write_bits(1, 8)
+    w.write_bits(0x60000000, 32)
+    w.write_bits(0xb0 << 40, 48) # progressive, frame only
+    w.write_bits(93, 8) # level 3.1
+    for _ in range(sub_layers - 1):
+        w.write_bits(0b01, 2) # only the sub-layer level is present
+    if sub_layers > 1:
+        w.write_bits(0, 2 * (9 - sub_layers))
+        for _ in range(sub_layers - 1):
+            w.write_bits(90, 8)
+    w.write_ue(0) # sps_seq_parameter_set_id
+    w.write_ue(1) # chroma_format_idc: 4:2:0
+    w.write_ue(1920)
+    w.write_ue(1088)
+    w.write_bits(1, 1) # conformance_window_flag, 8 lines cropped at the bottom
+    for crop in (0, 0, 0, 4):
+        w.write_ue(crop)
+    w.write_ue(0) # bit_depth_luma_minus8
+    w.write_ue(0) # bit_depth_chroma_minus8
+    w.write_ue(4) # log2_max_pic_order_cnt_lsb_minus4
+    w.write_bits(1, 1) # sps_sub_layer_ordering_info_present_flag
+    for _ in range(sub_layers):
+        w.write_ue(2)
+        w.write_ue(0)
+        w.write_ue(0)
+    for value in (0, 3, 0, 3, 1, 1):
+        w.write_ue(value)
+    # scaling_list, amp, sample_adaptive_offset, pcm
+    w.write_bits(0b0110, 4)
+    # two short-term reference picture sets, the second is predicted from the first
+    w.write_ue(2)
+    w.write_ue(1) # num_negative_pics
+    w.write_ue(0) # num_positive_pics
+    w.write_ue(0) # delta_poc_s0_minus1
+    w.write_bits(1, 1) # used_by_curr_pic_s0_flag
+    w.write_bits(1, 1) # inter_ref_pic_set_prediction_flag
+    w.write_bits(0, 1) # delta_rps_sign
+    w.write_ue(0) # abs_delta_rps_minus1
+    w.write_bits(0b101, 3) # used_by_curr_pic_flag, used_by_curr_pic_flag, use_delta_flag
+    w.write_bits(0, 1) # long_term_ref_pics_present_flag
+    w.write_bits(0b11, 2) # sps_temporal_mvp_enabled_flag, strong_intra_smoothing_enabled_flag
+    w.write_bits(1, 1) # vui_parameters_present_flag
+    # aspect_ratio, overscan, video_signal_type, chroma_loc, neutral_chroma, field_seq, frame_field_info, default_display_window
+    w.write_bits(0, 8)
+    w.write_bits(int(bool(fps)), 1) # vui_timing_info_present_flag
+    if fps:
+        w.write_bits(1, 32) # vui_num_units_in_tick
+        w.write_bits(fps, 32) # vui_time_scale
+        w.write_bits(0, 1) # vui_poc_proportional_to_timing_flag
+        w.write_bits(0, 1) # vui_hrd_parameters_present_flag
+    # bitstream_restriction, sps_extension
+    w.write_bits(0, 2)
+    return w.get_rbsp()
+
+# the slice header until the POC (see FrameOrder.get_offset), slice_type 0: P, 1: B, 2: I
+def get_slice(slice_type, poc_lsb, idr = False, ref = True):
+    w = BitWriter()
+    w.write_bits((0x60 if ref else 0) | (H264NALU.IDRTYPE if idr else H264NALU.NONIDRTYPE), 8)
+    w.write_ue(0) # first_mb_in_slice
+    w.write_ue(slice_type)
+    w.write_ue(0) # pic_parameter_set_id
+    w.write_bits(0, 8) # frame_num
+    if idr:
+        w.write_ue(0) # idr_pic_id
+    w.write_bits(poc_lsb, 8)
+    # the rest of the slice
+    w.write_bits(0xabcdef, 24)
+    return w.get_rbsp()
+
+# writes the nalus into the parser like a capture buffer, returns the published frame,
+# buf: a buffer of the pool, it's leased while the parser writes it like the camera does
+def write_annexb(parser, nalus, timestamp, pool = None, buf = None):
+    data = bytearray(b''.join(H264NALU.DELIMITER + nalu for nalu in nalus))
+    buf = buf or SimpleNamespace()
+    buf.buffer = data
+    buf.bytesused = len(data)
+    buf.timestamp = SimpleNamespace(secs=timestamp // 1000000, usecs=timestamp % 1000000)
+    lease = pool.lease(buf) if pool else None
+    try:
+        parser.write_buf(buf)
+    finally:
+        if lease:
+            lease.release()
+    return parser.ring[(parser.seq - 1) % parser.ring_size]
+
+def get_parser():
+    parser = H264Parser()
+    parser.params = (SPS, PPS)
+    return parser
+
+# reads everything from sock until it would block
+def drain(sock):
+    data = b''
+    while True:
+        try:
+            chunk = sock.recv(1 << 20, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return data
+        if not chunk:
+            return data
+        data += chunk
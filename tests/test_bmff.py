@@ -0,0 +1,30 @@
+import io
+
+import bmff
+
+from helpers import SPS, PPS
+
+NALUS = [b'\x65' + bytes(100), b'\x65' + bytes(300), b'\x65' + bytes(70000)]
+
+def get_legacy(params, nalus, is_idr, cto):
+    mdatsize = bmff.get_mdat_size(params + nalus)
+    w = io.BytesIO()
+    if cto:
+        bmff.write_moof_cto(w, 0, mdatsize, is_idr, 0, 0, cto)
+    else:
+        bmff.write_moof(w, 0, mdatsize, is_idr, 0, 0)
+    bmff.write_mdat(w, params + nalus)
+    return w.getvalue()
+
+def test_fragment_builder_matches_the_boxes():
+    builder = bmff.FragmentBuilder()
+    for params, is_idr, cto in (([SPS, PPS], True, 0), ([], False, 0), ([SPS, PPS], True, -1500), ([], False, 3000)):
+        header, prefixes = builder.build(params, NALUS, is_idr, cto)
+        data = bytes(header) + b''.join(prefix.tobytes() + nalu for prefix, nalu in zip(prefixes, NALUS))
+        assert data == get_legacy(params, NALUS, is_idr, cto)
+
+def test_fragment_builder_packs_the_prefixes_into_one_buffer():
+    header, prefixes = bmff.FragmentBuilder().build([], NALUS, False)
+    assert len(prefixes) == len(NALUS)
+    assert all(isinstance(prefix, memoryview) and prefix.obj is prefixes[0].obj for prefix in prefixes)
+    assert [int.from_bytes(prefix, 'big') for prefix in prefixes] == [len(nalu) for nalu in NALUS]
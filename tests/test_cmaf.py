@@ -0,0 +1,67 @@
+import re
+from types import SimpleNamespace
+
+import dash
+import hls
+from cmaf import CMAFSegmenter
+from h264 import H264Parser
+from mp4writer import FragmentProducer
+
+from helpers import PPS, get_sps, get_slice, write_annexb
+
+P, I = 0, 2
+FRAME = 40000
+TIMESCALE = 90000
+
+def get_segmenter(parser):
+    camera = SimpleNamespace(sleeping=False, request_key_frame=lambda: None)
+    return CMAFSegmenter(parser, FragmentProducer(parser, TIMESCALE), camera, None,
+        1280, 720, 0, TIMESCALE, 0.2, 1, 10)
+
+# 1 second GOPs, sps(i) returns the SPS of the i-th frame
+def write_frames(parser, segmenter, gops, sps = None):
+    mp4_writer = None
+    for i in range(gops * 25):
+        timestamp = 1000000 + i * FRAME
+        if i % 25 == 0:
+            frame = write_annexb(parser, [sps(i) if sps else get_sps(), PPS, get_slice(I, 0, idr=True)], timestamp)
+        else:
+            frame = write_annexb(parser, [get_slice(P, 2 * (i % 25))], timestamp)
+        if mp4_writer is None:
+            mp4_writer = segmenter.start_period(frame.params)
+        elif frame.keyframe and frame.params != mp4_writer.params:
+            mp4_writer = segmenter.start_period(frame.params, mp4_writer)
+        segmenter.add_frame(mp4_writer, frame)
+
+def test_new_params_start_a_discontinuity_and_a_period():
+    parser = H264Parser()
+    segmenter = get_segmenter(parser)
+    write_frames(parser, segmenter, 5, lambda i: get_sps(vui=i < 50))
+
+    segments = list(segmenter.segments)
+    assert [segment.period for segment in segments] == [0, 0, 1, 1, 1]
+    assert segments[0].init != segments[2].init
+    assert segmenter.get_init(0) == segments[0].init and segmenter.get_init(1) == segmenter.init
+    # the timeline continues
+    assert segments[2].start == segments[1].start + segments[1].ticks == segments[2].period_start
+
+    playlist = hls.get_media_playlist(segmenter).decode()
+    assert '#EXT-X-DISCONTINUITY-SEQUENCE:0' in playlist
+    lines = playlist.split('\n')
+    discontinuity = lines.index('#EXT-X-DISCONTINUITY')
+    assert lines[discontinuity + 1] == '#EXT-X-MAP:URI="hls/init1.mp4"'
+    assert lines.index('hls/seg1.mp4') < discontinuity < lines.index('hls/seg2.mp4')
+    assert hls.get_file(segmenter, hls.parse_file_path('/hls/init0.mp4')) == segments[0].init
+
+    mpd = dash.get_mpd(segmenter, 'avc1.4d0028', 1280, 720, 25).decode()
+    assert re.findall(r'<Period id="(\d+)" start="([^"]+)"', mpd) == [('0', 'PT0.000S'), ('1', f'PT{segments[2].start / TIMESCALE:.3f}S')]
+    assert re.findall(r'presentationTimeOffset="(\d+)"', mpd) == ['0', str(segments[2].start)]
+    assert re.findall(r'initialization="([^"]+)"', mpd) == ['dash/init0.mp4', 'dash/init1.mp4']
+    assert dash.parse_file_path('/dash/init1.mp4') == ('init', 1)
+
+def test_same_params_stay_in_one_period():
+    parser = H264Parser()
+    segmenter = get_segmenter(parser)
+    write_frames(parser, segmenter, 3)
+    assert [segment.period for segment in segmenter.segments] == [0, 0, 0]
+    assert '#EXT-X-DISCONTINUITY\n' not in hls.get_media_playlist(segmenter).decode()
@@ -0,0 +1,307 @@
+from types import SimpleNamespace
+
+from h264 import FrameOrder, H264Parser, H264NALU, SPS
+from v4l2camera import CameraSleeper
+
+from helpers import PPS, SPS as CAMERA_SPS, get_pool, get_sps, get_slice, write_annexb
+
+P, B, I = 0, 1, 2
+# 25 fps in the VUI of get_sps
+FRAME = 40000
+
+def write_keyframe(parser, timestamp):
+    return write_annexb(parser, [get_sps(), PPS, get_slice(I, 0, idr=True)], timestamp)
+
+def test_ip_stream_keeps_the_capture_timestamps():
+    parser = H264Parser()
+    timestamps = [1000000, 1041000, 1075000, 1160000, 1190000]
+    frames = [write_keyframe(parser, timestamps[0])]
+    # the third frame was lost, so there is a gap in the POC
+    for timestamp, poc in zip(timestamps[1:], (2, 4, 8, 10)):
+        frames.append(write_annexb(parser, [get_slice(P, poc)], timestamp))
+    assert [frame.dts for frame in frames] == timestamps
+    assert [frame.cto for frame in frames] == [0] * len(frames)
+    assert not parser.frame_order.reordered
+
+def test_b_frames_get_grid_decode_times_until_a_gop_without_them():
+    parser = H264Parser()
+    # decode order I0 P6 B2 B4, display order I0 B2 B4 P6
+    def write_gop(start, b_frames):
+        frames = [write_keyframe(parser, start)]
+        slices = [(P, 6), (B, 2), (B, 4)] if b_frames else [(P, 2), (P, 4), (P, 6)]
+        for i, (slice_type, poc) in enumerate(slices):
+            frames.append(write_annexb(parser, [get_slice(slice_type, poc, ref=slice_type == P)], start + 1000 + i * 33000))
+        return frames
+
+    first = write_gop(1000000, True)
+    # the P frame was before the first B slice, then the stream switched to the grid
+    assert parser.frame_order.reordered
+    assert [frame.cto for frame in first[2:]] == [-FRAME, -FRAME]
+
+    second = write_gop(2000000, True)
+    assert [frame.dts for frame in second] == [2000000 + i * FRAME for i in range(4)]
+    assert [frame.cto for frame in second] == [0, 2 * FRAME, -FRAME, -FRAME]
+    assert [frame.dts + frame.cto for frame in second] == [2000000 + i * FRAME for i in (0, 3, 1, 2)]
+
+    # the previous GOP had B-frames, this one doesn't, so it stays on the grid
+    third = write_gop(3000000, False)
+    assert [frame.dts for frame in third] == [3000000 + i * FRAME for i in range(4)]
+    assert [frame.cto for frame in third] == [0] * 4
+
+    # re-evaluated at the keyframe
+    fourth = write_gop(4000000, False)
+    assert not parser.frame_order.reordered
+    assert [frame.dts for frame in fourth] == [4000000] + [4001000 + i * 33000 for i in range(3)]
+    assert [frame.cto for frame in fourth] == [0] * 4
+
+def test_sleeper_clears_the_stale_gop():
+    pool, bufs = get_pool(4)
+    parser = H264Parser()
+    events = []
+    camera = SimpleNamespace(auto_sleep=True, sleep=lambda: events.append('sleep'), wakeup=lambda: events.append('wakeup'))
+    sleeper = CameraSleeper(camera, parser)
+
+    sleeper.add_client()
+    write_annexb(parser, [get_sps(), PPS, get_slice(I, 0, idr=True)], 1000000, pool, bufs[0])
+    write_annexb(parser, [get_slice(P, 2)], 1040000, pool, bufs[1])
+    reader = parser.reader()
+    assert reader.from_gop
+    reader.close()
+    sleeper.remove_client()
+    # the buffers went back to the driver, the next reader waits for a new frame
+    assert pool.leases == {}
+    reader = parser.reader()
+    assert not reader.from_gop
+    assert reader.read_frame(0) is None
+    reader.close()
+
+    # a keyframe which was on the way when the camera stopped
+    write_annexb(parser, [get_sps(), PPS, get_slice(I, 0, idr=True)], 1080000, pool, bufs[2])
+    sleeper.add_client()
+    assert not parser.reader().from_gop
+    assert events == ['wakeup', 'sleep', 'wakeup']
+
+def is_copied(frame, buf):
+    return frame.avcc.obj is not buf.buffer
+
+def test_gop_frames_out_of_the_ring_are_copied_only_if_the_pool_is_starving():
+    pool, bufs = get_pool(16)
+    pool.reserve = 2
+    parser = H264Parser(ring_size=4)
+    frames = [write_annexb(parser, [get_sps(), PPS, get_slice(I, 0, idr=True)], 1000000, pool, bufs[0])]
+    for i in range(1, 8):
+        frames.append(write_annexb(parser, [get_slice(P, 2 * i)], 1000000 + i * FRAME, pool, bufs[i]))
+    # the whole GOP is still in the capture buffers
+    assert all(frame.lease and not is_copied(frame, buf) for frame, buf in zip(frames, bufs))
+
+    # a new GOP, the old one is not needed anymore, its frames out of the ring go back to the driver without a copy
+    frames.append(write_annexb(parser, [get_sps(), PPS, get_slice(I, 0, idr=True)], 2000000, pool, bufs[8]))
+    assert sorted(pool.leases) == [5, 6, 7, 8]
+    assert not any(is_copied(frame, buf) for frame, buf in zip(frames, bufs))
+
+def test_gop_frames_are_copied_when_the_pool_is_starving():
+    pool, bufs = get_pool(6)
+    pool.reserve = 2
+    parser = H264Parser(ring_size=64)
+    frames = [write_annexb(parser, [get_sps(), PPS, get_slice(I, 0, idr=True)], 1000000, pool, bufs[0])]
+    for i in range(1, 6):
+        frames.append(write_annexb(parser, [get_slice(P, 2 * i)], 1000000 + i * FRAME, pool, bufs[i]))
+    # only the reserve is left to the driver, the oldest frames were copied, the GOP needs them
+    assert sorted(pool.leases) == [2, 3, 4, 5]
+    assert [is_copied(frame, buf) for frame, buf in zip(frames, bufs)] == [True, True, False, False, False, False]
+    reader = parser.reader()
+    assert bytes(reader.read_frame().avcc) == bytes(bufs[0].buffer)
+    reader.close()
+
+AUD = b'\x09\x10'
+SEI = b'\x06\x05\x01\x00\x80'
+
+def test_b_frames_after_an_aud_stop_the_sps_rewrite():
+    parser = H264Parser(rewrite_sps=True)
+    write_annexb(parser, [AUD, get_sps(), PPS, get_slice(I, 0, idr=True)], 1000000)
+    assert parser.sps != parser.sps_source
+    write_annexb(parser, [AUD, SEI, get_slice(P, 4)], 1040000)
+    assert parser.rewrite_sps
+    write_annexb(parser, [AUD, SEI, get_slice(B, 2, ref=False)], 1080000)
+    assert not parser.rewrite_sps
+    # the original SPS from the next keyframe
+    write_annexb(parser, [AUD, get_sps(), PPS, get_slice(I, 0, idr=True)], 1120000)
+    assert parser.params[0] == get_sps()
+
+def write_gop(parser, start, frames = 5, ref = True):
+    published = [write_keyframe(parser, start)]
+    for i in range(1, frames):
+        published.append(write_annexb(parser, [get_slice(P, 2 * i, ref=ref)], start + i * FRAME))
+    return published
+
+def read_all(reader):
+    frames = []
+    while True:
+        frame = reader.read_frame(0)
+        if frame is None:
+            return frames
+        frames.append(frame)
+
+def test_readers_start_with_the_cached_gop():
+    parser = H264Parser()
+    write_gop(parser, 1000000)
+    second = write_gop(parser, 2000000)
+    readers = [parser.reader(), parser.reader()]
+    live = parser.reader(gop=False)
+    assert [reader.from_gop for reader in readers + [live]] == [True, True, False]
+
+    third = write_gop(parser, 3000000, 2)
+    # every reader gets every frame, the cached ones first
+    for reader in readers:
+        assert read_all(reader) == second + third
+    assert read_all(live) == third
+    for reader in readers + [live]:
+        assert reader.dropped == 0
+        reader.close()
+
+def test_reader_out_of_the_ring_skips_to_the_next_keyframe():
+    parser = H264Parser(ring_size=8)
+    write_gop(parser, 1000000)
+    reader = parser.reader()
+    write_gop(parser, 2000000)
+    third = write_gop(parser, 3000000)
+    # the first GOP was overwritten, the rest of the second one is useless without its keyframe
+    assert read_all(reader) == third
+    assert reader.dropped == 10
+    reader.close()
+
+def test_lagging_reader_drops_to_the_next_keyframe():
+    parser = H264Parser()
+    reader = parser.reader(max_lag_frames=4)
+    first = write_gop(parser, 1000000, 6)
+    second = write_gop(parser, 2000000, 2)
+    # 8 frames behind, 4 is the limit: the keyframe is sent, the first P frame is 7 frames behind
+    assert read_all(reader) == [first[0]] + second
+    assert reader.dropped == 5
+    reader.close()
+
+def test_half_full_queue_drops_the_non_reference_frames():
+    parser = H264Parser()
+    reader = parser.reader(max_lag_frames=8)
+    first = write_gop(parser, 1000000, 6, ref=False)
+    assert all(frame.droppable for frame in first[1:])
+    # 5 and 4 frames behind are at least the half of the limit, the later ones are not
+    assert read_all(reader) == [first[0]] + first[3:]
+    assert reader.dropped == 2
+    reader.close()
+
+def test_cached_gop_burst_does_not_count_as_lag():
+    parser = H264Parser()
+    first = write_gop(parser, 1000000, 10)
+    reader = parser.reader(max_lag_frames=4)
+    assert read_all(reader) == first
+    assert reader.dropped == 0
+    reader.close()
+
+def test_keyframes_only_reader():
+    parser = H264Parser()
+    reader = parser.reader(keyframes_only=True)
+    gops = [write_gop(parser, start) for start in (1000000, 2000000, 3000000)]
+    assert read_all(reader) == [gop[0] for gop in gops]
+    assert reader.dropped == 0
+    reader.close()
+
+def to_avcc(nalus):
+    return b''.join(len(nalu).to_bytes(4, 'big') + nalu for nalu in nalus)
+
+def test_writable_buffer_is_converted_to_avcc_in_place():
+    parser = H264Parser()
+    nalus = [get_sps(), PPS, get_slice(I, 0, idr=True)]
+    buf = SimpleNamespace()
+    frame = write_annexb(parser, nalus, 1000000, buf=buf)
+    assert bytes(frame.avcc) == to_avcc(nalus) == bytes(buf.buffer)
+    # the NALUs are views of the capture buffer between the length prefixes
+    assert all(nalu.obj is buf.buffer for nalu in frame.nalus + [frame.avcc])
+    assert [bytes(nalu) for nalu in frame.nalus] == nalus
+
+def test_read_only_buffer_is_not_converted():
+    parser = H264Parser()
+    nalus = [get_sps(), PPS, get_slice(I, 0, idr=True)]
+    data = b''.join(H264NALU.DELIMITER + nalu for nalu in nalus)
+    buf = SimpleNamespace(buffer=data, bytesused=len(data), timestamp=SimpleNamespace(secs=1, usecs=0))
+    parser.write_buf(buf)
+    frame = parser.get_frame(0)
+    assert frame.avcc is None
+    assert [bytes(nalu) for nalu in frame.nalus] == nalus
+
+def test_rewritten_sps_is_not_sent_from_the_capture_buffer():
+    parser = H264Parser(rewrite_sps=True)
+    nalus = [get_sps(), PPS, get_slice(I, 0, idr=True)]
+    frame = write_annexb(parser, nalus, 1000000)
+    # the rewritten SPS is longer, it can't be in the capture buffer
+    assert frame.avcc is None
+    assert bytes(frame.nalus[0]) == parser.sps != nalus[0]
+    assert bytes(frame.nalus[2]) == nalus[2]
+
+def test_sps_stream_info():
+    info = SPS(get_sps())
+    assert (info.width, info.height, info.fps) == (1280, 720, 25)
+    assert info.codec() == 'avc1.4d0028'
+    assert (info.pic_order_cnt_type, info.log2_max_frame_num, info.log2_max_pic_order_cnt_lsb) == (0, 8, 8)
+    assert (info.max_num_reorder_frames, info.max_dec_frame_buffering) == (2, 3)
+
+    # a High profile camera SPS with a VUI without timing info
+    info = SPS(CAMERA_SPS)
+    assert (info.width, info.height, info.fps) == (1280, 720, None)
+    assert info.codec() == 'avc1.64002a'
+    assert info.max_num_reorder_frames == 0
+
+def test_set_zero_reorder_keeps_the_rest_of_the_sps():
+    nalu = get_sps()
+    info = SPS(nalu)
+    rewritten = SPS(info.set_zero_reorder(nalu))
+    assert rewritten.max_num_reorder_frames == 0
+    for name in ('profile_idc', 'level_idc', 'width', 'height', 'fps', 'pic_order_cnt_type', 'max_num_ref_frames',
+        'bitstream_restriction', 'max_dec_frame_buffering'):
+        assert getattr(rewritten, name) == getattr(info, name)
+    # it's already so
+    assert rewritten.set_zero_reorder(info.set_zero_reorder(nalu)) is None
+
+def test_set_zero_reorder_adds_the_vui():
+    nalu = get_sps(vui=False)
+    info = SPS(nalu)
+    assert not info.vui_parameters_present and info.max_num_reorder_frames is None
+    rewritten = SPS(info.set_zero_reorder(nalu))
+    assert rewritten.vui_parameters_present
+    assert (rewritten.width, rewritten.height, rewritten.fps) == (1280, 720, None)
+    assert (rewritten.max_num_reorder_frames, rewritten.max_dec_frame_buffering) == (0, info.max_num_ref_frames)
+    assert rewritten.bitstream_restriction == (True, 2, 1, 15, 15)
+
+def test_poc_offsets_continue_after_the_lsb_wraps():
+    sps = SPS(get_sps())
+    order = FrameOrder()
+    assert order.get_offset(sps, get_slice(I, 0, idr=True), True) == 0
+    offsets = []
+    # I P B B P B B ..., the 8 bit POC lsb wraps around at 256
+    for i in range(60):
+        anchor = 6 * (i + 1)
+        for slice_type, poc in ((P, anchor), (B, anchor - 4), (B, anchor - 2)):
+            offsets.append(order.get_offset(sps, get_slice(slice_type, poc % 256, ref=slice_type == P), False))
+    assert offsets == [2, -1, -1] * 60
+    assert order.reordered
+
+def annexb(nalus):
+    return b''.join(H264NALU.DELIMITER + nalu for nalu in nalus)
+
+def test_raw_stream_starts_with_the_parameter_sets_and_an_idr():
+    parser = H264Parser()
+    idr = get_slice(I, 0, idr=True)
+    write_keyframe(parser, 1000000)
+    write_annexb(parser, [get_slice(P, 2)], 1040000)
+    reader = parser.reader()
+    frames = read_all(reader)
+    assert b''.join(parser.get_annexb(frames[0], True)) == annexb([get_sps(), PPS, idr])
+    assert b''.join(parser.get_annexb(frames[1], False)) == annexb([get_slice(P, 2)])
+
+    # an IDR frame without the parameter sets gets them only at the start of the stream
+    write_annexb(parser, [idr], 2000000)
+    frame = read_all(reader)[0]
+    assert frame.keyframe
+    assert b''.join(parser.get_annexb(frame, True)) == annexb([get_sps(), PPS, idr])
+    assert b''.join(parser.get_annexb(frame, False)) == annexb([idr])
+    reader.close()
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+from h265 import H265SPS, H265Parser, H265NALU
+from mp4writer import get_init_segment
+from relay import find_box, get_boxes, parse_hvcc
+
+from helpers import get_h265_sps
+
+VPS = b'\x40\x01\x0c\x01\xff\xff\x01\x60\x00\x00\x03\x00\xb0\x00\x00\x03\x00\x00\x03\x00\x5d\xac\x09'
+PPS = b'\x44\x01\xc1\x72\xb4\x62\x40'
+HVCC_HEADER = bytes.fromhex('01 01 60000000 b00000000000 5d f000 fc fd f8 f8 0000 0f')
+
+def test_h265_sps_stream_info():
+    info = H265SPS(get_h265_sps())
+    assert (info.width, info.height, info.fps) == (1920, 1080, 30)
+    assert (info.bit_depth_luma, info.bit_depth_chroma, info.max_sub_layers) == (8, 8, 1)
+    assert info.codec() == 'hvc1.1.6.L93.B0'
+    assert info.get_hvcc_header() == HVCC_HEADER
+
+def test_h265_sps_with_sub_layers():
+    info = H265SPS(get_h265_sps(sub_layers=3, fps=25))
+    assert (info.width, info.height, info.fps) == (1920, 1080, 25)
+    # numTemporalLayers: 3, temporalIdNested, lengthSizeMinusOne: 3
+    assert info.get_hvcc_header() == HVCC_HEADER[:-1] + b'\x1f'
+    # without timing info in the VUI
+    assert H265SPS(get_h265_sps(fps=0)).fps is None
+
+def test_hvcc_init_segment():
+    sps = get_h265_sps()
+    moov = dict(get_boxes(get_init_segment(640, 480, 0, 90000, (VPS, sps, PPS))))[b'moov']
+    stsd = find_box(moov, (b'trak', b'mdia', b'minf', b'stbl', b'stsd'))
+    # version, flags, entry_count, then the sample entry
+    assert stsd[12:16] == b'hvc1'
+    hvcc = find_box(stsd[16 + 78:], (b'hvcC',))
+    assert hvcc[:len(HVCC_HEADER)] == HVCC_HEADER
+    assert parse_hvcc(hvcc) == (VPS, sps, PPS)
+    # the frame size comes from the SPS
+    tkhd = find_box(moov, (b'trak', b'tkhd'))
+    # 16.16 fixed point
+    assert (int.from_bytes(tkhd[-8:-6], 'big'), int.from_bytes(tkhd[-4:-2], 'big')) == (1920, 1080)
+
+def test_h265_parser_keyframes_and_droppable_frames():
+    parser = H265Parser()
+    sps = get_h265_sps()
+    frames = []
+    # IDR_W_RADL with the parameter sets, TRAIL_R, TRAIL_N
+    for i, nalus in enumerate([[VPS, sps, PPS, b'\x26\x01' + bytes(50)], [b'\x02\x01' + bytes(20)], [b'\x00\x01' + bytes(20)]]):
+        data = bytearray(b''.join(H265NALU.DELIMITER + nalu for nalu in nalus))
+        parser.write_buf(SimpleNamespace(buffer=data, bytesused=len(data), timestamp=SimpleNamespace(secs=1, usecs=i * 33333)))
+        frames.append(parser.get_frame(i))
+    assert parser.params == (VPS, sps, PPS)
+    assert parser.sps_info.codec() == 'hvc1.1.6.L93.B0'
+    assert [frame.keyframe for frame in frames] == [True, False, False]
+    assert [frame.droppable for frame in frames] == [False, False, True]
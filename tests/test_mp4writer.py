@@ -0,0 +1,230 @@
+import asyncio, io, socket, struct, time
+from threading import Thread
+from types import SimpleNamespace
+
+import pytest
+
+from asyncserver import AsyncRequestHandler
+from h264 import H264Parser
+from mp4writer import MP4Writer, FragmentProducer
+from relay import get_boxes, find_box
+from sockwriter import SocketWriter, IOV_MAX
+from helpers import PPS, get_pool, get_frame, get_parser, get_sps, get_slice, write_annexb, drain
+
+TIMESCALE = 15000
+
+def get_frames(pool, bufs, slices = 1, size = 100):
+    frames = []
+    for i, buf in enumerate(bufs):
+        nalus = [bytes([0x65 if i == 0 else 0x41]) + bytes(size)] * slices
+        frames.append(get_frame(pool, buf, i == 0, nalus, i * 33333))
+    return frames
+
+# writes the frames into one multi-sample fragment, then drops the capture references
+def write_fragment(writer, frames):
+    producer = FragmentProducer(get_parser(), TIMESCALE)
+    mp4_writer = MP4Writer(writer, 640, 480, 0, TIMESCALE, frames[0].params, len(frames))
+    for frame in frames:
+        mp4_writer.write_frame(frame, producer.get_fragment(frame))
+    mp4_writer.close()
+    for frame in frames:
+        frame.drop()
+
+def test_frame_group_holders_are_independent():
+    pool, bufs = get_pool(4)
+    frames = get_frames(pool, bufs)
+    producer = FragmentProducer(get_parser(), TIMESCALE)
+    holders = []
+
+    class Writer:
+        def write(self, data):
+            pass
+
+        def writev(self, bufs, frame = None):
+            # the writer keeps the buffers until a later send
+            holders.append(frame.acquire())
+
+    write_fragment(Writer(), frames)
+    assert [pool.leases[buf.index].refs for buf in bufs] == [1, 1, 1, 1]
+    for holder in holders:
+        holder.release()
+    assert pool.leases == {}
+
+def test_async_writer_releases_multisample_leases():
+    pool, bufs = get_pool(4)
+    # bigger than the socket buffer, so the fragment is sent in several flushes
+    frames = get_frames(pool, bufs, size=1 << 20)
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    server = SimpleNamespace(loop=asyncio.new_event_loop(), streams=set(), waiters=set())
+    try:
+        handler = AsyncRequestHandler(server, a, ('test', 0))
+        write_fragment(handler, frames)
+        assert handler.wbufs and handler.wleases
+        received = b''
+        while handler.wbufs:
+            received += drain(b)
+            handler.on_writable()
+        received += drain(b)
+        assert len(received) > 4 << 20
+        assert pool.leases == {}
+    finally:
+        a.close()
+        b.close()
+        server.loop.close()
+
+def test_zerocopy_writer_releases_multisample_leases():
+    listener = socket.create_server(('127.0.0.1', 0))
+    sock = socket.create_connection(listener.getsockname())
+    peer, _ = listener.accept()
+    pool, bufs = get_pool(4)
+    frames = get_frames(pool, bufs, size=32768)
+    try:
+        writer = SocketWriter(sock, zerocopy=True)
+        if not writer.zerocopy:
+            pytest.skip('MSG_ZEROCOPY is not supported')
+        write_fragment(writer, frames)
+        deadline = time.monotonic() + 5
+        while writer.pending and time.monotonic() < deadline:
+            drain(peer)
+            writer.reap_completions(False)
+        assert not writer.pending
+        assert pool.leases == {}
+    finally:
+        sock.close()
+        peer.close()
+        listener.close()
+
+def test_writev_over_iov_max():
+    pool, bufs = get_pool(4)
+    # every sample has 1 + 2 x slices buffers
+    frames = get_frames(pool, bufs, slices=IOV_MAX // 2)
+    a, b = socket.socketpair()
+    received = []
+
+    def receive():
+        while True:
+            chunk = b.recv(1 << 20)
+            if not chunk:
+                break
+            received.append(chunk)
+
+    receiver = Thread(target=receive)
+    receiver.start()
+    try:
+        write_fragment(SocketWriter(a), frames)
+        a.shutdown(socket.SHUT_WR)
+        receiver.join()
+        assert sum(len(chunk) for chunk in received) > 4 * (IOV_MAX // 2) * 105
+        assert pool.leases == {}
+    finally:
+        a.close()
+        b.close()
+
+def test_new_params_end_the_stream():
+    pool, bufs = get_pool(4)
+    frames = get_frames(pool, bufs[:2])
+    keyframes = [get_frame(pool, buf, True, [b'\x65' + bytes(100)], (i + 2) * 33333) for i, buf in enumerate(bufs[2:])]
+    # the same parameter sets in a new tuple, then a new PPS
+    keyframes[0].params = tuple(bytes(param) for param in frames[0].params)
+    keyframes[1].params = (frames[0].params[0], b'\x28\xee\x3c\x80')
+    producer = FragmentProducer(get_parser(), TIMESCALE)
+    out = []
+
+    class Writer:
+        def write(self, data):
+            out.append(bytes(data))
+
+        def writev(self, bufs, frame = None):
+            out.append(b''.join(bufs))
+
+    mp4_writer = MP4Writer(Writer(), 640, 480, 0, TIMESCALE, frames[0].params)
+    for frame in frames + keyframes[:1]:
+        mp4_writer.write_frame(frame, producer.get_fragment(frame))
+    with pytest.raises(ValueError):
+        mp4_writer.write_frame(keyframes[1], producer.get_fragment(keyframes[1]))
+    # only the first init segment, the client gets the new one when it reconnects
+    assert len(out) == 4
+    assert sum(b'moov' in data for data in out) == 1
+    for frame in frames + keyframes:
+        frame.drop()
+
+# the in-place AVCC frames are sent as one buffer, the output is the same
+def test_avcc_frames_are_muxed_like_the_annexb_ones():
+    outputs = []
+    for inplace in (True, False):
+        parser = H264Parser()
+        producer = FragmentProducer(parser, TIMESCALE)
+        out = []
+
+        class Writer:
+            def write(self, data):
+                out.append(bytes(data))
+
+            def writev(self, bufs, frame = None):
+                out.append(b''.join(bufs))
+
+        mp4_writer = None
+        for i, nalus in enumerate([[get_sps(), PPS, get_slice(2, 0, idr=True)], [get_slice(0, 2)], [get_slice(0, 4)]]):
+            frame = write_annexb(parser, nalus, 1000000 + i * 40000)
+            if not inplace:
+                frame.avcc = None
+            assert (frame.avcc is not None) == inplace
+            if mp4_writer is None:
+                mp4_writer = MP4Writer(Writer(), 640, 480, 0, TIMESCALE, parser.params)
+            mp4_writer.write_frame(frame, producer.get_fragment(frame))
+        outputs.append(out)
+    assert outputs[0] == outputs[1]
+
+# returns the (version, [(duration, cto)]) of the trun of every moof
+def get_truns(data):
+    truns = []
+    for boxtype, payload in get_boxes(data):
+        if boxtype != b'moof':
+            continue
+        trun = find_box(payload, (b'traf', b'trun'))
+        flags, count = struct.unpack_from('>I I', trun)
+        if flags & 0x4:
+            # one sample with the first sample flags: duration, size and the cto if it's there
+            duration, _, cto = struct.unpack_from('>I I i', trun + bytes(4), 16)
+            samples = [(duration, cto if flags & 0x800 else 0)]
+        else:
+            # duration, size, flags, cto of every sample
+            samples = [struct.unpack_from('>I 8x i', trun, 12 + 16 * i) for i in range(count)]
+        truns.append((flags >> 24, samples))
+    return truns
+
+# decode order I0 P6 B2 B4, the second GOP is on the frame rate grid (see test_h264)
+def test_b_frames_get_signed_composition_time_offsets():
+    for fragment_frames in (1, 4):
+        parser = H264Parser()
+        producer = FragmentProducer(parser, 90000)
+        out = io.BytesIO()
+
+        class Writer:
+            def write(self, data):
+                out.write(data)
+
+            def writev(self, bufs, frame = None):
+                for buf in bufs:
+                    out.write(buf)
+
+        mp4_writer = None
+        for gop in range(2):
+            for i, (slice_type, poc) in enumerate([(2, 0), (0, 6), (1, 2), (1, 4)]):
+                nalus = [get_sps(), PPS, get_slice(2, 0, idr=True)] if i == 0 else [get_slice(slice_type, poc, ref=slice_type == 0)]
+                frame = write_annexb(parser, nalus, 1000000 * (gop + 1) + i * 40000)
+                if mp4_writer is None:
+                    mp4_writer = MP4Writer(Writer(), 640, 480, 0, 90000, parser.params, fragment_frames)
+                mp4_writer.write_frame(frame, producer.get_fragment(frame))
+        truns = get_truns(out.getvalue())
+        # 40 ms is 3600 ticks
+        if fragment_frames == 1:
+            assert [version for version, samples in truns[4:]] == [0, 1, 1, 1]
+            assert [samples[0][1] for version, samples in truns[4:]] == [0, 7200, -3600, -3600]
+            assert [samples[0][0] for version, samples in truns[5:]] == [3600] * 3
+        else:
+            version, samples = truns[1]
+            assert version == 1
+            assert [cto for duration, cto in samples] == [0, 7200, -3600, -3600]
+            assert [duration for duration, cto in samples[1:]] == [3600] * 3
@@ -0,0 +1,78 @@
+import io
+
+import relay
+from h264 import H264Parser, H264NALU
+from mp4writer import MP4Writer, FragmentProducer
+from relay import Upstream, RelaySource
+
+from helpers import PPS, get_sps, get_slice, write_annexb
+
+P, I = 0, 2
+TIMESCALE = 90000
+
+# a stream.mp4 of the frames like an upstream fmp4streamer sends it
+def get_stream(nalus, timestamps, fragment_frames = 1):
+    parser = H264Parser()
+    producer = FragmentProducer(parser, TIMESCALE)
+    out = io.BytesIO()
+
+    class Writer:
+        def write(self, data):
+            out.write(data)
+
+        def writev(self, bufs, frame = None):
+            for buf in bufs:
+                out.write(buf)
+
+    mp4_writer = None
+    for frame_nalus, timestamp in zip(nalus, timestamps):
+        frame = write_annexb(parser, frame_nalus, timestamp)
+        if mp4_writer is None:
+            mp4_writer = MP4Writer(Writer(), 1280, 720, 0, TIMESCALE, parser.params, fragment_frames)
+        mp4_writer.write_frame(frame, producer.get_fragment(frame))
+    return out.getvalue()
+
+def get_upstream(monkeypatch, data):
+    monkeypatch.setattr(relay, 'urlopen', lambda url, timeout: io.BytesIO(data))
+    return Upstream('http://upstream/stream.mp4')
+
+# the pipe of the RelaySource, it keeps the timestamps and the frames
+class Pipe:
+    def __init__(self):
+        self.frames = []
+
+    def write_buf(self, buf):
+        self.frames.append((buf.timestamp.secs * 1000000 + buf.timestamp.usecs, bytes(buf.buffer)))
+
+def relay_frames(upstream):
+    pipe = Pipe()
+    source = RelaySource(upstream, pipe, False)
+    try:
+        source.relay(upstream)
+    except EOFError:
+        pass
+    return pipe.frames
+
+def test_first_sample_keeps_its_duration(monkeypatch):
+    nalus = [[get_sps(), PPS, get_slice(I, 0, idr=True)]] + [[get_slice(P, 2 * i)] for i in range(1, 5)]
+    timestamps = [1000000, 1040000, 1080000, 1120000, 1160000]
+    frames = relay_frames(get_upstream(monkeypatch, get_stream(nalus, timestamps)))
+    assert len(frames) == len(timestamps)
+    # the upstream's first sample is only 1 tick long, the relayed one is a frame long
+    assert [b[0] - a[0] for a, b in zip(frames, frames[1:])] == [40000] * 4
+
+def test_demuxed_frames_are_the_muxed_ones(monkeypatch):
+    nalus = []
+    for gop in range(3):
+        nalus.append([get_sps(), PPS, get_slice(I, 0, idr=True) + bytes(3000)])
+        nalus += [[get_slice(P, 2 * i) + bytes(i * 100)] for i in range(1, 10)]
+    timestamps = [1000000 + i * 40000 for i in range(len(nalus))]
+    annexb = [b''.join(H264NALU.DELIMITER + nalu for nalu in frame) for frame in nalus]
+    for fragment_frames in (1, 4):
+        upstream = get_upstream(monkeypatch, get_stream(nalus, timestamps, fragment_frames))
+        assert upstream.video_format() == 'H264'
+        assert (upstream.timescale, upstream.params) == (TIMESCALE, (get_sps(), PPS))
+        frames = relay_frames(upstream)
+        # a multi-sample fragment is sent when it's full
+        assert [frame for timestamp, frame in frames] == annexb[:len(annexb) // fragment_frames * fragment_frames]
+        assert [b[0] - a[0] for a, b in zip(frames, frames[1:])] == [40000] * (len(frames) - 1)
@@ -0,0 +1,60 @@
+import socket, struct
+from threading import Lock, Thread
+from types import SimpleNamespace
+
+from h264 import H264NALU
+from rtsp import RTSPSession, MAX_PAYLOAD
+from sockwriter import SocketWriter, IOV_MAX
+
+# reassembles the NALUs from the interleaved FU-A packets
+def depacketize(data):
+    nalus = []
+    fu = None
+    markers = 0
+    while data:
+        assert data[0:1] == b'$'
+        size = struct.unpack_from('>H', data, 2)[0]
+        packet = data[4 : 4 + size]
+        data = data[4 + size:]
+        markers += packet[1] >> 7
+        payload = packet[12:]
+        if payload[0] & 0x1f == 28:
+            if payload[1] & 0x80:
+                fu = bytes([payload[0] & 0xe0 | payload[1] & 0x1f])
+            fu += payload[2:]
+            if payload[1] & 0x40:
+                nalus.append(fu)
+        else:
+            nalus.append(payload)
+    return nalus, markers
+
+def test_tcp_interleaved_large_keyframe():
+    a, b = socket.socketpair()
+    received = []
+
+    def receive():
+        while True:
+            chunk = b.recv(1 << 20)
+            if not chunk:
+                break
+            received.append(chunk)
+
+    receiver = Thread(target=receive)
+    receiver.start()
+    try:
+        server = SimpleNamespace(parser=SimpleNamespace(NALU=H264NALU), camera=None, sleeper=None, max_lag_frames=0, max_lag_bytes=0)
+        session = RTSPSession(server, ('tcp', SocketWriter(a), Lock(), 0, 1))
+        idr = b'\x65' + bytes(range(256)) * 1200
+        packets = session.packetizer.packetize([memoryview(idr)], 0)
+        # every FU-A packet has 4 buffers and the interleaved header
+        assert len(packets) * 5 > IOV_MAX
+        session.send(packets)
+        a.shutdown(socket.SHUT_WR)
+        receiver.join()
+        nalus, markers = depacketize(b''.join(received))
+        assert nalus == [idr]
+        assert markers == 1
+        assert len(packets) == -(-(len(idr) - 1) // (MAX_PAYLOAD - 2))
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import v4l2bufpool
+from v4l2bufpool import BufferPool
+
+def get_queueing_pool(monkeypatch, count, reserve = 2):
+    queued = []
+    monkeypatch.setattr(v4l2bufpool, 'ioctl', lambda fd, request, buf: queued.append(buf.index))
+    bufs = [SimpleNamespace(index=i) for i in range(count)]
+    return BufferPool('test', -1, bufs, reserve), bufs, queued
+
+def test_buffer_is_queued_after_the_last_release(monkeypatch):
+    pool, bufs, queued = get_queueing_pool(monkeypatch, 4)
+    released = []
+    pool.on_release = lambda: released.append(list(pool.leases))
+    pool.start()
+    assert queued == [0, 1, 2, 3] and pool.queued == 4
+
+    # the capture thread dequeued the buffer, two clients are sending it
+    lease = pool.lease(bufs[0])
+    assert pool.queued == 3
+    clients = [lease.acquire(), lease.acquire()]
+    lease.release()
+    clients[0].release()
+    pool.queue_free()
+    # it is still being sent
+    assert queued == [0, 1, 2, 3] and released == []
+
+    clients[1].release()
+    assert released == [[]]
+    assert pool.free == [bufs[0]]
+    pool.queue_free()
+    assert queued == [0, 1, 2, 3, 0] and pool.queued == 4
+
+def test_buffers_are_queued_in_release_order(monkeypatch):
+    pool, bufs, queued = get_queueing_pool(monkeypatch, 4)
+    pool.start()
+    queued.clear()
+    leases = [pool.lease(buf) for buf in bufs[:3]]
+    for i in (2, 0, 1):
+        leases[i].release()
+    pool.queue_free()
+    assert queued == [2, 0, 1]
+
+def test_leased_buffers_are_not_queued_after_streamon(monkeypatch):
+    pool, bufs, queued = get_queueing_pool(monkeypatch, 4)
+    pool.start()
+    lease = pool.lease(bufs[1])
+    # e.g. the camera woke up, a client still sends the buffer of the last frame
+    queued.clear()
+    pool.start()
+    assert queued == [0, 2, 3] and pool.queued == 3
+    assert not pool.starving()
+    pool.reserve = 4
+    assert pool.starving()
+    lease.release()
+    assert not pool.starving()
@@ -0,0 +1,82 @@
+from fcntl import ioctl
+from threading import Condition
+
+import v4l2
+
+# A dequeued capture buffer is leased to its consumers and it is queued back
+# to the driver only when the last holder released it
+class BufferLease:
+    __slots__ = ('pool', 'buf', 'refs')
+
+    def __init__(self, pool, buf):
+        self.pool = pool
+        self.buf = buf
+        self.refs = 1
+
+    def acquire(self):
+        with self.pool.condition:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.pool.condition:
+            self.refs -= 1
+            if self.refs == 0:
+                self.pool.release_buf(self.buf)
+
+
+class BufferPool:
+    def __init__(self, device, fd, bufs, reserve = 2):
+        self.device = device
+        self.fd = fd
+        self.bufs = bufs
+        # keep at least this many buffers for the driver, consumers should copy the frames below this
+        self.reserve = reserve
+        self.condition = Condition()
+        self.leases = {}
+        self.free = []
+        self.queued = 0
+        # called when a buffer could be queued again, see V4L2Engine
+        self.on_release = None
+
+    # queue every buffer which is not leased, call it after every VIDIOC_STREAMON
+    def start(self):
+        with self.condition:
+            self.queued = 0
+            self.free = [buf for buf in self.bufs if buf.index not in self.leases]
+        self.queue_free()
+
+    def queue_free(self):
+        with self.condition:
+            free = self.free
+            self.free = []
+        for buf in free:
+            ioctl(self.fd, v4l2.VIDIOC_QBUF, buf)
+        with self.condition:
+            self.queued += len(free)
+
+    # waits until there is a buffer in the driver (or it could be queued), returns False on timeout
+    def wait_buffer(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.queued > 0 or len(self.free) > 0, timeout)
+
+    # call it right after VIDIOC_DQBUF
+    def lease(self, buf):
+        with self.condition:
+            self.queued -= 1
+            lease = BufferLease(self, buf)
+            self.leases[buf.index] = lease
+            buf.lease = lease
+            return lease
+
+    def release_buf(self, buf):
+        # called with the condition held
+        del self.leases[buf.index]
+        self.free.append(buf)
+        self.condition.notify_all()
+        if self.on_release:
+            self.on_release()
+
+    def starving(self):
+        with self.condition:
+            return len(self.bufs) - len(self.leases) < self.reserve
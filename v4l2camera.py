@@ -5,6 +5,8 @@ import mmap, os, struct, logging, sys
 import v4l2
 from v4l2ctrls import V4L2Ctrls
 from v4l2m2m import V4L2M2M
+from v4l2bufpool import BufferPool
+from v4l2engine import V4L2Engine
 from uvcxh264 import H264Ctrls
 from uvcxlogitech import LogitechCtrls
 
@@ -30,6 +32,10 @@ class V4L2Camera(Thread):
         fps = int(params.get('fps'))
         capture_format = params.get('capture_format', 'H264')
         self.auto_sleep = config.getboolean(device, 'auto_sleep', fallback=True)
+        engine = params.get('engine', 'threads')
+        if engine not in ['threads', 'epoll']:
+            logging.error(f'{self.device}: unknown engine: {engine}, use threads or epoll')
+            sys.exit(3)
 
         if capture_format == 'MJPGH264':
             params['uvcx_h264_stream_mux'] = 'H264'
@@ -60,6 +66,10 @@ class V4L2Camera(Thread):
         encoder = params.get('encoder')
         encoder_input_format = params.get('encoder_input_format', 'NV12' if decoder else capture_format)
         encoder_memory = params.get('encoder_memory', 'MMAP-MMAP')
+        encoder_format = params.get('encoder_format', 'H264')
+        if encoder_format not in ['H264', 'HEVC']:
+            logging.error(f'{self.device}: unknown encoder_format: {encoder_format}, use H264 or HEVC')
+            sys.exit(3)
 
 
         capture_memory = params.get('capture_memory', 'DMABUF' if encoder or decoder else 'MMAP')
@@ -68,7 +78,7 @@ class V4L2Camera(Thread):
 
         if encoder:
             encoderparams = dict(config.items(encoder) if encoder in config else {})
-            self.encoder = V4L2M2M(encoder, self.pipe, encoderparams, width, height, encoder_input_format, 'H264', encoder_memory)
+            self.encoder = V4L2M2M(encoder, self.pipe, encoderparams, width, height, encoder_input_format, encoder_format, encoder_memory)
             self.pipe = self.encoder
 
         if decoder:
@@ -77,8 +87,8 @@ class V4L2Camera(Thread):
             self.decoder = V4L2M2M(decoder, self.encoder, decoderparams, width, height, decoder_input_format, encoder_input_format, decoder_memory, camera_sizeimage)
             self.pipe = self.decoder
 
-        if capture_format not in ['H264', 'MJPGH264'] and not self.encoder:
-            logging.error(f'{self.device}: capture format is not H264 or MJPGH264, please add the V4L2 M2M encoder (or decoder) devices to the config')
+        if capture_format not in ['H264', 'MJPGH264', 'HEVC'] and not self.encoder:
+            logging.error(f'{self.device}: capture format is not H264, MJPGH264 or HEVC, please add the V4L2 M2M encoder (or decoder) devices to the config')
             sys.exit(3)
 
         if capture_format == 'MJPGH264':
@@ -91,6 +101,11 @@ class V4L2Camera(Thread):
 
         self.init_buffers(capture_memory)
         self.connect_buffers()
+        self.bufpool = BufferPool(self.device, self.fd, self.cap_bufs)
+
+        self.qbuf = v4l2.v4l2_buffer()
+        self.qbuf.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        self.qbuf.memory = self.cap_bufs[0].memory
 
         def check_buffers(elem):
             if not hasattr(elem.pipe, 'input_bufs'):
@@ -104,6 +119,12 @@ class V4L2Camera(Thread):
             check_buffers(elem.pipe)
         check_buffers(self)
 
+        # one thread for the whole chain instead of one per device
+        self.engine = None
+        if engine == 'epoll':
+            os.set_blocking(self.fd, False)
+            self.engine = V4L2Engine(self, [e for e in [self.decoder, self.encoder] if e])
+
 
 
     def init_device(self, width, height, capture_format):
@@ -240,47 +261,64 @@ class V4L2Camera(Thread):
             print()
 
     def capture_loop(self):
-        for buf in self.cap_bufs:
-            ioctl(self.fd, v4l2.VIDIOC_QBUF, buf)
+        while not self.stopped and not self.sleeping:
+            # queue back the buffers which were released by the consumers
+            self.bufpool.queue_free()
+            if not self.bufpool.wait_buffer(0.1):
+                continue
 
-        qbuf = v4l2.v4l2_buffer()
-        qbuf.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
-        qbuf.memory = self.cap_bufs[0].memory
+            self.capture_step()
 
-        while not self.stopped and not self.sleeping:
+    # dequeues and processes one frame, it returns without a frame if the fd is non-blocking
+    def capture_step(self, events = 0):
+        qbuf = self.qbuf
+        try:
             ioctl(self.fd, v4l2.VIDIOC_DQBUF, qbuf)
+        except BlockingIOError:
+            return
 
-            buf = self.cap_bufs[qbuf.index]
-            buf.bytesused = qbuf.bytesused
-            buf.timestamp = qbuf.timestamp
+        buf = self.cap_bufs[qbuf.index]
+        buf.bytesused = qbuf.bytesused
+        buf.timestamp = qbuf.timestamp
 
+        lease = self.bufpool.lease(buf)
+        try:
             self.pipe.write_buf(buf)
-
-            ioctl(self.fd, v4l2.VIDIOC_QBUF, buf)
-
-
+        finally:
+            lease.release()
 
     def start_capturing(self):
         while not self.stopped:
-            # we have to setup the h264 ctrls before every streamon
-            self.h264_ctrls.refresh_ctrls()
-            ioctl(self.fd, v4l2.VIDIOC_STREAMON, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE))
+            self.streamon()
             self.capture_loop()
-            ioctl(self.fd, v4l2.VIDIOC_STREAMOFF, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE))
+            self.streamoff()
             with self.condition:
                 while self.sleeping and not self.stopped:            
                     self.condition.wait()
 
+    def streamon(self):
+        # we have to setup the h264 ctrls before every streamon
+        self.h264_ctrls.refresh_ctrls()
+        ioctl(self.fd, v4l2.VIDIOC_STREAMON, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        self.bufpool.start()
+
+    def streamoff(self):
+        ioctl(self.fd, v4l2.VIDIOC_STREAMOFF, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE))
+
     def stop_capturing(self):
         with self.condition:
             self.stopped = True
             self.condition.notify_all()
+        if self.engine:
+            self.engine.wakeup()
         
 
     def sleep(self):
         if not self.auto_sleep:
             return
         self.sleeping = True
+        if self.engine:
+            self.engine.wakeup()
 
     def wakeup(self):
         if not self.auto_sleep:
@@ -288,9 +326,14 @@ class V4L2Camera(Thread):
         with self.condition:
             self.sleeping = False
             self.condition.notify_all()
+        if self.engine:
+            self.engine.wakeup()
 
     # Thread run
     def run(self):
+        if self.engine:
+            self.engine.run()
+            return
         if self.encoder:
             self.encoder.start()
         if self.decoder:
@@ -301,14 +344,23 @@ class V4L2Camera(Thread):
     def stop(self):
         self.stop_capturing()
         self.join()
+        if self.engine:
+            # the M2M threads were not started
+            for m2m in self.engine.m2ms:
+                m2m.stop_capturing()
+            return
         if self.decoder:
             self.decoder.stop()
         if self.encoder:
             self.encoder.stop()
 
+# It stops the camera when the last client is gone. The parser's cached GOP is cleared when the camera stops
+# and when it starts again (for the frames which were on the way), so a new client never starts with frames
+# from before the sleep
 class CameraSleeper:
-    def __init__(self, camera):
+    def __init__(self, camera, parser):
         self.camera = camera
+        self.parser = parser
         self.clients = 0
         self.clients_lock = Lock()
 
@@ -317,6 +369,7 @@ class CameraSleeper:
             return
         with self.clients_lock:
             if self.clients == 0:
+                self.parser.clear()
                 self.camera.wakeup()
             self.clients += 1
     
@@ -327,3 +380,4 @@ class CameraSleeper:
             self.clients -= 1
             if self.clients == 0:
                 self.camera.sleep()
+                self.parser.clear()
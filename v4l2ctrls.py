@@ -13,10 +13,10 @@ class V4L2Ctrls:
 
     def setup_v4l2_ctrls(self, params):
         for k, v in params.items():
-            if k in ['width', 'height', 'fps', 'auto_sleep', 'rotation',
+            if k in ['width', 'height', 'fps', 'auto_sleep', 'rotation', 'engine',
             'capture_format', 'capture_memory',
             'decoder', 'decoder_input_format', 'decoder_memory',
-            'encoder', 'encoder_input_format', 'encoder_memory',
+            'encoder', 'encoder_input_format', 'encoder_memory', 'encoder_format',
             ] or k.startswith('uvcx_'):
                 continue
             ctrl = find_by_name(self.ctrls, k)
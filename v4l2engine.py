@@ -0,0 +1,84 @@
+import os, select, logging
+
+# Drives the camera and the V4L2 M2M devices from one thread instead of one thread per device.
+# Every device is non-blocking and registered in one epoll, the frames are moved
+# between the queues in the same loop, so the stages don't wake up each other's threads.
+class V4L2Engine:
+    def __init__(self, camera, m2ms):
+        self.camera = camera
+        self.m2ms = m2ms
+        self.devices = [camera] + m2ms
+        self.fds = {device.fd: device for device in self.devices}
+        self.registered = set()
+        self.streaming = False
+
+        self.epoll = select.epoll()
+        # wakes up the loop on sleep, wakeup, stop and when a consumer released a buffer
+        self.wake_r, self.wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.epoll.register(self.wake_r, select.EPOLLIN)
+
+        for m2m in m2ms:
+            m2m.threaded = False
+        for device in self.devices:
+            device.bufpool.on_release = self.wakeup
+
+    # can be called from any thread
+    def wakeup(self):
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            # the pipe is full, the loop will wake up anyway
+            pass
+
+    # runs in the camera's thread until the camera is stopped
+    def run(self):
+        for m2m in self.m2ms:
+            m2m.streamon()
+        try:
+            while not self.camera.stopped:
+                self.update()
+                for fd, events in self.epoll.poll():
+                    if fd == self.wake_r:
+                        os.read(self.wake_r, 4096)
+                        continue
+                    device = self.fds[fd]
+                    try:
+                        device.capture_step(events)
+                    except Exception as e:
+                        logging.warning(f'{device.device}: capture_step: failed: {e}')
+        finally:
+            if self.streaming:
+                self.camera.streamoff()
+                self.streaming = False
+            for fd in self.registered:
+                self.epoll.unregister(fd)
+            self.registered.clear()
+
+    # handles the sleep transitions, queues back the released buffers
+    # and polls only the devices which have queued buffers
+    def update(self):
+        camera = self.camera
+        if camera.sleeping == self.streaming:
+            if self.streaming:
+                camera.streamoff()
+            else:
+                camera.streamon()
+            self.streaming = not self.streaming
+
+        for device in self.devices:
+            if device is camera and not self.streaming:
+                # the buffers will be queued by the next streamon
+                active = False
+            else:
+                device.bufpool.queue_free()
+                # V4L2 reports POLLERR without queued buffers, don't poll the device until then
+                active = device.bufpool.queued > 0
+
+            fd = device.fd
+            if active and fd not in self.registered:
+                # POLLIN: captured frame, POLLOUT: consumed input frame of an M2M device
+                self.epoll.register(fd, select.EPOLLIN if device is camera else select.EPOLLIN | select.EPOLLOUT)
+                self.registered.add(fd)
+            elif not active and fd in self.registered:
+                self.epoll.unregister(fd)
+                self.registered.discard(fd)
@@ -1,14 +1,19 @@
 from fcntl import ioctl
-from threading import Thread
-import mmap, os, struct, logging, sys
+from threading import Thread, Condition
+from time import monotonic
+import mmap, os, struct, logging, sys, select
 
 from v4l2ctrls import V4L2Ctrls
+from v4l2bufpool import BufferPool
 import v4l2
 
 JPEG_APP0 = b'\xff\xe0'
 JPEG_APP4 = b'\xff\xe4'
 JPEG_APP4_END = b'\xe4'
 
+# log the dropped input frames at most this often, in seconds
+DROP_WARNING_INTERVAL = 10
+
 class V4L2M2M(Thread):
     def __init__(self, device, pipe, params, width, height,
         input_format, capture_format, memory_config, input_sizeimage = 0):
@@ -23,8 +28,19 @@ class V4L2M2M(Thread):
         self.cap_bufs = []
 
         self.input_format = input_format
-
-        self.fd = os.open(self.device, os.O_RDWR, 0)
+        # the upstream buffers are held while they are queued on our OUTPUT queue,
+        # so several frames can be in flight
+        self.input_condition = Condition()
+        self.input_leases = {}
+        # False if the upstream device runs in our thread (see V4L2Engine)
+        self.threaded = True
+        # (upstream buffer, lease) of the frame which waits for a consumed input frame, only without threads
+        self.pending = None
+        self.dropped = 0
+        self.drop_warning = 0
+
+        # every DQBUF is driven by poll
+        self.fd = os.open(self.device, os.O_RDWR | os.O_NONBLOCK, 0)
 
         self.ctrls = V4L2Ctrls(self.device, self.fd)
         self.ctrls.setup_v4l2_ctrls(params)
@@ -40,6 +56,21 @@ class V4L2M2M(Thread):
             capture_memory,
             input_sizeimage,
         )
+        self.bufpool = BufferPool(self.device, self.fd, self.cap_bufs)
+
+        planes = v4l2.v4l2_planes()
+        self.qbuf = v4l2.v4l2_buffer()
+        self.qbuf.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE_MPLANE
+        self.qbuf.memory = self.cap_bufs[0].memory
+        self.qbuf.length = 1
+        self.qbuf.m.planes = planes
+
+        oplanes = v4l2.v4l2_planes()
+        self.obuf = v4l2.v4l2_buffer()
+        self.obuf.type = v4l2.V4L2_BUF_TYPE_VIDEO_OUTPUT_MPLANE
+        self.obuf.memory = self.input_bufs[0].memory
+        self.obuf.length = 1
+        self.obuf.m.planes = oplanes
 
     def init_device(self, width, height, input_format, capture_format, input_memory, capture_memory, input_sizeimage):
 
@@ -186,36 +217,119 @@ class V4L2M2M(Thread):
         self.ctrls.print_ctrls()
 
     def capture_loop(self):
-        for buf in self.cap_bufs:
-            ioctl(self.fd, v4l2.VIDIOC_QBUF, buf)
-
-        planes = v4l2.v4l2_planes()
-        qbuf = v4l2.v4l2_buffer()
-        qbuf.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE_MPLANE
-        qbuf.memory = self.cap_bufs[0].memory
-        qbuf.length = 1
-        qbuf.m.planes = planes
+        poller = select.poll()
+        # POLLIN: encoded/decoded frame, POLLOUT: consumed input frame
+        poller.register(self.fd, select.POLLIN | select.POLLOUT)
 
         while not self.stopped:
             try:
-                ioctl(self.fd, v4l2.VIDIOC_DQBUF, qbuf)
-
-                buf = self.cap_bufs[qbuf.index]
-                buf.m.planes[0].bytesused = qbuf.m.planes[0].bytesused
-                buf.timestamp = qbuf.timestamp
-
-                # store bytesused the same place as without MPLANE
-                buf.bytesused = qbuf.m.planes[0].bytesused
-
-                self.pipe.write_buf(buf)
-                ioctl(self.fd, v4l2.VIDIOC_QBUF, buf)
+                # queue back the buffers which were released by the consumers
+                self.bufpool.queue_free()
+                if not self.bufpool.wait_buffer(0.1):
+                    self.reclaim_input_bufs()
+                    continue
+
+                events = poller.poll(100)
+                if events:
+                    self.capture_step(events[0][1])
             except Exception as e:
                 if not self.stopped:
                     logging.warning(f'{self.device}: capture_loop: failed: {e}')
 
+    # handles the poll events of the device without blocking
+    def capture_step(self, events):
+        self.reclaim_input_bufs()
+        self.write_pending()
+
+        if not events & select.POLLIN:
+            return
+
+        qbuf = self.qbuf
+        try:
+            ioctl(self.fd, v4l2.VIDIOC_DQBUF, qbuf)
+        except BlockingIOError:
+            return
+
+        buf = self.cap_bufs[qbuf.index]
+        buf.m.planes[0].bytesused = qbuf.m.planes[0].bytesused
+        buf.timestamp = qbuf.timestamp
+
+        # store bytesused the same place as without MPLANE
+        buf.bytesused = qbuf.m.planes[0].bytesused
+
+        lease = self.bufpool.lease(buf)
+        try:
+            self.pipe.write_buf(buf)
+        finally:
+            lease.release()
+
+    # dequeue the consumed input buffers and give them back to the upstream device
+    def reclaim_input_bufs(self):
+        while True:
+            try:
+                ioctl(self.fd, v4l2.VIDIOC_DQBUF, self.obuf)
+            except BlockingIOError:
+                return
+            self.release_input_buf(self.obuf.index)
+
+    def release_input_buf(self, index):
+        with self.input_condition:
+            lease = self.input_leases.pop(index, None)
+            self.input_condition.notify_all()
+        if lease:
+            lease.release()
+
+    def drop_frame(self):
+        self.dropped += 1
+        now = monotonic()
+        if now - self.drop_warning >= DROP_WARNING_INTERVAL:
+            logging.warning(f'{self.device}: write_buf: the input frames are not consumed, dropped frames: {self.dropped}')
+            self.drop_warning = now
+
+    # writes the frame which waited for a consumed input frame, see write_buf
+    def write_pending(self):
+        pending = self.pending
+        if pending is None:
+            return
+        self.pending = None
+        ibuf, lease = pending
+        try:
+            # it is pending again if the input frames are still not consumed
+            self.write_buf(ibuf)
+        finally:
+            lease.release()
 
+    # called from the upstream device's thread
     def write_buf(self, ibuf):
         buf = self.input_bufs[ibuf.index]
+        lease = getattr(ibuf, 'lease', None)
+
+        if not self.threaded:
+            # nobody else reclaims them
+            self.reclaim_input_bufs()
+            self.write_pending()
+
+        with self.input_condition:
+            if buf.index in self.input_leases:
+                logging.warning(f'{self.device}: write_buf: input buffer {buf.index} is still queued')
+                return
+            # leave some buffers to the upstream device, wait until we consume the older frames
+            ready = not lease or self.input_condition.wait_for(lambda: not self.input_leases or not lease.pool.starving(), 1 if self.threaded else 0)
+            if ready:
+                self.input_leases[buf.index] = lease.acquire() if lease else None
+
+        if not ready:
+            if self.threaded:
+                self.drop_frame()
+                return
+            # the upstream device runs in our thread, it can't wait, capture_step writes the frame
+            # when an input frame is consumed, a newer frame replaces it
+            replaced, self.pending = self.pending, (ibuf, lease.acquire())
+            if replaced:
+                replaced[1].release()
+                self.drop_frame()
+            return
+
         buf.timestamp = ibuf.timestamp
         buf.m.planes[0].bytesused = ibuf.bytesused
 
@@ -234,23 +348,34 @@ class V4L2M2M(Thread):
 
         #print(f"{self.device} writing input buf bytesused {buf.m.planes[0].bytesused} length {buf.m.planes[0].length} fd {buf.m.planes[0].m.fd} buf length {buf.length}")
         try:
+            # don't wait for the device, our thread reclaims the buffer when it's consumed
             ioctl(self.fd, v4l2.VIDIOC_QBUF, buf)
-            ioctl(self.fd, v4l2.VIDIOC_DQBUF, buf)
         except Exception as e:
             logging.warning(f'{self.device}: write_buf: failed: {e}')
+            self.release_input_buf(buf.index)
 
 
 
     def start_capturing(self):
+        self.streamon()
+        self.capture_loop()
+
+    def streamon(self):
         ioctl(self.fd, v4l2.VIDIOC_STREAMON, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_OUTPUT_MPLANE))
         ioctl(self.fd, v4l2.VIDIOC_STREAMON, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE_MPLANE))
-        self.capture_loop()
+        self.bufpool.start()
 
 
     def stop_capturing(self):
         self.stopped = True
         ioctl(self.fd, v4l2.VIDIOC_STREAMOFF, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_OUTPUT_MPLANE))
         ioctl(self.fd, v4l2.VIDIOC_STREAMOFF, struct.pack('I', v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE_MPLANE))
+        # STREAMOFF dequeued every input buffer
+        for index in list(self.input_leases):
+            self.release_input_buf(index)
+        pending, self.pending = self.pending, None
+        if pending:
+            pending[1].release()
 
     # Thread run
     def run(self):